@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+import copy
+import random
+import unittest
+
+import numpy as np
+
+import result_cache
+from panel import streak_series, drawdown_series
+
+
+# Bump it when the thresholds change, to invalidate the cached ones
+VERSION = 1
+# Shorter histories keep the thresholds of the config
+MIN_HISTORY = 250
+# The cached thresholds are reused until the history has grown by this many prices
+REFRESH = 20
+
+
+def series_thresholds(worth, quantiles):
+    '''Thresholds of MonitorConfig from the distributions of a series' own N, drawdown and daily moves
+
+    quantiles maps the names of the thresholds to the quantile of their distribution, e.g.
+    {'low_threshold': 0.01, 'high_threshold': 0.99, 'drawdown_threshold': 0.95, 'daily_change_threshold': 0.99}
+    N and the drawdown are the ones each day would have had, see panel.streak_series and drawdown_series.
+    '''
+    worth = list(worth)
+    thresholds = {}
+    if 'low_threshold' in quantiles or 'high_threshold' in quantiles:
+        N = np.asarray(streak_series(worth))
+        for name in ('low_threshold', 'high_threshold'):
+            if name in quantiles:
+                thresholds[name] = int(np.quantile(N, quantiles[name]))
+    if 'drawdown_threshold' in quantiles:
+        thresholds['drawdown_threshold'] = round(float(np.quantile(drawdown_series(worth), quantiles['drawdown_threshold'])), 4)
+    if 'daily_change_threshold' in quantiles:
+        prices = np.asarray(worth, dtype=np.float64)
+        moves = np.abs(prices[1:] / prices[:-1] - 1)
+        thresholds['daily_change_threshold'] = round(float(np.quantile(moves, quantiles['daily_change_threshold'])), 4)
+    return thresholds
+
+
+def quantiles_key(quantiles):
+    return str(sorted(quantiles.items()))
+
+
+def reusable(cached_length, length):
+    """Whether the thresholds of the first cached_length prices still hold for the first length ones"""
+    return 0 <= length - cached_length < REFRESH
+
+
+def asset_thresholds(asset, quantiles, cache=None):
+    '''Thresholds of an asset from the history before today, None if it is too short
+
+    They are cached by code and reused while the history only grows by fewer than REFRESH
+    prices and its cached prefix is unchanged, so most runs do not compute them at all.
+    '''
+    history = asset.worth[:-1]
+    if len(history) < MIN_HISTORY:
+        return None
+    if cache is None:
+        return series_thresholds(history, quantiles)
+    key = '{0}|thresholds:{1}|{2}'.format(asset.code, VERSION, quantiles_key(quantiles))
+    cached = cache.get(key)
+    if cached is not None and reusable(cached['length'], len(history)) \
+            and result_cache.fingerprint(history[:cached['length']]) == cached['fingerprint']:
+        return cached['thresholds']
+    thresholds = series_thresholds(history, quantiles)
+    cache.put(key, {'length': len(history), 'fingerprint': result_cache.fingerprint(history),
+                    'thresholds': thresholds})
+    return thresholds
+
+
+def with_thresholds(config, thresholds):
+    """A copy of config with the thresholds of an asset, config itself if there are none"""
+    if not thresholds:
+        return config
+    config = copy.copy(config)
+    config.__dict__.update(thresholds)
+    return config
+
+
+class TestAdaptiveThresholds(unittest.TestCase):
+    def series(self, n, volatility):
+        random.seed(3)
+        price, worth = 1.0, []
+        for _ in range(n):
+            price *= 1 + random.gauss(0, volatility)
+            worth.append(price)
+        return worth
+
+    def test_series_thresholds(self):
+        quantiles = {'low_threshold': 0.05, 'high_threshold': 0.95, 'drawdown_threshold': 0.9, 'daily_change_threshold': 0.99}
+        bond = series_thresholds(self.series(1000, 0.002), quantiles)
+        coin = series_thresholds(self.series(1000, 0.05), quantiles)
+        self.assertEqual(set(quantiles), set(bond))
+        self.assertLess(bond['daily_change_threshold'], coin['daily_change_threshold'])
+        self.assertLess(bond['drawdown_threshold'], coin['drawdown_threshold'])
+        self.assertLess(bond['low_threshold'], 0)
+        self.assertGreater(bond['high_threshold'], 0)
+        # about 1% of the days move more than the threshold
+        worth = np.asarray(self.series(1000, 0.05))
+        moves = np.abs(worth[1:] / worth[:-1] - 1)
+        self.assertAlmostEqual(0.01, np.mean(moves > coin['daily_change_threshold']), delta=0.005)
+
+    def test_cache(self):
+        from unittest import mock
+        from base_asset import TestAsset
+        quantiles = {'daily_change_threshold': 0.99}
+        cache = result_cache.ResultCache()
+        asset = TestAsset('A')
+        asset.worth = self.series(300, 0.01)
+        self.assertIsNone(asset_thresholds(TestAsset('B'), quantiles, cache))
+        with mock.patch('adaptive_thresholds.series_thresholds', wraps=series_thresholds) as compute:
+            first = asset_thresholds(asset, quantiles, cache)
+            asset.worth = asset.worth + [asset.worth[-1] * 1.5] * 5
+            self.assertEqual(first, asset_thresholds(asset, quantiles, cache))
+            self.assertEqual(1, compute.call_count)
+            asset.worth = asset.worth + [1.0] * REFRESH
+            asset_thresholds(asset, quantiles, cache)
+            self.assertEqual(2, compute.call_count)
+            asset.worth[0] *= 2  # the history has been replaced
+            asset_thresholds(asset, quantiles, cache)
+            self.assertEqual(3, compute.call_count)
+
+    def test_monitor(self):
+        import os
+        import tempfile
+        from monitor_config import MonitorConfig
+        from monitor_with_criteria import MonitorWithCriteria
+        from base_asset import TestAsset
+        worth = self.series(400, 0.002)
+        with tempfile.TemporaryDirectory() as directory:
+            alerts = {}
+            for quantiles in [None, {'daily_change_threshold': 0.99}]:
+                config = MonitorConfig(asset_type='stock', subject_prefix='test', daily_change_threshold=0.1,
+                                       snapshot_file=os.path.join(directory, 'snapshot.json'),
+                                       adaptive_quantiles=quantiles)
+                monitor = MonitorWithCriteria(config)
+                asset = TestAsset('A', worth + [worth[-1] * 1.02])  # +2% is rare for this series
+                asset.result_cache = None
+                asset.trade()
+                monitor.success = [asset]
+                monitor.filter_sort()  # the first run only records the price
+                asset.worth[-1] *= 1.001
+                alerts[str(quantiles)] = monitor.filter_sort()
+                os.remove(config.snapshot_file)
+            self.assertEqual([[], ['A']], [[a.code for a in v] for v in alerts.values()])
@@ -0,0 +1,172 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import json
+import time
+import asyncio
+import resource
+import threading
+import subprocess
+import unittest
+
+
+class StubServer:
+    """Local HTTP server answering every request after delay seconds, so the benchmark needs no network"""
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.port = None
+        self._loop = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    async def _handle(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            await asyncio.sleep(self.delay)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, '127.0.0.1', 0, backlog=4096))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return 'http://127.0.0.1:{0}/'.format(self.port)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def run_threads(url, n, concurrency):
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    def get(_):
+        return requests.get(url, timeout=60).status_code == 200
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(get, range(n)))
+
+
+def run_gevent(url, n, concurrency):
+    from gevent import monkey
+    monkey.patch_all()
+    import requests
+    from gevent.pool import Pool
+
+    def get(_):
+        return requests.get(url, timeout=60).status_code == 200
+
+    return sum(Pool(concurrency).imap_unordered(get, range(n)))
+
+
+def run_asyncio(url, n, concurrency):
+    import aiohttp
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def get():
+                async with semaphore, session.get(url) as r:
+                    await r.read()
+                    return r.status == 200
+            return sum(await asyncio.gather(*(get() for _ in range(n))))
+
+    return asyncio.run(main())
+
+
+BACKENDS = {'threads': run_threads, 'gevent': run_gevent, 'asyncio': run_asyncio}
+
+
+def measure(backend, url, n, concurrency):
+    """Run one backend in a fresh process, gevent patches the whole interpreter"""
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--client', backend, url, str(n), str(concurrency)],
+        capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def benchmark(n=1000, delay=0.5, concurrency=500, backends=tuple(BACKENDS)):
+    '''Time n requests waiting delay seconds each with up to concurrency of them in flight
+
+    The ideal time is n / concurrency * delay, what is above it is the overhead of the backend.
+    '''
+    server = StubServer(delay)
+    url = server.start()
+    try:
+        return {backend: measure(backend, url, n, concurrency) for backend in backends}
+    finally:
+        server.stop()
+
+
+class TestBackendBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        results = benchmark(n=40, delay=0.05, concurrency=20)
+        for backend, result in results.items():
+            self.assertEqual(40, result['ok'], backend)
+            self.assertGreaterEqual(result['seconds'], 0.1)
+
+    def test_gevent_monitor(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        results = {}
+        for backend in ['threads', 'gevent']:
+            monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test'))
+            monitor.BACKEND = backend
+            assets = [TestAsset('A', [1, 2, 3]), TestAsset('B', [1], fail=True), TestAsset('C', [3, 2])]
+            for asset in assets:
+                asset.result_cache = None
+            monitor._download_asset_data(assets)
+            monitor._sort_results_by_original_order(assets)
+            results[backend] = ([(a.code, a.N) for a in monitor.success], monitor.failed)
+        self.assertEqual((([('A', 2), ('C', -1)]), ['B']), results['gevent'])
+        self.assertEqual(results['threads'], results['gevent'])
+
+    def test_patch_first(self):
+        '''Every entry script patches the standard library before smtplib and ssl are imported'''
+        code = 'import {0}; import gevent_patch; print(gevent_patch.imported_too_early)'
+        env = dict(os.environ, DOWNLOAD_BACKEND='gevent', TEST='1')
+        for script in ['monitor_all', 'monitor_funds', 'monitor_subscribers', 'monitor_distributed']:
+            out = subprocess.run([sys.executable, '-c', code.format(script)], env=env, capture_output=True,
+                                 text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            self.assertEqual('[]', out.strip().splitlines()[-1], script)
+
+    def test_gevent_with_budget(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', latency_budget=5))
+        monitor.BACKEND = 'gevent'
+        asset = TestAsset('A', [1, 2])
+        asset.result_cache = None
+        with self.assertLogs(level='WARNING') as logs:
+            monitor._download_asset_data([asset])
+        self.assertIn('ignored with a latency budget', '\n'.join(logs.output))
+        self.assertEqual([asset], monitor.success)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--client']:
+        backend, url, n, concurrency = sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])
+        start = time.time()
+        ok = BACKENDS[backend](url, n, concurrency)
+        print(json.dumps({'ok': ok, 'seconds': round(time.time() - start, 3),
+                          'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}))
+    else:
+        # python backend_benchmark.py [requests] [delay] [concurrency]
+        args = [float(a) for a in sys.argv[1:4]]
+        n, delay, concurrency = (args + [1000, 0.5, 500][len(args):])
+        for backend, result in benchmark(int(n), delay, int(concurrency)).items():
+            print('{0:8} {1}'.format(backend, result))
@@ -1,19 +1,59 @@
 # -*- coding: UTF-8 -*-
+import time
 import logging
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone, timedelta
 import unittest
 
+from range_index import SparseTable
+from order_stats import RankIndex
+import result_cache
+import history_archive
+import risk
+import adaptive_thresholds
+import sparkline
+import trading_calendar
+
+
+# Timestamps in dates are converted to trading days in this timezone.
+# Sources stamp a daily close at midnight Beijing time (funds), midnight UTC (crypto)
+# or a calendar date (stocks), all of which fall on the right day in UTC+8.
+TIMEZONE = timezone(timedelta(hours=8))
+
+
+def to_date(timestamp):
+    """Convert a timestamp in milliseconds into its trading day"""
+    return datetime.fromtimestamp(timestamp / 1000, TIMEZONE).date()
+
 
 class BaseAsset(ABC):
     """Base class for all asset types"""
+    # Bump it when the results of buy_or_sell or cal_mdd change, to invalidate cached results
+    STRATEGY_VERSION = 1
+    # Cache of analysis results keyed by the data fingerprint, set to None to disable
+    result_cache = result_cache.default_cache
+    # Archive that every successful download is written to, set HISTORY_ARCHIVE to enable it
+    archive = history_archive.default_archive
+    # Key of trading_calendar.MARKETS, None if unknown: the asset is processed on every run
+    market = None
+    # Prices per year of the series, to annualize the risk metrics
+    periods_per_year = 252
+
     def __init__(self, code):
         self.code = code
         self.name = ''
+        self.dates = [] # Timestamps in milliseconds of worth, see to_date
         self.worth = [] # Daily closing prices
         self.trading = False # Whether currently trading
+        self.stale = False # Whether the history is the archived one because the download failed or was late
         self.N = 0 # Records the output of the buy_or_sell strategy method, positive means buy amount, negative means sell
         self.mdd = None # Maximum drawdown
         self.cur = None # Current drawdown
+        self.rank = None # Percentile rank of the current price in the history, 0 is the lowest and 1 the highest
+        self._range_index = None # SparseTable over worth, built lazily by range_min/range_max
+        self._range_index_key = None
+        self._rank_index = None # RankIndex over the history before today, built lazily by percentile_rank
+        self._rank_index_key = None
 
     @property
     def current_price(self):
@@ -55,9 +95,15 @@ class BaseAsset(ABC):
         """Default string representation with hardcoded thresholds for backward compatibility"""
         return self.format_with_config()
 
-    def format_with_config(self, low_threshold=-300, drawdown_threshold=0.2, daily_change_threshold=0.1):
-        """Format asset string with configurable thresholds"""
+    def format_with_config(self, low_threshold=-300, drawdown_threshold=0.2, daily_change_threshold=0.1,
+                           low_rank_threshold=None, high_rank_threshold=None, rank_window=None):
+        """Format asset string with configurable thresholds
+
+        The percentile rank is only shown when a rank threshold is given and reached.
+        """
         k = '{0}({1})'.format(self.name, self.code)
+        if self.stale:
+            k += '⌛'
         v = str(self.N)
 
         # return MAX when it reaches the highest in history
@@ -96,8 +142,62 @@ class BaseAsset(ABC):
             else:
                 v += '🅓'
 
+        # Percentile rank of the current price in the past rank_window trading days
+        rank = self.rank if rank_window is None else self.percentile_rank(rank_window)
+        if rank is not None and (
+                (low_rank_threshold is not None and rank <= low_rank_threshold) or
+                (high_rank_threshold is not None and rank >= high_rank_threshold)):
+            if v[-1].isdigit():
+                v += ','
+            v += 'P{:.0f}%'.format(100*rank)
+
         return '{0}:{1}'.format(k, v)
 
+    def _get_range_index(self):
+        """Get the range index of worth, rebuilding it if worth has been replaced, extended or today's price updated"""
+        key = (id(self.worth), len(self.worth), self.current_price)
+        if self._range_index_key != key:
+            self._range_index = SparseTable(self.worth)
+            self._range_index_key = key
+        return self._range_index
+
+    def range_min(self, start=None, end=None):
+        """min(worth[start:end]) in O(1) after the index is built"""
+        start, end, _ = slice(start, end).indices(len(self.worth))
+        return self._get_range_index().min(start, end)
+
+    def range_max(self, start=None, end=None):
+        """max(worth[start:end]) in O(1) after the index is built"""
+        start, end, _ = slice(start, end).indices(len(self.worth))
+        return self._get_range_index().max(start, end)
+
+    def window_min(self, window, end=None):
+        """Minimum of the last `window` prices up to end (exclusive), e.g. min(worth[-window:])
+
+        Backtests can pass end=i+1 to evaluate day i without slicing worth.
+        """
+        end = len(self.worth) if end is None else end
+        return self.range_min(max(end - window, 0), end)
+
+    def window_max(self, window, end=None):
+        """Maximum of the last `window` prices up to end (exclusive), e.g. max(worth[-window:])"""
+        end = len(self.worth) if end is None else end
+        return self.range_max(max(end - window, 0), end)
+
+    def percentile_rank(self, window=None):
+        """Percentile rank of the current price among the previous `window` prices (the full history if None)
+
+        The index over the history is cached, so re-ranking an updated intraday price costs O(log n).
+        """
+        if len(self.worth) < 2:
+            return None
+        key = (id(self.worth), len(self.worth), window)
+        if self._rank_index_key != key:
+            history = self.worth[:-1] if window is None else self.worth[-window-1:-1]
+            self._rank_index = RankIndex(history, history)
+            self._rank_index_key = key
+        return self._rank_index.percentile(self.current_price)
+
     def buy_or_sell(self, worth):
         '''This strategy does not directly output the amount to buy or sell, but outputs a strength signal for me to decide
     self.N: positive number represents price higher than past N trading days, negative number represents price lower than past N trading days'''
@@ -152,24 +252,126 @@ class BaseAsset(ABC):
                 if retry < 0:
                     raise
 
-        self.N = self.buy_or_sell(self.worth)
-        self.mdd, self.cur = self.cal_mdd()
+        if self.archive is not None:
+            self.archive.write_asset(self)
+        return self.analyze()
+
+    def settled(self, now=None):
+        '''Number of leading rows of dates and worth whose prices are final, the ones to archive
+
+        The last row is provisional while it is an estimate (trading) or the real-time price of
+        a day whose close has not been published yet, see trading_calendar.Market.last_close.
+        Without a market calendar, the day must be over in TIMEZONE.
+        '''
+        n = len(self.worth)
+        if not n or self.trading:
+            return max(n - 1, 0)
+        now = now or datetime.now(timezone.utc)
+        market = trading_calendar.MARKETS.get(self.market)
+        close = market.last_close(now) if market is not None else None
+        if close is not None:
+            last_day = close.astimezone(market.tz).date()
+        else:
+            last_day = now.astimezone(TIMEZONE).date() - timedelta(days=1)
+        return n if to_date(self.dates[-1]) <= last_day else n - 1
+
+    def restore(self, archive):
+        """Load the history from an archive instead of downloading it"""
+        dates, prices = archive.read(self.code)
+        self.dates = dates.tolist()
+        self.worth = prices.tolist()
+        self.name = archive.index[self.code]['name'] or self.name
+
+    def fallback(self):
+        """Serve the last archived history when the download failed or was late, False if there is none"""
+        if self.archive is None or self.code not in self.archive:
+            return False
+        self.restore(self.archive)
+        self.trading = False
+        self.stale = True
+        self.analyze()
+        return True
+
+    def result_key(self):
+        """Key of the analysis results: asset code, series fingerprint and strategy identity"""
+        strategy = '{0}.{1}:{2}'.format(type(self).__module__, type(self).__qualname__, self.STRATEGY_VERSION)
+        return '{0}|{1}|{2}'.format(self.code, result_cache.fingerprint(self.worth), strategy)
+
+    def analyze(self):
+        """Run the strategy on worth, reusing the cached results if this series has been analyzed before"""
+        def compute():
+            N = self.buy_or_sell(self.worth)
+            mdd, cur = self.cal_mdd()
+            return {'N': N, 'mdd': mdd, 'cur': cur, 'rank': self.percentile_rank()}
+
+        if self.result_cache is None:
+            results = compute()
+        else:
+            results = self.result_cache.get_or_compute(self.result_key(), compute)
+        self.N = results['N']
+        self.mdd = results['mdd']
+        self.cur = results['cur']
+        self.rank = results['rank']
         return self.N
 
+    def risk_metrics(self):
+        """Risk metrics of worth (see risk.risk_metrics), cached by the data fingerprint like analyze"""
+        def compute():
+            return risk.risk_metrics(self.worth, self.periods_per_year)
+
+        if self.result_cache is None:
+            return compute()
+        key = '{0}|{1}|risk:{2}:{3}'.format(
+            self.code, result_cache.fingerprint(self.worth), risk.VERSION, self.periods_per_year)
+        return self.result_cache.get_or_compute(key, compute)
+
+    def adaptive_thresholds(self, quantiles):
+        """Thresholds of MonitorConfig from quantiles of the history, see adaptive_thresholds.asset_thresholds"""
+        return adaptive_thresholds.asset_thresholds(self, quantiles, self.result_cache)
+
+    def sparkline(self, low_threshold, high_threshold):
+        """Inline SVG chart of the history with its buy/sell signals, see sparkline.sparkline_svg"""
+        return sparkline.sparkline_svg(self.worth, low_threshold=low_threshold, high_threshold=high_threshold)
+
+    @classmethod
+    def prefetch(cls, assets):
+        """Fetch the data of many assets of this class at once before their trade(), nothing by default"""
+        pass
+
+    @classmethod
+    def release(cls):
+        """Free the resources shared by the downloads of this class once they are all done"""
+        if cls.archive is not None:
+            cls.archive.save()
+
     @abstractmethod
     def download(self):
         """Download asset data - must be implemented by subclasses"""
         pass
 
 class TestAsset(BaseAsset):
-    """Concrete implementation of BaseAsset for testing"""
-    def __init__(self, code):
+    '''Concrete implementation of BaseAsset for testing
+
+    If worth is set, download() serves it after delay seconds with its last price real-time
+    (trading) and one date per millisecond since the epoch, or raises if fail is set.
+    '''
+    def __init__(self, code, worth=None, fail=False, delay=0):
         super().__init__(code)
         self.name = 'Test Asset'
+        self._worth = worth
+        self.fail = fail
+        self.delay = delay
+        self.downloads = 0
 
     def download(self):
-        """Dummy implementation for testing"""
-        pass
+        self.downloads += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception('download failed')
+        if self._worth is not None:
+            self.worth = list(self._worth)
+            self.dates = list(range(len(self.worth)))
+            self.trading = True
 
 class TestBaseAsset(unittest.TestCase):
     """Tests for BaseAsset formatting functionality"""
@@ -385,6 +587,80 @@ class TestBaseAsset(unittest.TestCase):
         expected = 'Test Asset(TEST):-400🅢🅑-29.2%⬇️30%🅜'
         self.assertEqual(expected, result)
 
+    def test_range_min_max(self):
+        """Test the range min/max helpers against slicing"""
+        self.asset.worth = [3, 1, 4, 1, 5, 9, 2, 6]
+        self.assertEqual(1, self.asset.range_min())
+        self.assertEqual(9, self.asset.range_max())
+        self.assertEqual(min(self.asset.worth[2:5]), self.asset.range_min(2, 5))
+        self.assertEqual(max(self.asset.worth[-3:]), self.asset.range_max(-3))
+        for window in range(1, 10):
+            self.assertEqual(min(self.asset.worth[-window:]), self.asset.window_min(window))
+            self.assertEqual(max(self.asset.worth[-window:]), self.asset.window_max(window))
+            self.assertEqual(min(self.asset.worth[:5][-window:]), self.asset.window_min(window, end=5))
+        # the index follows updates of today's price
+        self.asset.worth[-1] = 10
+        self.assertEqual(10, self.asset.range_max())
+        self.asset.worth.append(0)
+        self.assertEqual(0, self.asset.window_min(2))
+        # empty range
+        self.assertRaises(ValueError, self.asset.range_min, 3, 3)
+
+    def test_percentile_rank(self):
+        """Test the percentile rank of the current price"""
+        self.asset.worth = [100.0]
+        self.assertIsNone(self.asset.percentile_rank())
+        self.asset.worth = [3, 1, 4, 1, 5, 2]
+        self.assertEqual(0.4, self.asset.percentile_rank())  # higher than 1, 1
+        self.assertEqual(0.5, self.asset.percentile_rank(2))  # among [1, 5]
+        self.asset.worth[-1] = 10  # intraday update
+        self.assertEqual(1, self.asset.percentile_rank())
+        self.asset.worth[-1] = 0
+        self.assertEqual(0, self.asset.percentile_rank(3))
+
+    def test_format_with_config_rank(self):
+        """Test that the percentile rank is displayed when it reaches a rank threshold"""
+        self.asset.worth = [3, 5, 4, 1, 2, 1.9]
+        self.asset.N = -1
+        self.asset.cur = 0.0
+        self.asset.rank = self.asset.percentile_rank()
+        self.assertNotIn('P', self.asset.format_with_config())
+        result = self.asset.format_with_config(low_rank_threshold=0.2)
+        self.assertEqual('Test Asset(TEST):-1,P20%', result)
+        self.assertNotIn('P', self.asset.format_with_config(high_rank_threshold=0.95))
+        # rank within a window
+        self.asset.worth[-1] = 4.5
+        result = self.asset.format_with_config(high_rank_threshold=0.9, rank_window=2)
+        self.assertIn('P100%', result)
+
+    def test_analyze_cache(self):
+        """Test that analysis results are reused for an identical series"""
+        calls = []
+        class CountingAsset(TestAsset):
+            result_cache = result_cache.ResultCache()
+            def buy_or_sell(self, worth):
+                calls.append(1)
+                return super().buy_or_sell(worth)
+
+        asset = CountingAsset('TEST')
+        asset.worth = [1, 0.8, 0.9]
+        self.assertEqual(1, asset.analyze())
+        self.assertEqual((0.2, 0), (asset.mdd, asset.cur))
+        other = CountingAsset('TEST')
+        other.worth = [1, 0.8, 0.9]
+        self.assertEqual(1, other.analyze())
+        self.assertEqual(0, other.cur)
+        self.assertEqual(0.5, other.rank)
+        self.assertEqual(1, len(calls))
+        # a new price is a new fingerprint
+        other.worth.append(0.7)
+        self.assertEqual(-3, other.analyze())
+        self.assertEqual(2, len(calls))
+        # a different strategy version is a different key
+        other.STRATEGY_VERSION = 2
+        other.analyze()
+        self.assertEqual(3, len(calls))
+
     def test_buy_or_sell(self):
         """Test the buy_or_sell strategy method"""
         buy_or_sell = self.asset.buy_or_sell
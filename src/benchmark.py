@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+
+import numpy as np
+
+from panel import streak_series
+
+
+def market_returns(prices, horizon):
+    """Buy and hold from every start day s for horizon trading days: prices[s+horizon] / prices[s]"""
+    prices = np.asarray(prices, dtype=np.float64)
+    return prices[horizon:] / prices[:len(prices) - horizon]
+
+
+def dca_returns(prices, horizon):
+    '''Buy 1 every day from every start day s to s+horizon, like FundBaseline
+
+    The shares bought between two days are a difference of the cumulative sum of 1/price,
+    so all start days are evaluated in one pass without any simulation.
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    shares = np.concatenate([[0], np.cumsum(1 / prices)])
+    starts = np.arange(len(prices) - horizon)
+    bought = shares[starts + horizon + 1] - shares[starts]
+    return bought * prices[starts + horizon] / (horizon + 1)
+
+
+def strategy_returns(prices, signals, horizons):
+    '''Returns of a strategy from every start day for several horizons at once
+
+    signals[t] is the money to invest (negative to redeem) on day t, computed on the
+    full history, e.g. signals_from_streak(prices). The accounting is the one of
+    MyFund.backtest in the notebook: redemptions are capped by the position and their
+    money is reused by later buys, cost is the peak of the money put in. All start days
+    are simulated together, one vectorized step per day of the longest horizon.
+    Return a dict horizon -> array of returns indexed by start day (NaN if nothing was bought).
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    signals = np.asarray(signals, dtype=np.float64)
+    n = len(prices)
+    horizons = sorted(h for h in horizons if h < n)
+    results = {}
+    if not horizons:
+        return results
+    starts = np.arange(n - horizons[0])
+    cost = np.zeros(len(starts))
+    share = np.zeros(len(starts))
+    money = np.zeros(len(starts))
+    for k in range(horizons[-1] + 1):
+        t = starts + k
+        alive = t < n
+        t = np.minimum(t, n - 1)
+        x = np.where(alive, signals[t], 0)
+        y = prices[t]
+        # sell
+        x = np.where(x < 0, -np.minimum(-x, share * y), x)
+        money -= np.minimum(x, 0)
+        # buy with the redeemed money first
+        buy = np.maximum(x, 0)
+        cost += np.maximum(buy - money, 0)
+        money = np.maximum(money - buy, 0)
+        share += x / y
+        if k in horizons:
+            valid = len(prices) - k
+            with np.errstate(invalid='ignore', divide='ignore'):
+                r = (share * y + money) / cost
+            results[k] = np.where(cost > 0, r, np.nan)[:valid]
+    return results
+
+
+def signals_from_streak(prices, window=80, max_units=8):
+    """Money to invest each day by the README strategy on N: buy k when N <= -k*window, sell k when N >= k*window"""
+    N = np.asarray(streak_series(list(prices)))
+    k = np.minimum(np.abs(N) // window, max_units)
+    return np.where(N < 0, k, -k).astype(np.float64)
+
+
+def compare(prices, signals, horizons):
+    '''Market, DCA and strategy returns for every start day and every horizon (in trading days)
+
+    Return a dict horizon -> {'market': ..., 'dca': ..., 'strategy': ...}, the arrays are
+    indexed by start day, replacing the random sampling of start days in the notebook.
+    '''
+    strategy = strategy_returns(prices, signals, horizons)
+    return {h: {
+        'market': market_returns(prices, h),
+        'dca': dca_returns(prices, h),
+        'strategy': strategy[h],
+    } for h in strategy}
+
+
+def win_rates(comparison):
+    """Fraction of start days where the strategy beats the market and DCA, for every horizon"""
+    rates = {}
+    for h, r in comparison.items():
+        strategy = np.nan_to_num(r['strategy'], nan=1.0)  # nothing bought means nothing gained
+        rates[h] = {
+            'market': float(np.mean(strategy >= r['market'])),
+            'dca': float(np.mean(strategy >= r['dca'])),
+        }
+    return rates
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        random.seed(4)
+        price = 1.0
+        self.prices = []
+        for _ in range(300):
+            price *= random.uniform(0.97, 1.03)
+            self.prices.append(price)
+
+    def backtest(self, signals, start, horizon):
+        """MyFund.backtest of the notebook for one start day"""
+        cost = share = money = 0
+        for i in range(start, start + horizon + 1):
+            x, y = signals[i], self.prices[i]
+            if x < 0:
+                x = -min(-x, share * y)
+                money -= x
+            else:
+                if x < money:
+                    money -= x
+                else:
+                    cost += (x - money)
+                    money = 0
+            share += x / y
+        return (share * y + money) / cost if cost > 0 else np.nan
+
+    def test_market_and_dca(self):
+        h = 20
+        market = market_returns(self.prices, h)
+        dca = dca_returns(self.prices, h)
+        self.assertEqual(len(self.prices) - h, len(market))
+        self.assertEqual(len(self.prices) - h, len(dca))
+        for s in [0, 17, len(self.prices) - h - 1]:
+            self.assertAlmostEqual(self.prices[s + h] / self.prices[s], market[s])
+            self.assertAlmostEqual(self.backtest([1] * len(self.prices), s, h), dca[s])
+
+    def test_strategy(self):
+        signals = signals_from_streak(self.prices, window=5, max_units=3)
+        self.assertTrue((signals > 0).any() and (signals < 0).any())
+        results = strategy_returns(self.prices, signals, [10, 50, 1000])
+        self.assertEqual([10, 50], sorted(results))
+        for h, r in results.items():
+            self.assertEqual(len(self.prices) - h, len(r))
+            for s in range(0, len(r), 7):
+                np.testing.assert_allclose(self.backtest(signals, s, h), r[s])
+
+    def test_compare(self):
+        comparison = compare(self.prices, [1] * len(self.prices), [30, 60])
+        np.testing.assert_allclose(comparison[30]['dca'], comparison[30]['strategy'])
+        comparison = compare(self.prices, signals_from_streak(self.prices, window=5), [30, 60])
+        rates = win_rates(comparison)
+        r = comparison[60]
+        self.assertEqual(np.mean(r['strategy'] >= r['market']), rates[60]['market'])
+        self.assertEqual(np.mean(r['strategy'] >= r['dca']), rates[60]['dca'])
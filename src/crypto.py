@@ -1,34 +1,187 @@
 # -*- coding: UTF-8 -*-
+import bisect
 import logging
 from datetime import datetime
 import pandas as pd
 import time
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import ccxt
 
+import rate_limiter
 from base_asset import BaseAsset
 
 
+DAY_MS = 24 * 60 * 60 * 1000  # daily candles start at 00:00 UTC
+
+
+def verify_candles(candles, start, period, end=None):
+    '''Check that candles are sorted on the grid start + k * period without duplicates
+
+    Raise ValueError otherwise, return the missing ranges up to end (included) as
+    (first missing, next present) pairs.
+    '''
+    gaps = []
+    previous = start - period
+    for candle in candles:
+        t = candle[0]
+        if (t - start) % period:
+            raise ValueError(f"candle at {t} is not aligned on {period}ms from {start}")
+        if t <= previous:
+            raise ValueError(f"candle at {t} overlaps or is out of order after {previous}")
+        if t - previous > period:
+            gaps.append((previous + period, t))
+        previous = t
+    if end is not None and previous < end:
+        gaps.append((previous + period, end + period))
+    return gaps
+
+
 class Crypto(BaseAsset):
-    def __init__(self, symbol, exchange_name='binance'):
-        # For crypto, we use the symbol as the code (e.g., 'BTC/USDT')
-        super().__init__(symbol)
+    BACKFILL_WORKERS = 4  # concurrent requests of a backfill
+    LIMIT = 1000  # maximum candles per request for most exchanges
+    market = 'CRYPTO'
+
+    def __init__(self, symbol, exchange_name='binance', timeframe='1d'):
+        # For crypto, we use the symbol as the code (e.g., 'BTC/USDT'), with the timeframe if not daily
+        super().__init__(symbol if timeframe == '1d' else f'{symbol} {timeframe}')
         self.symbol = symbol
         self.exchange_name = exchange_name
+        self.timeframe = timeframe  # '1d', '4h', '1h', '15m'...
+        self.period = ccxt.Exchange.parse_timeframe(timeframe) * 1000  # candle length in milliseconds
         self.name = self.symbol.split('/')[0]  # e.g., BTC/USDT -> BTC
+        self.history = None  # (dates, worth) of a previous run to extend, see crypto_screener.py
+        self.last_price = None  # the latest ticker price
+        self.periods_per_year = round(365 * DAY_MS / self.period)  # trading around the clock
 
-    def download(self):
-        # Initialize the exchange
+    def candle_start(self, now=None):
+        """Timestamp of the candle in progress, candles are aligned on multiples of their period since the epoch"""
+        return int((now or time.time()) * 1000) // self.period * self.period
+
+    def settled(self, now=None):
+        """The last candle is not closed until its period is over"""
+        n = len(self.worth)
+        return n - 1 if n and self.dates[-1] + self.period > (now or time.time()) * 1000 else n
+
+    def create_exchange(self):
         exchange_class = getattr(ccxt, self.exchange_name)
-        exchange = exchange_class({
+        return exchange_class({
             # 'apiKey': '',  # Add your API key if needed
             # 'secret': '',  # Add your secret if needed
             'timeout': 30000,
-            'enableRateLimit': True,  # Enable built-in rate limiting
+            'enableRateLimit': False,  # rate_limiter is shared by all the instances of an exchange
         })
 
+    def limit(self, exchange):
+        """Context manager around a request to the exchange, see rate_limiter.py"""
+        options = {'rate': 1000 / exchange.rateLimit, 'burst': 10} if getattr(exchange, 'rateLimit', 0) else {}
+        return rate_limiter.limit(self.exchange_name, **options)
+
+    def fetch_ohlcv(self, exchange, since=None, limit=None):
+        with self.limit(exchange):
+            return exchange.fetch_ohlcv(self.symbol, self.timeframe, since=since, limit=limit)
+
+    def download(self):
+        exchange = self.create_exchange()
+        if self.history is not None and len(self.history[0]) > 0:
+            if self._update_history(exchange):
+                return
+        self.backfill(exchange)
+
+    def _update_history(self, exchange):
+        '''Extend the history of a previous run instead of downloading it again
+
+        If the last known candle is the one in progress, only its close has changed, and if it
+        is the one before (the archive only keeps closed candles, see settled), the candle in
+        progress is new: the ticker price is used without any request in both cases. Otherwise
+        the candles since the last known one are fetched in one request. Return False if the gap
+        is too large for one request.
+        '''
+        dates, worth = self.history
+        start = self.candle_start()
+        if self.last_price is not None and dates[-1] in (start, start - self.period):
+            keep = len(dates) - 1 if dates[-1] == start else len(dates)
+            self.dates = list(dates[:keep]) + [start]
+            self.worth = list(worth[:keep]) + [self.last_price]
+            logging.info(f"Updated {self.code} from the ticker price {self.last_price}")
+            return True
+
+        since = dates[-1]  # the last known candle may not have been closed
+        ohlcv_batch = self.fetch_ohlcv(exchange, since=since, limit=self.LIMIT)
+        if not ohlcv_batch or len(ohlcv_batch) >= self.LIMIT or ohlcv_batch[0][0] > since:
+            logging.warning(f"Cannot extend the history of {self.code}, downloading all of it")
+            return False
+        keep = bisect.bisect_left(dates, since)
+        self.dates = list(dates[:keep]) + [candle[0] for candle in ohlcv_batch]
+        self.worth = list(worth[:keep]) + [candle[4] for candle in ohlcv_batch]
+        logging.info(f"Fetched {len(ohlcv_batch)} new candles for {self.code}")
+        return True
+
+    def backfill(self, exchange):
+        '''Download the full history with concurrent requests
+
+        The first candle gives the listing date. It is checked against the latest page of
+        candles, which also serves the last window: a listing date after the start of that page
+        is wrong. The range up to the candle in progress is split into windows of LIMIT candles
+        fetched in parallel within the rate limit of the exchange, and a window missing candles
+        is fetched once more. Every window must then be complete: candles on the period grid,
+        inside the window, without duplicates. The history is only set if every window succeeded.
+        A wrong listing date, a short window, gaps or overlaps fall back to paging the history
+        backwards sequentially, like the exchanges that cannot return their first candle.
+        '''
+        first = self.fetch_ohlcv(exchange, since=0, limit=1)
+        end = self.candle_start()
+        latest = [c for c in self.fetch_ohlcv(exchange, limit=self.LIMIT) if c[0] <= end] if first else []
+        if not latest:
+            logging.warning(f"Cannot find the listing date of {self.code}, paging backwards")
+            return self._download_all(exchange)
+        start = first[0][0]
+        if start > latest[0][0]:
+            logging.warning(f"The listing date {start} of {self.code} is after {latest[0][0]}, paging backwards")
+            return self._download_all(exchange)
+        windows = list(range(start, end + 1, self.LIMIT * self.period))
+
+        def fetch(since):
+            until = min(since + self.LIMIT * self.period, end + self.period)
+            expected = (until - since) // self.period
+            for attempt in range(2):
+                if since >= latest[0][0]:
+                    batch = latest
+                else:
+                    try:
+                        batch = self.fetch_ohlcv(exchange, since=since, limit=self.LIMIT)
+                    except Exception:
+                        if attempt:
+                            raise
+                        logging.warning(f"Retrying the window from {since} of {self.code}", exc_info=True)
+                        continue
+                candles = [c for c in batch if since <= c[0] < until]
+                if len(candles) == expected:
+                    return candles
+                if batch is latest:
+                    break
+            raise ValueError(f"the window from {since} of {self.code} has {len(candles)} of {expected} candles")
+
         try:
-            # Fetch all available OHLCV data (1 day timeframe)
+            with ThreadPoolExecutor(max_workers=self.BACKFILL_WORKERS) as executor:
+                results = list(executor.map(fetch, windows))
+            candles = [c for window in results for c in window]
+            gaps = verify_candles(candles, start, self.period, end)
+            if gaps:
+                raise ValueError(f"{self.code} has {len(gaps)} gaps: {gaps[:5]}")
+        except ValueError:
+            # e.g. the exchange has no data for a maintenance
+            logging.warning(f"Cannot backfill {self.code}, paging backwards", exc_info=True)
+            return self._download_all(exchange)
+        self.dates = [c[0] for c in candles]
+        self.worth = [c[4] for c in candles]
+        logging.info(f"Backfilled {len(candles)} {self.timeframe} candles of {self.code} in {len(windows)} windows")
+
+    def _download_all(self, exchange):
+        try:
+            # Fetch all available OHLCV data
             # We need to paginate to get all historical data since exchanges have limits
             all_ohlcv = []
             limit = 1000  # Maximum candles per request for most exchanges
@@ -41,10 +194,10 @@ class Crypto(BaseAsset):
                     # Fetch a batch of data - a list of [timestamp, open, high, low, close, volume]
                     if since is None:
                         # First request - get the most recent data
-                        ohlcv_batch = exchange.fetch_ohlcv(self.symbol, '1d', limit=limit)
+                        ohlcv_batch = self.fetch_ohlcv(exchange, limit=limit)
                     else:
                         # Subsequent requests - get data from a specific timestamp
-                        ohlcv_batch = exchange.fetch_ohlcv(self.symbol, '1d', since=since, limit=limit)
+                        ohlcv_batch = self.fetch_ohlcv(exchange, since=since, limit=limit)
 
                     if not ohlcv_batch:
                         logging.warning(f"No data returned for {self.symbol} on batch {i}. Stopping pagination.")
@@ -62,7 +215,7 @@ class Crypto(BaseAsset):
                     # Set since to get older data
                     # Use the actual number of candles returned instead of the requested limit
                     actual_candles = len(ohlcv_batch)
-                    since = ohlcv_batch[0][0] - (24 * 60 * 60 * 1000 * actual_candles)
+                    since = ohlcv_batch[0][0] - (self.period * actual_candles)
 
                     # Convert since timestamp to human readable format for logging
                     since_date = datetime.fromtimestamp(since / 1000).strftime('%Y-%m-%d %H:%M:%S') if since else 'N/A'
@@ -91,8 +244,95 @@ class Crypto(BaseAsset):
             logging.info(f"Fetched {len(df)} days of historical data for {self.symbol} (from {df['datetime'].iloc[0].strftime('%Y-%m-%d')} to {df['datetime'].iloc[-1].strftime('%Y-%m-%d')})")
 
             # Set worth (closing prices)
+            self.dates = df['timestamp'].tolist()
             self.worth = df['close'].tolist()
 
         except Exception as e:
             logging.error(f"Error fetching data for {self.symbol}: {e}")
-            raise
\ No newline at end of file
+            raise
+
+class FakeExchange:
+    """Serve the candles of [start, end] like fetch_ohlcv, skipping the missing timestamps"""
+    rateLimit = 1
+
+    def __init__(self, start, end, period, missing=()):
+        self.candles = [[t, 0, 0, 0, float(t), 0] for t in range(start, end + 1, period) if t not in missing]
+        self.failures = {}  # since -> number of requests to fail
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        with self._lock:
+            self.requests.append(since)
+            if self.failures.get(since):
+                self.failures[since] -= 1
+                raise Exception('timeout')
+        if since is None:
+            return self.candles[-limit:]
+        return [c for c in self.candles if c[0] >= since][:limit]
+
+
+class TestCrypto(unittest.TestCase):
+    def setUp(self):
+        self.crypto = Crypto('BTC/USDT', timeframe='1h')
+        self.period = self.crypto.period
+        self.end = self.crypto.candle_start()
+        self.start = self.end - 2500 * self.period
+
+    def test_timeframe(self):
+        self.assertEqual('BTC/USDT 1h', self.crypto.code)
+        self.assertEqual(3600 * 1000, self.period)
+        self.assertEqual('BTC/USDT', Crypto('BTC/USDT').code)
+        self.assertEqual(DAY_MS, Crypto('BTC/USDT').period)
+
+    def test_settled(self):
+        self.crypto.dates = [self.end - self.period, self.end]
+        self.crypto.worth = [1.0, 2.0]
+        self.assertEqual(1, self.crypto.settled())  # the candle in progress
+        self.assertEqual(2, self.crypto.settled((self.end + self.period) / 1000))
+
+    def test_verify_candles(self):
+        candles = [[t] for t in [0, 10, 20, 50, 60]]
+        self.assertEqual([(30, 50), (70, 80)], verify_candles(candles, 0, 10, end=70))
+        self.assertRaises(ValueError, verify_candles, [[0], [10], [10]], 0, 10)
+        self.assertRaises(ValueError, verify_candles, [[0], [15]], 0, 10)
+
+    def test_backfill(self):
+        exchange = FakeExchange(self.start, self.end, self.period)
+        self.crypto.backfill(exchange)
+        self.assertEqual([c[0] for c in exchange.candles], self.crypto.dates)
+        self.assertEqual(2501, len(self.crypto.worth))
+        # the listing date, the latest page serving the last window, then 2 windows of 1000 candles
+        self.assertEqual([0, None], exchange.requests[:2])
+        self.assertEqual(4, len(exchange.requests))
+
+    def test_backfill_gap(self):
+        exchange = FakeExchange(self.start, self.end, self.period, missing={self.start + 10 * self.period})
+        self.crypto.backfill(exchange)
+        self.assertEqual(2500, len(self.crypto.worth))
+        # the window with the gap is fetched again, then the history is paged backwards
+        self.assertEqual(2, exchange.requests.count(self.start))
+        self.assertEqual(2, exchange.requests.count(None))
+
+    def test_backfill_listing(self):
+        class Wrong(FakeExchange):
+            def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+                if since == 0:
+                    return self.candles[-1:]  # not the first candle
+                return super().fetch_ohlcv(symbol, timeframe, since, limit)
+        exchange = Wrong(self.start, self.end, self.period)
+        self.crypto.backfill(exchange)
+        self.assertEqual([c[0] for c in exchange.candles], self.crypto.dates)
+
+    def test_backfill_failures(self):
+        second = self.start + 1000 * self.period
+        exchange = FakeExchange(self.start, self.end, self.period)
+        exchange.failures[second] = 1
+        self.crypto.backfill(exchange)
+        self.assertEqual(2501, len(self.crypto.worth))
+
+        # nothing is kept if a window cannot be fetched
+        crypto = Crypto('BTC/USDT', timeframe='1h')
+        exchange.failures[second] = 2
+        self.assertRaises(Exception, crypto.backfill, exchange)
+        self.assertEqual([], crypto.worth)
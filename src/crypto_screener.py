@@ -0,0 +1,258 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import math
+import time
+import logging
+import tempfile
+import unittest
+from collections import defaultdict
+
+from crypto import Crypto, DAY_MS
+from history_archive import HistoryArchive
+
+
+def trigger_levels(history, config):
+    '''Prices at which today's price would meet a criterion of MonitorWithCriteria
+
+    history is the closes before today's candle. A price between low and high cannot
+    trigger anything, so the full analysis can be skipped:
+        prev_close  the daily change is measured against it
+        low         below it N < low_threshold, or the rank or the drawdown may trigger
+        high        above it N > high_threshold or the price is at its historical high,
+                    or the rank may trigger
+    '''
+    if not history:
+        return None
+    history = list(history)
+    prev_close = history[-1]
+
+    # N < low_threshold needs a price lower than the past 1-low_threshold days
+    window = 1 - config.low_threshold
+    low = min(history[-window:]) if len(history) >= window else -math.inf
+    # the current drawdown is at most 1 - price / the highest price
+    low = max(low, (1 - config.drawdown_threshold) * max(history))
+    # N > high_threshold needs a price higher than the past high_threshold+1 days,
+    # and a historical high a price higher than all of them
+    high = max(history[-(config.high_threshold + 1):])
+
+    if config.low_rank_threshold is not None or config.high_rank_threshold is not None:
+        ranked = sorted(history if config.rank_window is None else history[-config.rank_window:])
+        n = len(ranked)
+        # the rank of a price is the fraction of the ranked prices strictly lower than it
+        if config.low_rank_threshold is not None:
+            # rank <= t while at most k prices are lower, i.e. price <= ranked[k]
+            k = sum(1 for i in range(1, n + 1) if i / n <= config.low_rank_threshold)
+            low = max(low, ranked[k] if k < n else math.inf)
+        if config.high_rank_threshold is not None:
+            # rank >= t once c prices are lower, i.e. price > ranked[c-1]
+            c = n + 1 - sum(1 for i in range(n + 1) if i / n >= config.high_rank_threshold)
+            high = min(high, ranked[c - 1] if 0 < c <= n else (-math.inf if c == 0 else math.inf))
+
+    return {'prev_close': prev_close, 'low': low, 'high': high}
+
+
+def could_trigger(price, levels, config):
+    """Whether the price could make the asset interesting, False only if it surely cannot"""
+    if levels is None:
+        return True
+    prev_close = levels['prev_close']
+    if prev_close and abs(price - prev_close) / prev_close >= config.daily_change_threshold:
+        return True
+    # inclusive bounds: rank <= t and the rounded drawdown are not strict comparisons
+    return price <= levels['low'] or price >= levels['high']
+
+
+class CryptoScreener:
+    '''First tier of the crypto monitor: one ticker request per exchange for all the symbols
+
+    The trigger levels of each symbol are computed once a day from its archived history
+    and cached in state_file. A symbol is passed on to the monitor only if its ticker price
+    could change its signal or if its history has not been updated today. The monitor then
+    extends the archived history with the ticker price, or with the candles since the last
+    run, instead of downloading all of it again.
+    '''
+    def __init__(self, config, archive, state_file='crypto_screener.json'):
+        self.config = config
+        self.archive = archive
+        self.state_file = state_file
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def fetch_prices(self, cryptos):
+        """Last prices of all the cryptos, with one bulk ticker request per exchange"""
+        groups = defaultdict(list)
+        for c in cryptos:
+            groups[c.exchange_name].append(c)
+
+        prices = {}
+        for exchange_name, group in groups.items():
+            symbols = [c.symbol for c in group]
+            try:
+                exchange = group[0].create_exchange()
+                with group[0].limit(exchange):
+                    tickers = exchange.fetch_tickers(symbols)
+            except Exception:
+                logging.exception('failed to fetch tickers from {0}'.format(exchange_name))
+                continue
+            for c in group:
+                ticker = tickers.get(c.symbol) or {}
+                price = ticker.get('last') or ticker.get('close')
+                if price is not None:
+                    prices[c.code] = price
+            logging.info('fetched {0} tickers from {1}'.format(len(tickers), exchange_name))
+        return prices
+
+    def screen(self, cryptos, now=None):
+        """Return the cryptos the monitor needs to process"""
+        prices = self.fetch_prices(cryptos)
+        candidates = []
+        for c in cryptos:
+            c.archive = self.archive
+            c.last_price = prices.get(c.code)
+            if c.code in self.archive:
+                dates, worth = self.archive.read(c.code)
+                c.history = (dates.tolist(), worth.tolist())
+            state = self.state.get(c.code)
+            if c.last_price is None or state is None or state['date'] != c.candle_start(now):
+                candidates.append(c)  # the history must be updated
+            elif could_trigger(c.last_price, state['levels'], self.config):
+                candidates.append(c)
+            else:
+                logging.debug('{0} screened out at {1}'.format(c.code, c.last_price))
+        logging.info('screened {0} cryptos, {1} to process'.format(len(cryptos), len(candidates)))
+        return candidates
+
+    def update(self, cryptos):
+        """Cache the trigger levels of the cryptos downloaded by the monitor and save them"""
+        for c in cryptos:
+            if not c.worth or len(c.dates) != len(c.worth):
+                continue
+            self.state[c.code] = {
+                'date': c.dates[-1],  # the levels hold as long as this candle is in progress
+                'levels': trigger_levels(c.worth[:-1], self.config),
+            }
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.state_file)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_file)
+        self.archive.save()
+
+
+class FakeExchange:
+    rateLimit = 1
+
+    def __init__(self, tickers, candles=()):
+        self.tickers = tickers
+        self.candles = list(candles)
+        self.requests = []
+
+    def fetch_tickers(self, symbols):
+        self.requests.append(('tickers', symbols))
+        return {s: {'last': self.tickers[s]} for s in symbols if s in self.tickers}
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        self.requests.append(('ohlcv', symbol, since))
+        return [c for c in self.candles if since is None or c[0] >= since][:limit]
+
+
+class TestCryptoScreener(unittest.TestCase):
+    def setUp(self):
+        from monitor_config import MonitorConfig
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = MonitorConfig(asset_type='crypto', subject_prefix='test',
+                                    low_threshold=-3, high_threshold=3, drawdown_threshold=0.3)
+        self.archive = HistoryArchive(os.path.join(self.tmp.name, 'archive'))
+        self.state_file = os.path.join(self.tmp.name, 'state.json')
+        self.now = time.time()
+        self.today = int(self.now * 1000) // DAY_MS * DAY_MS
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def create_crypto(self, symbol, exchange):
+        c = Crypto(symbol)
+        c.create_exchange = lambda: exchange
+        c.result_cache = None
+        return c
+
+    def test_trigger_levels(self):
+        history = [10, 12, 11, 13, 12, 12.5]
+        levels = trigger_levels(history, self.config)
+        self.assertEqual(12.5, levels['prev_close'])
+        self.assertEqual(11, levels['low'])  # lower than the past 4 days
+        self.assertEqual(13, levels['high'])
+        self.assertTrue(could_trigger(10.9, levels, self.config))
+        self.assertTrue(could_trigger(13.1, levels, self.config))
+        self.assertFalse(could_trigger(12, levels, self.config))
+        self.assertTrue(could_trigger(12.5 * 1.1, dict(levels, high=100), self.config))
+        self.assertTrue(could_trigger(1, None, self.config))
+
+    def test_levels_agree_with_analysis(self):
+        """A price screened out never makes the asset interesting"""
+        import random
+        from base_asset import TestAsset
+        from monitor_config import MonitorConfig
+        random.seed(5)
+        config = MonitorConfig(asset_type='crypto', subject_prefix='test', low_threshold=-10, high_threshold=10,
+                               drawdown_threshold=0.2, daily_change_threshold=0.05,
+                               low_rank_threshold=0.1, high_rank_threshold=0.9, rank_window=30)
+        history = [1.0]
+        for _ in range(60):
+            history.append(history[-1] * random.uniform(0.96, 1.04))
+        levels = trigger_levels(history, config)
+        for i in range(400):
+            price = history[-1] * (0.9 + i / 2000)
+            asset = TestAsset('A')
+            asset.result_cache = None
+            asset.worth = history + [price]
+            asset.analyze()
+            interesting = (abs(asset.daily_change_pct) >= config.daily_change_threshold
+                           or asset.N < config.low_threshold or asset.N > config.high_threshold
+                           or asset.cur > config.drawdown_threshold or asset.is_at_historical_high
+                           or asset.percentile_rank(30) <= 0.1 or asset.percentile_rank(30) >= 0.9)
+            if interesting:
+                self.assertTrue(could_trigger(price, levels, config), price)
+
+    def test_screen(self):
+        candles = [[self.today - i * DAY_MS, 0, 0, 0, close, 0] for i, close in [(2, 12), (1, 12.5), (0, 12.2)]]
+        exchange = FakeExchange({'BTC/USDT': 12.0, 'ETH/USDT': 20.0}, candles)
+        btc = self.create_crypto('BTC/USDT', exchange)
+        eth = self.create_crypto('ETH/USDT', exchange)
+        history = [10, 12, 11, 13, 12]
+        dates = [self.today - (6 - i) * DAY_MS for i in range(5)]  # the last candle was not closed
+        self.archive.write('BTC/USDT', dates, history)
+
+        screener = CryptoScreener(self.config, self.archive, self.state_file)
+        # nothing cached yet: both must be processed, BTC only needs the new candles
+        self.assertEqual([btc, eth], screener.screen([btc, eth], now=self.now))
+        self.assertEqual([('tickers', ['BTC/USDT', 'ETH/USDT'])], exchange.requests)
+        btc.trade()
+        self.assertEqual(history + [12.5, 12.2], btc.worth)
+        self.assertEqual(('ohlcv', 'BTC/USDT', dates[-1]), exchange.requests[-1])
+        screener.update([btc])
+
+        # later the same day: BTC is quiet, ETH has no cached levels yet
+        btc = self.create_crypto('BTC/USDT', exchange)
+        eth = self.create_crypto('ETH/USDT', exchange)
+        screener = CryptoScreener(self.config, self.archive, self.state_file)
+        self.assertEqual([eth], screener.screen([btc, eth], now=self.now))
+
+        # BTC moves above its levels and is updated from the ticker without any candle request
+        exchange.tickers['BTC/USDT'] = 14.0
+        exchange.requests = []
+        self.assertEqual([btc, eth], screener.screen([btc, eth], now=self.now))
+        btc.download()
+        self.assertEqual(history + [12.5, 14.0], btc.worth)
+        self.assertEqual([('tickers', ['BTC/USDT', 'ETH/USDT'])], exchange.requests)
+
+    def test_ticker_failure(self):
+        class Down(FakeExchange):
+            def fetch_tickers(self, symbols):
+                raise Exception('down')
+        btc = self.create_crypto('BTC/USDT', Down({}))
+        screener = CryptoScreener(self.config, self.archive, self.state_file)
+        self.assertEqual([btc], screener.screen([btc], now=self.now))
+        self.assertIsNone(btc.last_price)
@@ -1,12 +1,17 @@
 # -*- coding: UTF-8 -*-
 import re
+import time
 import logging
 import unittest
 from datetime import datetime
+from urllib.parse import urlparse
 import execjs
 import requests
 
-from base_asset import BaseAsset
+import rate_limiter
+import fund_metadata
+import fund_holdings
+from base_asset import BaseAsset, to_date
 
 
 class Fund(BaseAsset):
@@ -14,35 +19,112 @@ class Fund(BaseAsset):
     This strategy does not directly output the amount to buy or sell, but outputs a strength signal for me to decide
     self.N: positive number represents price higher than past N trading days, negative number represents price lower than past N trading days
     '''
+    metadata = fund_metadata.default_metadata
+    holdings = fund_holdings.default_holdings
+
     def __init__(self, code):
         super().__init__(code)
+        self.holdings_estimate = None  # (change in %, trading day) set by prefetch
+
+    @property
+    def market(self):
+        """A QDII fund moves with the overseas market of its holdings, see FundMetadata.market"""
+        return self.metadata.market(self.code)
+
+    @classmethod
+    def prefetch(cls, assets):
+        '''Refresh the stale metadata of the funds in one request
+
+        The funds without a fundgz estimate get one from the quotes of their holdings,
+        fetched together for all of them, see fund_holdings.
+        '''
+        stale = [a.code for a in assets if cls.metadata.is_stale(a.code)]
+        if stale:
+            cls.metadata.refresh(stale, Fund.get(fund_metadata.SEARCH_URL).text)
+        lacking = [a for a in assets if cls.metadata.lacks_estimate(a.code)]
+        if lacking:
+            estimates = cls.holdings.estimate([a.code for a in lacking])
+            for a in lacking:
+                a.holdings_estimate = estimates.get(a.code)
+
+    @classmethod
+    def release(cls):
+        super().release()
+        cls.metadata.save()
+        cls.holdings.save()
 
     def download(self):
         """get historical daily prices including today's if available"""
         code = self.code
         # 1. get the history daily price
         url = 'http://fund.eastmoney.com/pingzhongdata/{0}.js'.format(code)
-        r = requests.get(url, timeout=10)
-        assert r.status_code == 200
+        r = Fund.get(url)
         jsContent = execjs.compile(r.text)
-        name = jsContent.eval('fS_name')
+        name = self.metadata.name(code) or jsContent.eval('fS_name')
         logging.info('{0}:{1}'.format(code, name))
         logging.info('url1: {0}'.format(url))
         # 基金的累计净值，代表基金从成立以来的整体收益情况，比较直观和全面地反映基金在运作期间的历史表现
         ACWorthTrend = jsContent.eval('Data_ACWorthTrend')
+        dates = [t for t,w in ACWorthTrend]
         worth = [w for t,w in ACWorthTrend]
 
-        # 2. get today's real-time price
-        url = 'http://fundgz.1234567.com.cn/js/{0}.js'.format(code)
-        logging.info('url2: {0}'.format(url))
-        r = requests.get(url, timeout=10)
-        assert r.status_code == 200
-        rate = Fund.parse_current_rate(r.text)
-        if rate is not None:
-            self.trading = True
-            worth.append(worth[-1] * (1 + rate/100))
+        # 2. get today's real-time price, unless there cannot be one
+        rate = None
+        if self.metadata.wants_estimate(code):
+            url = 'http://fundgz.1234567.com.cn/js/{0}.js'.format(code)
+            logging.info('url2: {0}'.format(url))
+            r = Fund.get(url)
+            rate = Fund.parse_current_rate(r.text)
+            self.metadata.record_estimate(code, rate is not None)
+        if rate is None:
+            rate = self._holdings_rate(dates)
         self.name = name
+        self.dates = dates
         self.worth = worth
+        self._append_estimate(rate)
+
+    def _holdings_rate(self, dates):
+        """Change in % estimated from the holdings, None unless its quotes are newer than the last NAV"""
+        if self.holdings_estimate is None:
+            return None
+        change, day = self.holdings_estimate
+        # the quotes must be newer than the last NAV, e.g. a QDII fund before the next US session
+        if day > to_date(dates[-1]).isoformat():
+            logging.info('{0}: {1}% estimated from the holdings on {2}'.format(self.code, change, day))
+            return change
+        return None
+
+    def _append_estimate(self, rate):
+        """Append today's price estimated from the last NAV and a change in %, if there is one"""
+        if rate is not None:
+            self.trading = True
+            self.dates.append(int(time.time() * 1000))
+            self.worth.append(self.worth[-1] * (1 + rate/100))
+
+    def fallback(self):
+        """The archived NAVs, followed by the estimate from the holdings that did arrive"""
+        if self.archive is None or self.code not in self.archive:
+            return False
+        self.restore(self.archive)
+        self.trading = False
+        self.stale = True
+        self._append_estimate(self._holdings_rate(self.dates))
+        self.analyze()
+        return True
+
+    def settled(self, now=None):
+        """Every net asset value is final, only the estimate appended by download is not"""
+        return len(self.worth) - 1 if self.trading else len(self.worth)
+
+    @staticmethod
+    def get(url):
+        """GET through the rate limiter of the host"""
+        with rate_limiter.limit(urlparse(url).hostname):
+            r = requests.get(url, timeout=10)
+            if r.status_code == 429:
+                raise rate_limiter.Throttled(url)
+            assert r.status_code == 200
+        return r
 
     @staticmethod
     def parse_current_rate(text):
@@ -90,4 +172,22 @@ class TestFund(unittest.TestCase):
         self.assertEqual(1.23, parse_current_rate(sample))
         # test regex
         sample = 'jsonpgz({"gszzl":"-0.1","gztime":"%s 14:40"});' % date
-        self.assertEqual(-0.1, parse_current_rate(sample))
\ No newline at end of file
+        self.assertEqual(-0.1, parse_current_rate(sample))
+
+    def test_fallback(self):
+        import tempfile
+        from history_archive import HistoryArchive
+        with tempfile.TemporaryDirectory() as directory:
+            archive = HistoryArchive(directory)
+            # NAVs of 2025-03-31 and 2025-04-01 in Beijing
+            archive.write('270042', [1743350400000, 1743436800000], [2.0, 2.5], 'QDII')
+            fund = Fund('270042')
+            fund.archive, fund.result_cache = archive, None
+            fund.holdings_estimate = (-2.0, '2025-04-02')  # from the quotes that did arrive
+            self.assertTrue(fund.fallback())
+            self.assertEqual([2.0, 2.5, 2.45], fund.worth)
+            self.assertEqual((True, True), (fund.trading, fund.stale))
+            # not newer than the last NAV
+            fund.holdings_estimate = (-2.0, '2025-04-01')
+            self.assertTrue(fund.fallback())
+            self.assertEqual(([2.0, 2.5], False), (fund.worth, fund.trading))
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import logging
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import efinance as ef
+
+import rate_limiter
+
+
+def weighted_changes(holdings, quotes, min_coverage=20):
+    '''Estimate the daily change of many funds at once from the changes of their holdings
+
+    holdings: {fund: [(stock, weight in % of the NAV), ...]}
+    quotes: {stock: (change in %, trading day 'YYYY-MM-DD')}
+    Return {fund: (change in %, latest trading day of its quotes)}. The disclosed holdings are
+    only the top ones, the rest of the fund is assumed to move like them, so the change is
+    averaged over the quoted weight. A fund whose quoted weight is under min_coverage % has no estimate.
+    '''
+    funds = list(holdings)
+    stocks = list(dict.fromkeys(s for f in funds for s, _ in holdings[f] if s in quotes))
+    if not funds or not stocks:
+        return {}
+    column = {s: j for j, s in enumerate(stocks)}
+    weights = np.zeros((len(funds), len(stocks)))
+    for i, f in enumerate(funds):
+        for s, w in holdings[f]:
+            if s in column:
+                weights[i, column[s]] += w
+    changes = np.array([quotes[s][0] for s in stocks], dtype=np.float64)
+    # trading days compare as 'YYYY-MM-DD' strings, ranked to take the latest per fund
+    days, day_index = np.unique([quotes[s][1] for s in stocks], return_inverse=True)
+    coverage = weights.sum(axis=1)
+    estimated = weights @ changes / np.where(coverage > 0, coverage, 1)
+    latest = np.where(weights > 0, day_index[None, :], -1).max(axis=1)
+    return {f: (round(float(estimated[i]), 4), str(days[latest[i]]))
+            for i, f in enumerate(funds) if coverage[i] >= min_coverage}
+
+
+def fetch_quotes(stocks):
+    """{stock: (change in %, trading day)} of all the stocks with one request"""
+    if not stocks:
+        return {}
+    with rate_limiter.limit('eastmoney-bulk'):
+        latest = ef.stock.get_latest_quote(list(stocks))
+    quotes = {}
+    for _, row in latest.iterrows():
+        if row['涨跌幅'] is not None and not np.isnan(row['涨跌幅']):
+            quotes[str(row['代码'])] = (float(row['涨跌幅']), str(row['最新交易日']))
+    return quotes
+
+
+class FundHoldings:
+    '''Cache of the disclosed top holdings of funds, persisted to a json file
+
+    The holdings are disclosed quarterly, so they are requested again once older than
+    max_age days. They give an intraday estimate for the funds without a fundgz one,
+    e.g. QDII funds: the quotes of all their stocks are fetched with one request, each
+    stock once however many funds hold it.
+    '''
+    def __init__(self, path=None, max_age=30):
+        self.path = path
+        self.max_age = max_age
+        self.data = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def get(self, code):
+        """[(stock, weight in %), ...] of the last disclosure"""
+        entry = self.data.get(code)
+        return [tuple(h) for h in entry['holdings']] if entry else []
+
+    def is_stale(self, code, now=None):
+        entry = self.data.get(code)
+        if not entry:
+            return True
+        now = now or datetime.now(timezone.utc)
+        return now - datetime.fromisoformat(entry['updated']) > timedelta(days=self.max_age)
+
+    def refresh(self, code, now=None):
+        now = now or datetime.now(timezone.utc)
+        with rate_limiter.limit('eastmoney'):
+            position = ef.fund.get_invest_position(code)
+        holdings = [[str(row['股票代码']), float(row['持仓占比'])] for _, row in position.iterrows()]
+        with self._lock:
+            self.data[code] = {
+                'date': str(position['公开日期'].iloc[0]) if len(position) else None,
+                'holdings': holdings,
+                'updated': now.isoformat(),
+            }
+            self._dirty = True
+
+    def estimate(self, codes):
+        """{fund: (change in %, trading day)} estimated from the holdings, see weighted_changes"""
+        for code in codes:
+            if self.is_stale(code):
+                try:
+                    self.refresh(code)
+                except Exception:
+                    logging.exception('failed to get the holdings of {0}'.format(code))
+        holdings = {code: self.get(code) for code in codes}
+        stocks = list(dict.fromkeys(s for h in holdings.values() for s, _ in h))
+        estimates = weighted_changes(holdings, fetch_quotes(stocks))
+        logging.info('estimated {0} of {1} funds from the quotes of {2} stocks'.format(
+            len(estimates), len(codes), len(stocks)))
+        return estimates
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self.data, ensure_ascii=False)
+            self._dirty = False
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
+# Shared by all the funds, in memory unless FUND_HOLDINGS is set to a file path to persist it across runs
+default_holdings = FundHoldings(os.getenv('FUND_HOLDINGS'))
+
+
+class TestFundHoldings(unittest.TestCase):
+    def test_weighted_changes(self):
+        holdings = {
+            'QDII': [('AAPL', 10.0), ('MSFT', 30.0)],
+            'BOTH': [('MSFT', 20.0), ('00700', 20.0)],
+            'FEW': [('AAPL', 5.0), ('UNKNOWN', 50.0)],
+        }
+        quotes = {'AAPL': (2.0, '2025-01-02'), 'MSFT': (-1.0, '2025-01-02'), '00700': (3.0, '2025-01-03')}
+        estimates = weighted_changes(holdings, quotes)
+        self.assertEqual({'QDII', 'BOTH'}, set(estimates))  # FEW has only 5% of its NAV quoted
+        self.assertEqual((-0.25, '2025-01-02'), estimates['QDII'])  # (10 * 2 - 30) / 40
+        self.assertEqual((1.0, '2025-01-03'), estimates['BOTH'])
+        self.assertEqual({}, weighted_changes({'A': []}, quotes))
+
+    def test_estimate(self):
+        import pandas as pd
+        from unittest import mock
+        positions = {
+            '270042': pd.DataFrame({'股票代码': ['AAPL', 'MSFT'], '持仓占比': [10.0, 30.0],
+                                    '公开日期': ['2025-03-31', '2025-03-31']}),
+            '164906': pd.DataFrame({'股票代码': ['MSFT', '00700'], '持仓占比': [20.0, 20.0],
+                                    '公开日期': ['2025-03-31', '2025-03-31']}),
+        }
+        quotes = pd.DataFrame([
+            {'代码': 'AAPL', '涨跌幅': 2.0, '最新交易日': '2025-04-01'},
+            {'代码': 'MSFT', '涨跌幅': -1.0, '最新交易日': '2025-04-01'},
+            {'代码': '00700', '涨跌幅': float('nan'), '最新交易日': '2025-04-01'},
+        ])
+        with mock.patch.object(ef.fund, 'get_invest_position', side_effect=positions.get) as position, \
+                mock.patch.object(ef.stock, 'get_latest_quote', return_value=quotes) as latest, \
+                tempfile.TemporaryDirectory() as directory:
+            cache = FundHoldings(os.path.join(directory, 'holdings.json'))
+            estimates = cache.estimate(['270042', '164906'])
+            # one quote request, MSFT only once
+            latest.assert_called_once_with(['AAPL', 'MSFT', '00700'])
+            self.assertEqual({'270042': (-0.25, '2025-04-01'), '164906': (-1.0, '2025-04-01')}, estimates)
+
+            cache.save()
+            cache = FundHoldings(cache.path)
+            self.assertEqual([('AAPL', 10.0), ('MSFT', 30.0)], cache.get('270042'))
+            cache.estimate(['270042'])
+            self.assertEqual(2, position.call_count)  # the holdings are cached
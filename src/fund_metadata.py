@@ -0,0 +1,196 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import logging
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from trading_calendar import MARKETS
+
+
+SEARCH_URL = 'http://fund.eastmoney.com/js/fundcode_search.js'
+# QDII funds named after Hong Kong indexes, the others mostly hold US stocks
+HK_WORDS = ('恒生', '港股', '香港', 'H股', '中概')
+
+
+def parse_search(text):
+    """fundcode_search.js -> {code: (name, type)}, its rows are [code, abbr, name, type, pinyin]"""
+    rows = json.loads(text[text.index('['):text.rindex(']') + 1])
+    return {row[0]: (row[2], row[3]) for row in rows}
+
+
+class FundMetadata:
+    '''Cache of what rarely changes about a fund, persisted to a json file
+
+    For every code: name, type and QDII flag, refreshed from fundcode_search.js once they are
+    older than max_age days, and statistics of its fundgz estimates: how often a request
+    returned today's estimate. They tell which estimate requests are useless:
+    outside of the trading hours, or for funds that almost never have one (most QDII funds),
+    which are only probed again once a week in case that changed.
+    '''
+    MIN_ATTEMPTS = 5  # estimate requests before judging a fund
+    MIN_HIT_RATE = 0.2
+    PROBE_DAYS = 7
+
+    def __init__(self, path=None, max_age=30):
+        self.path = path
+        self.max_age = max_age
+        self.data = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def get(self, code):
+        return self.data.get(code)
+
+    def name(self, code):
+        entry = self.data.get(code)
+        return entry.get('name') if entry else None
+
+    def market(self, code):
+        """Key of trading_calendar.MARKETS whose close moves the fund: the overseas market of a QDII fund"""
+        entry = self.data.get(code)
+        if not entry or not entry.get('qdii'):
+            return 'CN_FUND'
+        return 'HK' if any(word in entry.get('name', '') for word in HK_WORDS) else 'US'
+
+    def is_stale(self, code, now=None):
+        entry = self.data.get(code)
+        if not entry or 'updated' not in entry:
+            return True
+        now = now or datetime.now(timezone.utc)
+        return now - datetime.fromisoformat(entry['updated']) > timedelta(days=self.max_age)
+
+    def refresh(self, codes, text, now=None):
+        """Update name, type and QDII flag of codes from the content of fundcode_search.js"""
+        now = now or datetime.now(timezone.utc)
+        search = parse_search(text)
+        with self._lock:
+            for code in codes:
+                entry = self.data.setdefault(code, {})
+                if code not in search:
+                    # e.g. a new or a closed fund, looked up again after max_age days like the others
+                    entry.update(missing=True, updated=now.isoformat())
+                    continue
+                name, fund_type = search[code]
+                entry.pop('missing', None)
+                # QDII funds are either typed 'QDII' or named '...(QDII)'
+                entry.update(name=name, type=fund_type, qdii='QDII' in fund_type + name, updated=now.isoformat())
+            self._dirty = True
+        logging.info('refreshed the metadata of {0} funds'.format(len(codes)))
+
+    def wants_estimate(self, code, now=None):
+        """Whether requesting the estimate of a fund can return today's estimate"""
+        now = now or datetime.now(timezone.utc)
+        market = MARKETS['CN']
+        local = now.astimezone(market.tz)
+        if not market.is_trading_day(local.date()):
+            return False
+        # estimates are published during the sessions and kept during the lunch break
+        if not market.sessions[0][0] <= local.time() < market.sessions[-1][1]:
+            return False
+        entry = self.data.get(code)
+        if not entry or not entry.get('attempts') or not self.lacks_estimate(code):
+            return True
+        return now - datetime.fromisoformat(entry['last_attempt']) > timedelta(days=self.PROBE_DAYS)
+
+    def lacks_estimate(self, code):
+        """Whether fundgz (almost) never has an estimate of the fund, e.g. a QDII fund"""
+        entry = self.data.get(code)
+        if not entry:
+            return False
+        attempts, hits = entry.get('attempts', 0), entry.get('hits', 0)
+        if attempts >= self.MIN_ATTEMPTS:
+            return hits < self.MIN_HIT_RATE * attempts
+        return entry.get('qdii', False) and hits == 0
+
+    def record_estimate(self, code, hit, now=None):
+        """Count the result of an estimate request"""
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            entry = self.data.setdefault(code, {})
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            entry['hits'] = entry.get('hits', 0) + (1 if hit else 0)
+            if entry['attempts'] > 50:
+                # forget the old requests slowly
+                entry['attempts'] //= 2
+                entry['hits'] //= 2
+            entry['last_attempt'] = now.isoformat()
+            self._dirty = True
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self.data, ensure_ascii=False)
+            self._dirty = False
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
+# Shared by all the funds, in memory unless FUND_METADATA is set to a file path to persist it across runs
+default_metadata = FundMetadata(os.getenv('FUND_METADATA'))
+
+
+class TestFundMetadata(unittest.TestCase):
+    SEARCH = 'var r = [["000961","THHS300ETFLJA","天弘沪深300ETF联接A","指数型-股票","TIANHONG"],' \
+             '["270042","GFNZ100ETFLJRMBA","广发纳斯达克100ETF联接人民币(QDII)A","指数型-海外股票","GUANGFA"]];'
+
+    def at(self, text):
+        return datetime.fromisoformat(text).replace(tzinfo=MARKETS['CN'].tz)
+
+    def setUp(self):
+        self.metadata = FundMetadata()
+        self.metadata.refresh(['000961', '270042', '999999'], self.SEARCH, now=self.at('2025-06-03 10:00'))
+
+    def test_refresh(self):
+        self.assertEqual('天弘沪深300ETF联接A', self.metadata.name('000961'))
+        self.assertFalse(self.metadata.get('000961')['qdii'])
+        self.assertTrue(self.metadata.get('270042')['qdii'])
+        self.assertEqual(('CN_FUND', 'US', 'CN_FUND'), tuple(map(self.metadata.market, ['000961', '270042', '123456'])))
+        self.assertFalse(self.metadata.is_stale('000961', self.at('2025-06-20 10:00')))
+        self.assertTrue(self.metadata.is_stale('000961', self.at('2025-07-20 10:00')))
+        self.assertTrue(self.metadata.is_stale('123456'))
+        # an unknown code does not download fundcode_search.js again on every run
+        self.assertTrue(self.metadata.get('999999')['missing'])
+        self.assertIsNone(self.metadata.name('999999'))
+        self.assertFalse(self.metadata.is_stale('999999', self.at('2025-06-20 10:00')))
+        self.assertTrue(self.metadata.is_stale('999999', self.at('2025-07-20 10:00')))
+        self.assertFalse(self.metadata.lacks_estimate('999999'))
+        search = self.SEARCH.replace('000961', '999999')
+        self.metadata.refresh(['999999'], search, now=self.at('2025-07-20 10:00'))
+        self.assertNotIn('missing', self.metadata.get('999999'))
+        self.assertEqual('天弘沪深300ETF联接A', self.metadata.name('999999'))
+
+    def test_trading_hours(self):
+        self.assertTrue(self.metadata.wants_estimate('000961', self.at('2025-06-03 10:00')))
+        self.assertTrue(self.metadata.wants_estimate('000961', self.at('2025-06-03 12:00')))  # lunch break
+        self.assertFalse(self.metadata.wants_estimate('000961', self.at('2025-06-03 15:30')))
+        self.assertFalse(self.metadata.wants_estimate('000961', self.at('2025-06-02 10:00')))  # holiday
+
+    def test_rarely_available(self):
+        now = self.at('2025-06-03 10:00')
+        # a QDII fund is tried once
+        self.assertTrue(self.metadata.lacks_estimate('270042'))
+        self.assertTrue(self.metadata.wants_estimate('270042', now))
+        self.metadata.record_estimate('270042', False, now=now)
+        self.assertFalse(self.metadata.wants_estimate('270042', now + timedelta(minutes=30)))
+        self.assertTrue(self.metadata.wants_estimate('270042', now + timedelta(days=8)))
+
+        for i in range(6):
+            self.metadata.record_estimate('000961', i == 0, now=now)
+        self.assertFalse(self.metadata.wants_estimate('000961', now))
+        self.metadata.record_estimate('000961', True, now=now)
+        self.assertTrue(self.metadata.wants_estimate('000961', now))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.metadata.path = os.path.join(directory, 'metadata.json')
+            self.metadata.save()
+            self.assertEqual('天弘沪深300ETF联接A', FundMetadata(self.metadata.path).name('000961'))
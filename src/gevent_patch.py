@@ -0,0 +1,20 @@
+# -*- coding: UTF-8 -*-
+'''Patch the standard library for DOWNLOAD_BACKEND=gevent, see Monitor.BACKEND
+
+It must run before requests, smtplib or ssl are imported, so every entry script
+imports this module first. Every download waiting for a response then yields
+to the others.
+'''
+import os
+import sys
+import logging
+
+# modules imported before the patch, their sockets may still block the other greenlets
+imported_too_early = []
+
+if os.getenv('DOWNLOAD_BACKEND') == 'gevent':
+    imported_too_early = [m for m in ('ssl', 'smtplib', 'requests', 'urllib3') if m in sys.modules]
+    if imported_too_early:
+        logging.warning('{0} imported before gevent_patch'.format(','.join(imported_too_early)))
+    from gevent import monkey
+    monkey.patch_all()
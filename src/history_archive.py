@@ -0,0 +1,274 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import logging
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+
+class HistoryArchive:
+    """Columnar archive of price histories read through memory maps
+
+    All assets are stored back to back in two flat files, and an index maps
+    each code to its slice, so opening the archive does not read any price:
+        dates.bin   int64 timestamps in milliseconds
+        prices.bin  float64 prices
+        index.json  code -> {"offset": ..., "length": ..., "name": ...}
+    A write of the same length overwrites the segment in place, any other write
+    appends a new segment and repoints the index. The index is written by save(),
+    once per batch of writes, which also compacts the archive when more than
+    COMPACT_RATIO of it is stale segments. There must be only one writing process at a time.
+    """
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._dates_path = os.path.join(directory, 'dates.bin')
+        self._prices_path = os.path.join(directory, 'prices.bin')
+        self._index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.RLock()
+        self._maps = None
+        self._dirty = False
+        self.index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        # number of prices in the files and in the segments of the index, see stale_ratio()
+        self._total = os.path.getsize(self._prices_path) // 8 if os.path.exists(self._prices_path) else 0
+        self._live = sum(entry['length'] for entry in self.index.values())
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def codes(self):
+        return list(self.index)
+
+    def write(self, code, dates, prices, name=''):
+        if len(dates) != len(prices):
+            raise ValueError('{0}: {1} dates but {2} prices'.format(code, len(dates), len(prices)))
+        dates = np.asarray(dates, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        with self._lock:
+            entry = self.index.get(code)
+            if entry is not None and entry['length'] == len(prices):
+                # e.g. a run repeated on the same day
+                for path, values in ((self._dates_path, dates), (self._prices_path, prices)):
+                    with open(path, 'r+b') as f:
+                        f.seek(entry['offset'] * 8)
+                        f.write(values.tobytes())
+                if entry['name'] != name:
+                    self.index[code] = dict(entry, name=name)
+                    self._dirty = True
+                return
+            offset = self._total
+            with open(self._dates_path, 'ab') as f:
+                f.write(dates.tobytes())
+            with open(self._prices_path, 'ab') as f:
+                f.write(prices.tobytes())
+            self._total += len(prices)
+            self._live += len(prices) - (entry['length'] if entry is not None else 0)
+            self.index[code] = {'offset': offset, 'length': len(prices), 'name': name}
+            self._dirty = True
+            self._maps = None  # the files have grown, map them again on the next read
+
+    def write_asset(self, asset):
+        """Archive the settled rows of an asset, never its provisional last price (see BaseAsset.settled)"""
+        n = asset.settled()
+        if n:
+            self.write(asset.code, asset.dates[:n], asset.worth[:n], asset.name)
+
+    def read(self, code):
+        """Return the dates and prices of code as read-only arrays backed by the page cache"""
+        entry = self.index[code]
+        dates, prices = self._open()
+        start, end = entry['offset'], entry['offset'] + entry['length']
+        return dates[start:end], prices[start:end]
+
+    def _open(self):
+        maps = self._maps
+        if maps is None:
+            with self._lock:
+                if os.path.exists(self._prices_path) and os.path.getsize(self._prices_path) > 0:
+                    maps = (np.memmap(self._dates_path, dtype=np.int64, mode='r'),
+                            np.memmap(self._prices_path, dtype=np.float64, mode='r'))
+                else:
+                    maps = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+                self._maps = maps
+        return maps
+
+    def _save_index(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp, self._index_path)
+
+    def save(self):
+        """Write the index after a batch of writes, compact the archive if it is mostly stale"""
+        with self._lock:
+            if self.stale_ratio() > self.COMPACT_RATIO:
+                self.compact()
+            elif self._dirty:
+                self._save_index()
+                self._dirty = False
+
+    def stale_ratio(self):
+        """Fraction of the stored prices that belong to replaced segments"""
+        return 1 - self._live / self._total if self._total else 0.0
+
+    def compact(self):
+        """Rewrite the archive keeping only the latest segment of every code"""
+        with self._lock:
+            # mapped under the lock, so that no write can grow the index past the maps
+            dates, prices = self._open()
+            index = {}
+            offset = 0
+            tmp_dates, tmp_prices = self._dates_path + '.tmp', self._prices_path + '.tmp'
+            with open(tmp_dates, 'wb') as fd, open(tmp_prices, 'wb') as fp:
+                for code, entry in self.index.items():
+                    start, end = entry['offset'], entry['offset'] + entry['length']
+                    fd.write(np.ascontiguousarray(dates[start:end]).tobytes())
+                    fp.write(np.ascontiguousarray(prices[start:end]).tobytes())
+                    index[code] = dict(entry, offset=offset)
+                    offset += entry['length']
+            self._maps = dates = prices = None
+            os.replace(tmp_dates, self._dates_path)
+            os.replace(tmp_prices, self._prices_path)
+            self.index = index
+            self._total = self._live = offset
+            self._save_index()
+            self._dirty = False
+        logging.info('compacted history archive {0}: {1} prices of {2} assets'.format(self.directory, offset, len(index)))
+
+
+# Set HISTORY_ARCHIVE to a directory to archive every downloaded history
+default_archive = HistoryArchive(os.environ['HISTORY_ARCHIVE']) if os.getenv('HISTORY_ARCHIVE') else None
+
+
+class TestHistoryArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = HistoryArchive(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_read(self):
+        self.assertEqual(0, len(self.archive))
+        self.archive.write('A', [1, 2, 3], [1.0, 1.1, 1.2], name='Fund A')
+        self.archive.write('B', [2, 3], [10.0, 9.5])
+        dates, prices = self.archive.read('A')
+        self.assertEqual([1, 2, 3], dates.tolist())
+        self.assertEqual([1.0, 1.1, 1.2], prices.tolist())
+        self.assertEqual([10.0, 9.5], self.archive.read('B')[1].tolist())
+        self.assertRaises(ValueError, self.archive.write, 'C', [1], [1.0, 2.0])
+        # the index is written once per batch
+        self.assertEqual([], HistoryArchive(self.tmp.name).codes())
+        self.archive.save()
+
+        # reopen without any network or pickled objects
+        archive = HistoryArchive(self.tmp.name)
+        self.assertIn('A', archive)
+        self.assertEqual(['A', 'B'], archive.codes())
+        self.assertEqual('Fund A', archive.index['A']['name'])
+        self.assertIsInstance(archive.read('A')[1], np.memmap)
+
+    def test_rewrite_and_compact(self):
+        self.archive.write('A', [1, 2], [1.0, 1.1])
+        self.archive.write('B', [1], [5.0])
+        self.archive.write('A', [1, 2, 3], [1.0, 1.1, 1.3])
+        self.assertEqual([1.0, 1.1, 1.3], self.archive.read('A')[1].tolist())
+        self.assertEqual(6, os.path.getsize(os.path.join(self.tmp.name, 'prices.bin')) // 8)
+        self.assertAlmostEqual(2 / 6, self.archive.stale_ratio())
+        self.archive.compact()
+        self.assertEqual(0, self.archive.stale_ratio())
+        self.assertEqual(4, os.path.getsize(os.path.join(self.tmp.name, 'prices.bin')) // 8)
+        self.assertEqual([1.0, 1.1, 1.3], self.archive.read('A')[1].tolist())
+        self.assertEqual([5.0], HistoryArchive(self.tmp.name).read('B')[1].tolist())
+
+    def test_overwrite_and_auto_compact(self):
+        path = os.path.join(self.tmp.name, 'prices.bin')
+        self.archive.write('A', [1, 2], [1.0, 1.1], name='A')
+        self.archive.write('B', [1, 2], [5.0, 5.1])
+        self.archive.save()
+        # same length, e.g. the same day again: in place
+        self.archive.write('A', [1, 2], [1.0, 1.2], name='A')
+        self.assertEqual(4, os.path.getsize(path) // 8)
+        self.assertEqual([1.0, 1.2], HistoryArchive(self.tmp.name).read('A')[1].tolist())
+        # a new day for every asset appends the whole universe again
+        self.archive.write('A', [1, 2, 3], [1.0, 1.2, 1.3])
+        self.archive.write('B', [1, 2, 3], [5.0, 5.1, 5.2])
+        self.archive.save()
+        self.assertEqual(10, os.path.getsize(path) // 8)
+        # until more than half of the archive is stale
+        self.archive.write('A', [1, 2, 3, 4], [1.0, 1.2, 1.3, 1.4])
+        self.archive.write('B', [1, 2, 3, 4], [5.0, 5.1, 5.2, 5.3])
+        self.archive.save()
+        self.assertEqual(8, os.path.getsize(path) // 8)
+        archive = HistoryArchive(self.tmp.name)
+        self.assertEqual(0, archive.stale_ratio())
+        self.assertEqual([5.0, 5.1, 5.2, 5.3], archive.read('B')[1].tolist())
+
+    def test_asset(self):
+        from unittest import mock
+        from base_asset import TestAsset
+        asset = TestAsset('A')
+        asset.download = lambda: setattr(asset, 'worth', [1.0, 0.9]) or setattr(asset, 'dates', [1, 2])
+        with mock.patch.object(TestAsset, 'archive', self.archive):
+            asset.trade()
+            TestAsset.release()  # saves the index
+        restored = TestAsset('A')
+        restored.restore(HistoryArchive(self.tmp.name))
+        self.assertEqual([1, 2], restored.dates)
+        self.assertEqual([1.0, 0.9], restored.worth)
+        self.assertEqual('Test Asset', restored.name)
+        self.assertEqual(-1, restored.analyze())
+
+    def test_provisional(self):
+        from base_asset import TestAsset
+        asset = TestAsset('A')
+        asset.dates, asset.worth = [1, 2, 3], [1.0, 0.9, 0.95]
+        asset.trading = True  # the last price is an estimate
+        self.archive.write_asset(asset)
+        self.assertEqual([1.0, 0.9], self.archive.read('A')[1].tolist())
+        asset.dates, asset.worth = [3], [1.0]
+        self.archive.write_asset(asset)
+        self.assertEqual([1.0, 0.9], self.archive.read('A')[1].tolist())
+
+    def test_stale_fallback(self):
+        import time
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        self.archive.write('A', [1, 2], [1, 2], 'A')
+        self.archive.write('B', [1, 2], [5, 4], 'B')
+        assets = [TestAsset('A', [1, 2, 3, 4], delay=0.3), TestAsset('B', [1], fail=True),
+                  TestAsset('C', [1], fail=True), TestAsset('D', [3, 2, 1])]
+        for asset in assets:
+            asset.archive = self.archive
+            asset.result_cache = None
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', latency_budget=0.1))
+        monitor._download_asset_data(assets)
+
+        slow, failed, _, fresh = assets
+        self.assertEqual([slow, failed, fresh], sorted(monitor.success, key=assets.index))
+        self.assertEqual(['C'], monitor.failed)
+        self.assertEqual(([1, 2], 1, True), (slow.worth, slow.N, slow.stale))
+        self.assertEqual(([5, 4], True), (failed.worth, failed.stale))
+        self.assertEqual(([3, 2, 1], -2, False), (fresh.worth, fresh.N, fresh.stale))
+        monitor.TEST = '1'
+        self.assertIn('Stale: A,B', monitor._create_notification_table())
+
+        # the late download goes on in the background for the next run, without its estimate
+        for _ in range(50):
+            if len(self.archive.read('A')[1]) == 3:
+                break
+            time.sleep(0.05)
+        self.assertEqual([1, 2, 3], self.archive.read('A')[1].tolist())
+        self.assertEqual([1, 2], slow.worth)
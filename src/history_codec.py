@@ -0,0 +1,261 @@
+# -*- coding: UTF-8 -*-
+import sys
+import time
+import json
+import zlib
+import random
+import struct
+import unittest
+
+import numpy as np
+
+
+# Bump it when the format changes, decode refuses the other versions
+VERSION = 1
+MAGIC = b'HC'
+# magic, version, value encoding, decimals, bytes per date, bytes per value, length, first date, date unit, first value
+HEADER = struct.Struct('<2sBBBBBIqqq')
+FIXED, XOR = 0, 1
+MAX_DECIMALS = 8
+INT_TYPES = {1: np.int8, 2: np.int16, 4: np.int32, 8: np.int64}
+
+
+def _narrow(values):
+    """Cast integers to the smallest signed type holding them all, return (size in bytes, array)"""
+    values = np.asarray(values, dtype=np.int64)
+    for size, dtype in INT_TYPES.items():
+        info = np.iinfo(dtype)
+        if not len(values) or (values.min() >= info.min and values.max() <= info.max):
+            return size, values.astype(dtype)
+
+
+def _decimals(prices):
+    '''Fewest decimals (up to MAX_DECIMALS) that represent every price exactly, None if there are none
+
+    NAVs have 4 decimals and most closes 2 or 3, but a price computed from an estimate
+    (see Fund.download) or an adjusted close has no exact decimal form.
+    '''
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10.0 ** decimals
+        scaled = np.round(prices * scale)
+        # beyond 2**53 the integers are not exact as floats any more
+        if not np.all(np.abs(scaled) < 2 ** 53):
+            continue
+        # compare the bits of what decode() returns, -0.0 == 0.0 but an integer has no sign
+        decoded = scaled.astype(np.int64) / scale
+        if np.array_equal(decoded.view(np.uint64), prices.view(np.uint64)):
+            return decimals
+    return None
+
+
+def encode(dates, prices, level=6):
+    '''Compact lossless encoding of a price history
+
+    dates    timestamps in milliseconds, stored as the delta of deltas in units of their greatest
+             common divisor, e.g. 0 for consecutive days and 2 across a weekend
+    prices   deltas of the prices scaled to integers when they all have a few decimals (FIXED),
+             otherwise the float bits XORed with the previous price and grouped by byte (XOR),
+             so that the bytes that do not change make long runs of zeros
+    Both columns are stored in the smallest integer type and zlib is run on top.
+    '''
+    dates = np.asarray(dates, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    if len(dates) != len(prices):
+        raise ValueError('{0} dates but {1} prices'.format(len(dates), len(prices)))
+    n = len(prices)
+    first_date = int(dates[0]) if n else 0
+    deltas = np.diff(dates)
+    unit = int(np.gcd.reduce(deltas)) if len(deltas) and deltas.any() else 1
+    date_size, date_column = _narrow(np.diff(deltas // unit, prepend=0))
+
+    decimals = _decimals(prices) if n else 0
+    if decimals is not None:
+        mode = FIXED
+        scaled = np.round(prices * 10.0 ** decimals).astype(np.int64)
+        first_value = int(scaled[0]) if n else 0
+        value_size, value_column = _narrow(np.diff(scaled))
+        value_bytes = value_column.tobytes()
+    else:
+        mode, decimals, first_value, value_size = XOR, 0, 0, 8
+        bits = prices.view(np.uint64)
+        xored = bits ^ np.concatenate([np.zeros(1, dtype=np.uint64), bits[:-1]])
+        value_bytes = xored.view(np.uint8).reshape(-1, 8).T.tobytes()
+
+    header = HEADER.pack(MAGIC, VERSION, mode, decimals, date_size, value_size, n, first_date, unit, first_value)
+    return header + zlib.compress(date_column.tobytes() + value_bytes, level)
+
+
+def decode(blob):
+    """Decode a history of encode() into (int64 dates, float64 prices) arrays"""
+    magic, version, mode, decimals, date_size, value_size, n, first_date, unit, first_value = \
+        HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a history of version {0}: {1!r} {2}'.format(VERSION, magic, version))
+    data = zlib.decompress(memoryview(blob)[HEADER.size:])
+    split = (n - 1) * date_size if n else 0
+    dates = np.empty(n, dtype=np.int64)
+    prices = np.empty(n, dtype=np.float64)
+    if not n:
+        return dates, prices
+
+    steps = np.cumsum(np.frombuffer(data, dtype=INT_TYPES[date_size], count=n - 1), dtype=np.int64)
+    dates[0] = first_date
+    np.cumsum(steps * unit, out=dates[1:])
+    dates[1:] += first_date
+
+    if mode == FIXED:
+        scaled = np.empty(n, dtype=np.int64)
+        scaled[0] = first_value
+        np.cumsum(np.frombuffer(data, dtype=INT_TYPES[value_size], count=n - 1, offset=split), out=scaled[1:])
+        scaled[1:] += first_value
+        np.divide(scaled, 10.0 ** decimals, out=prices)
+    else:
+        xored = np.frombuffer(data, dtype=np.uint8, offset=split).reshape(8, n).T.copy().view(np.uint64).ravel()
+        prices[:] = np.bitwise_xor.accumulate(xored).view(np.float64)
+    return dates, prices
+
+
+def encode_asset(asset):
+    return encode(asset.dates, asset.worth)
+
+
+def dump(series, path):
+    '''Write many histories to one file: {code: (dates, prices)}, e.g. read from a HistoryArchive
+
+    The file is a json index of the codes and the sizes of their histories, one line long,
+    followed by the encoded histories back to back.
+    '''
+    blobs = {code: encode(dates, prices) for code, (dates, prices) in series.items()}
+    index = json.dumps({code: len(blob) for code, blob in blobs.items()}, ensure_ascii=False)
+    with open(path, 'wb') as f:
+        f.write(index.encode('utf-8') + b'\n')
+        for blob in blobs.values():
+            f.write(blob)
+
+
+def load(path, codes=None):
+    """Read the histories of dump(), only the ones of codes if set"""
+    with open(path, 'rb') as f:
+        index = json.loads(f.readline())
+        data = memoryview(f.read())
+    series = {}
+    offset = 0
+    for code, size in index.items():
+        if codes is None or code in codes:
+            series[code] = decode(data[offset:offset + size])
+        offset += size
+    return series
+
+
+def universe(n=10000, days=2500, seed=11):
+    """Synthetic histories like the ones of fund NAVs: 4 decimals, trading days only"""
+    random.seed(seed)
+    rng = np.random.default_rng(seed)
+    day = 86400000
+    start = 1420041600000  # 2015-01-01 in Beijing
+    calendar = np.array([start + i * day for i in range(days * 7 // 5 + 7)
+                         if (i + 3) % 7 < 5], dtype=np.int64)[:days]
+    series = {}
+    for i in range(n):
+        length = random.randint(days // 10, days)
+        moves = rng.normal(0.0003, random.choice([0.001, 0.01, 0.02]), length)
+        series['{0:06d}'.format(i)] = (calendar[-length:], np.round(np.cumprod(1 + moves), 4))
+    return series
+
+
+class TestHistoryCodec(unittest.TestCase):
+    def assertRoundtrip(self, dates, prices):
+        blob = encode(dates, prices)
+        decoded_dates, decoded_prices = decode(blob)
+        self.assertEqual(list(dates), decoded_dates.tolist())
+        # the exact bits, NaN included
+        self.assertEqual(np.asarray(prices, dtype=np.float64).tobytes(), decoded_prices.tobytes())
+        return blob
+
+    def test_fixed(self):
+        dates, prices = universe(1, 2000)['000000']
+        blob = self.assertRoundtrip(dates, prices)
+        self.assertEqual(FIXED, blob[3])
+        self.assertEqual(4, blob[4])
+        # weekends and holidays only change the delta of the dates
+        self.assertEqual(1, blob[5])
+        self.assertLess(len(blob), len(prices) * 16 / 5)
+        self.assertEqual(2, encode([1, 2], [1.5, 2.25])[4])
+        self.assertRoundtrip([1, 2, 3], [1, 10 ** 12, -3])
+
+    def test_xor(self):
+        prices = [1.0]
+        for _ in range(999):
+            prices.append(prices[-1] * 1.01)  # no exact decimals
+        blob = self.assertRoundtrip(range(0, 3000, 3), prices)
+        self.assertEqual(XOR, blob[3])
+        self.assertLess(len(blob), len(prices) * 8)
+        self.assertRoundtrip([5, 7], [1.0, float('nan')])
+        self.assertRoundtrip([5, 7], [float('inf'), 1e300])
+
+    def test_edges(self):
+        self.assertRoundtrip([], [])
+        self.assertRoundtrip([1735660800000], [1.2345])
+        self.assertRoundtrip([1, 1, 5, 2], [0.0, -1.5, 2.0, 2.0])
+        self.assertRoundtrip([1, 2], [-0.0, 1.0])
+        self.assertRaises(ValueError, encode, [1, 2], [1.0])
+        blob = bytearray(encode([1], [1.0]))
+        blob[2] = VERSION + 1
+        self.assertRaises(ValueError, decode, bytes(blob))
+
+    def test_asset(self):
+        from base_asset import TestAsset
+        asset = TestAsset('A')
+        asset.worth = [1.0, 1.1, 1.05]
+        asset.dates = [1735660800000, 1735747200000, 1736006400000]
+        dates, prices = decode(encode_asset(asset))
+        self.assertEqual(asset.dates, dates.tolist())
+        self.assertEqual(asset.worth, prices.tolist())
+
+    def test_dump_load(self):
+        import os
+        import tempfile
+        series = universe(50, 300)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'universe.hc')
+            dump(series, path)
+            loaded = load(path)
+            self.assertEqual(list(series), list(loaded))
+            for code, (dates, prices) in series.items():
+                self.assertEqual(dates.tolist(), loaded[code][0].tolist())
+                self.assertEqual(prices.tolist(), loaded[code][1].tolist())
+            self.assertEqual(['000007'], list(load(path, {'000007'})))
+            # against 16 bytes per price of the raw arrays
+            raw = sum(len(p) for _, p in series.values()) * 16
+            self.assertLess(os.path.getsize(path), raw / 4)
+
+
+if __name__ == '__main__':
+    # python history_codec.py [funds] [days]: size and load time of a synthetic fund universe
+    import os
+    import tempfile
+    n, days = [int(a) for a in sys.argv[1:3]] + [10000, 2500][len(sys.argv[1:3]):]
+    series = universe(n, days)
+    prices = sum(len(p) for _, p in series.values())
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'universe.hc')
+        start = time.time()
+        dump(series, path)
+        print('{0} funds, {1} prices: encoded in {2:.2f}s'.format(n, prices, time.time() - start))
+        print('{0:.1f} MB against {1:.1f} MB of raw arrays'.format(os.path.getsize(path) / 2 ** 20, prices * 16 / 2 ** 20))
+        start = time.time()
+        load(path)
+        elapsed = time.time() - start
+        print('loaded in {0:.2f}s, {1:.0f}us per fund'.format(elapsed, elapsed / n * 1e6))
+    # an eastmoney payload holds the history as a javascript array of [timestamp, price, ...]
+    dates, worth = series['000000']
+    payload = json.dumps([[int(t), float(w)] for t, w in zip(dates, worth)])
+    blob = encode(dates, worth)
+    start = time.time()
+    for _ in range(100):
+        json.loads(payload)
+    parse = (time.time() - start) / 100
+    start = time.time()
+    for _ in range(100):
+        decode(blob)
+    print('one history: json.loads {0:.0f}us, decode {1:.0f}us'.format(parse * 1e6, (time.time() - start) / 100 * 1e6))
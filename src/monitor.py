@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import copy
 import time
 import logging
+import threading
 import unittest
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import utils
+import risk
+import adaptive_thresholds
+import result_cache
+from profiling import Profiler
+from trading_calendar import TradingCalendar
 from fund import Fund, TestFund
 
 
@@ -28,14 +35,23 @@ HTML_TEMPLATE = '''
 
 class Monitor:
     """Base monitoring class for processing assets and sending notifications"""
+    # Download threads, the rate limiter of each source decides how many of them send requests at once
+    MAX_WORKERS = 16
+    # 'threads', or 'gevent' to download with greenlets: set DOWNLOAD_BACKEND=gevent, the entry
+    # scripts import gevent_patch first. Thousands of idle greenlets are cheap, the rate
+    # limiters still decide how many requests are sent at once. Not used with a latency budget
+    BACKEND = os.getenv('DOWNLOAD_BACKEND', 'threads')
+    POOL_SIZE = int(os.getenv('GEVENT_POOL_SIZE', 500))
 
     def __init__(self, config=None):
         self.success = []
         self.failed = []
+        self.skipped = []  # assets whose market has not traded since their last run
         self.config = config  # Optional config for configurable formatting
         self.subject = f'{self.config.subject_prefix}【{datetime.now().strftime(u"%Y{0}%m{1}%d{2}").format(*"年月日")}】'
 
         self.TEST = os.getenv('TEST')
+        self.profiler = Profiler.from_env()  # set PROFILE to a directory to profile the run
 
     def process(self, assets):
         """Main processing pipeline: download data, analyze, and notify"""
@@ -47,37 +63,138 @@ class Monitor:
         logging.info(f'Starting to process {len(assets)} assets')
         start_time = time.time()
 
-        self._download_asset_data(assets) # call trade -> buy_or_sell
+        with self.profiler.stage('download'):
+            self._download_asset_data(assets) # call trade -> buy_or_sell
         self._sort_results_by_original_order(assets)
-        self._generate_and_send_notification()
+        with self.profiler.stage('notify'):
+            self._generate_and_send_notification()
+        self.profiler.save()
 
         total_time = time.time() - start_time
         logging.info(f'Processing completed in {total_time:.2f} seconds')
 
-    def _download_asset_data(self, assets):
-        """Download and process asset data concurrently"""
-        def process_single_asset(asset):
-            """Process a single asset and track timing"""
-            start = time.time()
-            try:
+    def _process_single_asset(self, asset):
+        """Process a single asset and track timing"""
+        start = time.time()
+        try:
+            with self.profiler.asset(asset.code):
                 asset.trade()
+            self.success.append(asset)
+            logging.debug(f'Successfully processed {asset.code}')
+        except Exception as e:
+            logging.exception(f'Failed to process asset {asset.code}: {e}')
+            self._fall_back(asset)
+        return time.time() - start
+
+    def _fall_back(self, asset):
+        """Serve the archived history of an asset whose download failed or is late, or count it as failed"""
+        try:
+            served = asset.fallback()
+        except Exception:
+            logging.exception(f'Failed to fall back to the archived history of {asset.code}')
+            served = False
+        if served:
+            self.success.append(asset)
+        else:
+            self.failed.append(asset.code)
+
+    @staticmethod
+    def _prefetch(cls, assets):
+        try:
+            cls.prefetch([asset for asset in assets if type(asset) is cls])
+        except Exception:
+            # every asset can still download its own data
+            logging.exception(f'Failed to prefetch {cls.__name__} assets')
+
+    def _download_within_budget(self, assets, budget, classes):
+        '''Prefetch and download copies of the assets for at most budget seconds and return what is still running
+
+        An asset whose copy is done in time takes its data, the others fall back to their archived
+        history. The late downloads go on in the background and archive their history for the next run.
+        The downloads of a class whose prefetch is late do not wait for it.
+        '''
+        deadline = time.time() + budget
+        executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        prefetches = [executor.submit(self._prefetch, cls, assets) for cls in classes]
+        late = wait(prefetches, timeout=budget).not_done
+        if late:
+            logging.warning(f'{len(late)} prefetches are still running after {budget}s')
+        copies = [copy.copy(asset) for asset in assets]
+        futures = [executor.submit(c.trade) for c in copies]
+        done, pending = wait(futures, timeout=max(0, deadline - time.time()))
+        executor.shutdown(wait=False)
+        for asset, fresh, future in zip(assets, copies, futures):
+            if future in done and future.exception() is None:
+                asset.__dict__.update(fresh.__dict__)
                 self.success.append(asset)
-                logging.debug(f'Successfully processed {asset.code}')
-            except Exception as e:
-                logging.exception(f'Failed to process asset {asset.code}: {e}')
-                self.failed.append(asset.code)
-            return time.time() - start
+                continue
+            if future in done:
+                logging.error(f'Failed to process asset {asset.code}: {future.exception()}')
+            else:
+                logging.warning(f'{asset.code} is still downloading after {budget}s')
+            self._fall_back(asset)
+        return pending | late
+
+    @staticmethod
+    def _release_when_done(futures, classes):
+        """Wait for the background downloads before freeing the resources they share"""
+        wait(futures)
+        for cls in classes:
+            cls.release()
+        result_cache.default_cache.save()
+        logging.info(f'{len(futures)} late downloads are done')
 
+    def _download_asset_data(self, assets):
+        """Download and process asset data concurrently"""
         # Execute downloads concurrently
         concurrent_start = time.time()
         total_processing_time = 0
 
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            total_processing_time = sum(executor.map(process_single_asset, assets))
+        calendar = None
+        if self.config.calendar_file:
+            calendar = TradingCalendar(self.config.calendar_file)
+            assets, skipped = calendar.split(assets)
+            self.skipped.extend(skipped)
+
+        classes = list(dict.fromkeys(type(asset) for asset in assets))
+        pending = ()
+        try:
+            if self.profiler.enabled or self.config.latency_budget is None:
+                for cls in classes:
+                    self._prefetch(cls, assets)
+
+            if self.profiler.enabled:
+                # one at a time in this thread, so that cProfile sees the downloads
+                # and the memory of every asset can be told apart
+                total_processing_time = sum(map(self._process_single_asset, assets))
+            elif self.config.latency_budget is not None:
+                if self.BACKEND == 'gevent':
+                    logging.warning('DOWNLOAD_BACKEND=gevent is ignored with a latency budget, downloading with threads')
+                pending = self._download_within_budget(assets, self.config.latency_budget, classes)
+            elif self.BACKEND == 'gevent':
+                from gevent import monkey
+                from gevent.pool import Pool
+                if not monkey.is_module_patched('socket'):
+                    logging.warning('gevent has not patched the standard library, import gevent_patch first')
+                total_processing_time = sum(Pool(self.POOL_SIZE).imap_unordered(self._process_single_asset, assets))
+            else:
+                with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+                    total_processing_time = sum(executor.map(self._process_single_asset, assets))
+        finally:
+            if pending:
+                threading.Thread(target=self._release_when_done, args=(pending, classes)).start()
+            else:
+                for cls in classes:
+                    cls.release()
 
         actual_time = time.time() - concurrent_start
         logging.info(f'Processing time: {total_processing_time:.2f}s total, {actual_time:.2f}s actual')
-        logging.info(f'Success: {len(self.success)}, Failed: {len(self.failed)}')
+        stale = sum(asset.stale for asset in self.success)
+        logging.info(f'Success: {len(self.success)} ({stale} stale), Failed: {len(self.failed)}, Skipped: {len(self.skipped)}')
+        result_cache.default_cache.save()
+        if calendar is not None:
+            # the stale assets are downloaded again on the next run
+            calendar.record([asset for asset in self.success if not asset.stale])
 
     def _sort_results_by_original_order(self, assets):
         """Sort successful results to match original asset order"""
@@ -96,6 +213,17 @@ class Monitor:
 
     def _create_notification_content(self):
         """Create HTML notification content from processed results"""
+        html_table = self._create_notification_table()
+
+        if not html_table:
+            return None
+
+        html_message = HTML_TEMPLATE.format(html_table)
+        logging.debug(f'HTML content:\n{html_message}')
+        return html_message
+
+    def _create_notification_table(self):
+        """Create the HTML table of interesting assets without the surrounding template"""
         interesting_assets = self.filter_sort()
 
         if not interesting_assets:
@@ -103,13 +231,38 @@ class Monitor:
 
         # Format asset information - use configurable formatting if config is available
         # Use configurable formatting with thresholds from config
-        asset_lines = [asset.format_with_config(
-            low_threshold=self.config.low_threshold,
-            drawdown_threshold=self.config.drawdown_threshold,
-            daily_change_threshold=self.config.daily_change_threshold
-        ) for asset in interesting_assets]
+        asset_lines = []
+        for asset in interesting_assets:
+            config = self._config_for(asset)
+            asset_lines.append(asset.format_with_config(
+                low_threshold=config.low_threshold,
+                drawdown_threshold=config.drawdown_threshold,
+                daily_change_threshold=config.daily_change_threshold,
+                low_rank_threshold=config.low_rank_threshold,
+                high_rank_threshold=config.high_rank_threshold,
+                rank_window=config.rank_window
+            ))
 
-        html_table = utils.html_table([line.split(':') for line in asset_lines], head=False)
+        rows = [line.split(':') for line in asset_lines]
+        columns = self.config.risk_columns
+        if columns:
+            for row, asset in zip(rows, interesting_assets):
+                metrics = asset.risk_metrics()
+                row.extend(risk.format_metric(c, metrics[c]) for c in columns)
+            rows.insert(0, ['', ''] + [risk.COLUMNS[c][0] for c in columns])
+        if self.config.sparklines:
+            for row, asset in zip(rows[1:] if columns else rows, interesting_assets):
+                config = self._config_for(asset)
+                row.append(asset.sparkline(config.low_threshold, config.high_threshold))
+            if columns:
+                rows[0].append('')
+        html_table = utils.html_table(rows, head=bool(columns))
+
+        stale = [asset.code for asset in interesting_assets if asset.stale]
+        if stale:
+            stale_msg = 'Stale: ' + ','.join(stale)
+            asset_lines.append(stale_msg)
+            html_table += f'\n<p style="color:gray">⌛{stale_msg}</p>'
 
         # Add error information if any
         if self.failed:
@@ -119,12 +272,16 @@ class Monitor:
 
         # Log text version and return HTML
         text_message = '\n'.join(asset_lines)
-        html_message = HTML_TEMPLATE.format(html_table)
-
         logging.info(f'Notification content:\n{text_message}')
-        logging.debug(f'HTML content:\n{html_message}')
 
-        return html_message
+        return html_table
+
+    def _config_for(self, asset):
+        """The config with the thresholds of the asset when adaptive_quantiles is set, see adaptive_thresholds.py"""
+        quantiles = self.config.adaptive_quantiles
+        if not quantiles:
+            return self.config
+        return adaptive_thresholds.with_thresholds(self.config, asset.adaptive_thresholds(quantiles))
 
     def _send_notification(self, html_message):
         """Send email notification unless in test mode"""
@@ -150,3 +307,45 @@ class Monitor:
         else:
             logging.info('No assets are currently trading')
             return []
+
+
+class TestMonitor(unittest.TestCase):
+    def test_skip_closed_markets(self):
+        import tempfile
+        from datetime import time as day_time
+        from unittest import mock
+        import trading_calendar
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        closed = trading_calendar.Market('CLOSED', 'UTC', [(day_time(0), day_time(0))])
+        asset = TestAsset('A', [1, 2, 3])
+        asset.market = 'CLOSED'
+        # the prices of the fixture are from 1970, see TestTradingCalendar for is_up_to_date
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(trading_calendar.MARKETS, {'CLOSED': closed}), \
+                mock.patch.object(TradingCalendar, 'is_up_to_date', return_value=True):
+            config = MonitorConfig(asset_type='fund', subject_prefix='test',
+                                   calendar_file=os.path.join(directory, 'calendar.json'))
+            for downloads, skipped in [(1, []), (1, [asset])]:
+                monitor = Monitor(config)
+                monitor._download_asset_data([asset])
+                self.assertEqual(downloads, asset.downloads)
+                self.assertEqual(skipped, monitor.skipped)
+                self.assertEqual([], monitor.failed)
+
+    def test_prefetch_within_budget(self):
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+
+        class SlowPrefetch(TestAsset):
+            @classmethod
+            def prefetch(cls, assets):
+                time.sleep(0.5)
+
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', latency_budget=0.1))
+        asset = SlowPrefetch('A', [1, 2])
+        asset.archive = asset.result_cache = None
+        start = time.time()
+        monitor._download_asset_data([asset])
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(['A'], monitor.failed)  # nothing to fall back to
@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+import gevent_patch  # noqa: F401, first of all, see gevent_patch.py
+import os
+import sys
+import json
+import time
+import logging
+import unittest
+
+from monitor import Monitor, HTML_TEMPLATE
+from monitor_config import MonitorConfig
+from monitor_with_criteria import MonitorWithCriteria
+from base_asset import BaseAsset, TestAsset
+from fund import Fund
+from stock import Stock
+from crypto import Crypto
+from monitor_funds import FUND_CONFIG, FUND_CODES
+from monitor_stocks import STOCK_CONFIG, STOCK_CODES
+from monitor_cryptos import CRYPTO_CONFIG, CRYPTO_SYMBOLS
+
+
+# asset type -> (monitor class, config)
+# Each type keeps the thresholds of its own standalone script
+MONITORS = {
+    'fund': (Monitor, FUND_CONFIG),
+    'stock': (MonitorWithCriteria, STOCK_CONFIG),
+    'crypto': (MonitorWithCriteria, CRYPTO_CONFIG),
+}
+
+WATCHLIST = {
+    'fund': FUND_CODES,
+    'stock': STOCK_CODES,
+    'crypto': CRYPTO_SYMBOLS,
+}
+
+
+def make_asset(asset_type, item):
+    """Create an asset from a watchlist entry
+
+    Crypto entries can be a symbol or a (symbol, exchange) pair.
+    """
+    if asset_type == 'fund':
+        return Fund(item)
+    if asset_type == 'stock':
+        return Stock(item)
+    if asset_type == 'crypto':
+        if isinstance(item, (tuple, list)):
+            return Crypto(*item)
+        return Crypto(item)
+    raise ValueError(f'Unknown asset type: {asset_type}')
+
+
+class MultiMonitor(Monitor):
+    """Monitor several asset types in one run
+
+    All assets are downloaded by a single executor. Identical assets that appear
+    in more than one section share one object, so their history is downloaded once.
+    Each section is filtered and formatted by its own monitor (and thus its own
+    MonitorConfig) and the results are sent as one email with a section per type.
+    """
+
+    def __init__(self, subject_prefix='小作手', calendar_file=None, latency_budget=None):
+        super().__init__(MonitorConfig(asset_type='all', subject_prefix=subject_prefix, calendar_file=calendar_file,
+                                       latency_budget=latency_budget))
+        self.sections = []  # list of (monitor, assets)
+        self._cache = {}  # shared assets keyed by (asset class, code)
+
+    def asset(self, asset_type, item):
+        """Get the shared asset for a watchlist entry, creating it on first use"""
+        asset = make_asset(asset_type, item)
+        key = (type(asset), asset.code, getattr(asset, 'exchange_name', None))
+        return self._cache.setdefault(key, asset)
+
+    def add(self, monitor, items, asset_type=None):
+        """Add a section to the run
+
+        items are either assets or watchlist entries of asset_type
+        """
+        asset_type = asset_type or monitor.config.asset_type
+        assets = [i if isinstance(i, BaseAsset) else self.asset(asset_type, i) for i in items]
+        self.sections.append((monitor, assets))
+        return assets
+
+    def process(self, assets=None):
+        """Download all sections at once, then analyze and notify per section"""
+        if self.TEST:
+            logging.info('TEST mode')
+            for _, section_assets in self.sections:
+                section_assets[:] = section_assets[:2]
+
+        # Deduplicate by identity while keeping the original order
+        unique = list({id(a): a for _, section_assets in self.sections for a in section_assets}.values())
+
+        logging.info('-' * 50)
+        logging.info(f'Starting to process {len(unique)} assets in {len(self.sections)} sections')
+        start_time = time.time()
+
+        with self.profiler.stage('download'):
+            self._download_asset_data(unique)
+        self._distribute_results()
+        with self.profiler.stage('notify'):
+            self._generate_and_send_notification()
+        self.profiler.save()
+
+        total_time = time.time() - start_time
+        logging.info(f'Processing completed in {total_time:.2f} seconds')
+
+    def _distribute_results(self, sections=None):
+        """Hand the shared download results to each section's monitor in watchlist order"""
+        if sections is None:
+            sections = self.sections
+        succeeded = {id(a) for a in self.success}
+        skipped = {id(a) for a in self.skipped}
+        for monitor, section_assets in sections:
+            monitor.success = [a for a in section_assets if id(a) in succeeded]
+            monitor.skipped = [a for a in section_assets if id(a) in skipped]
+            monitor.failed = [a.code for a in section_assets if id(a) not in succeeded and id(a) not in skipped]
+
+    def _create_notification_content(self, sections=None):
+        """Concatenate the tables of all sections into one HTML message"""
+        if sections is None:
+            sections = self.sections
+        parts = []
+        for monitor, _ in sections:
+            html_table = monitor._create_notification_table()
+            if html_table:
+                parts.append(f'<h3>{monitor.config.subject_prefix}</h3>\n{html_table}')
+
+        if not parts:
+            return None
+
+        html_message = HTML_TEMPLATE.format('\n'.join(parts))
+        logging.debug(f'HTML content:\n{html_message}')
+        return html_message
+
+
+def main(watchlist):
+    '''
+    watchlist maps an asset type ('fund', 'stock' or 'crypto') to its list of codes.
+    测试：`TEST=1 python monitor_all.py [watchlist.json]`
+    '''
+    multi = MultiMonitor(calendar_file='calendar.json')
+    for asset_type, items in watchlist.items():
+        monitor_class, config = MONITORS[asset_type]
+        multi.add(monitor_class(config), items, asset_type)
+
+    multi.process()
+
+
+class TestMultiMonitor(unittest.TestCase):
+    def setUp(self):
+        self.multi = MultiMonitor()
+        self.multi.TEST = None
+        self.fund_monitor = Monitor(FUND_CONFIG)
+        self.crypto_config = MonitorConfig(
+            asset_type='crypto',
+            subject_prefix='加密货币小作手',
+            snapshot_file='test_multi_snapshot.json'
+        )
+        self.crypto_monitor = MonitorWithCriteria(self.crypto_config)
+
+    def tearDown(self):
+        if os.path.exists(self.crypto_config.snapshot_file):
+            os.remove(self.crypto_config.snapshot_file)
+
+    def test_make_asset(self):
+        self.assertIsInstance(make_asset('fund', '000961'), Fund)
+        self.assertIsInstance(make_asset('stock', 'NDX'), Stock)
+        crypto = make_asset('crypto', ['OKB/USDT', 'okx'])
+        self.assertEqual('okx', crypto.exchange_name)
+        self.assertRaises(ValueError, make_asset, 'bond', 'x')
+
+    def test_shared_assets(self):
+        a = self.multi.asset('fund', '000961')
+        self.assertIs(a, self.multi.asset('fund', '000961'))
+        self.assertIsNot(a, self.multi.asset('stock', '000961'))
+
+    def test_download_once_and_distribute(self):
+        shared = TestAsset('A', [1, 2, 3])
+        failed = TestAsset('B', [1], fail=True)
+        self.multi.add(self.fund_monitor, [shared, failed])
+        self.multi.add(self.crypto_monitor, [shared])
+        self.multi._download_asset_data([shared, failed])
+        self.multi._distribute_results()
+
+        self.assertEqual(1, shared.downloads)
+        self.assertEqual([shared], self.fund_monitor.success)
+        self.assertEqual(['B'], self.fund_monitor.failed)
+        self.assertEqual([shared], self.crypto_monitor.success)
+        self.assertEqual([], self.crypto_monitor.failed)
+
+    def test_consolidated_notification(self):
+        asset = TestAsset('A', [1, 2, 3])
+        asset.trade()
+        self.fund_monitor.success = [asset]
+        self.multi.sections = [(self.fund_monitor, [asset]), (self.crypto_monitor, [])]
+        html = self.multi._create_notification_content()
+        self.assertIn('<h3>基金小作手</h3>', html)
+        self.assertNotIn('加密货币小作手', html)
+        self.assertIn('Test Asset(A)', html)
+
+        self.fund_monitor.success = []
+        self.assertIsNone(self.multi._create_notification_content())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r', encoding='utf-8') as f:
+            watchlist = json.load(f)
+    else:
+        watchlist = WATCHLIST
+    main(watchlist)
@@ -12,7 +12,15 @@ class MonitorConfig:
             low_threshold=-500,
             high_threshold=1000,
             drawdown_threshold=0.2,
-            daily_change_threshold=0.1
+            daily_change_threshold=0.1,
+            low_rank_threshold=None,
+            high_rank_threshold=None,
+            rank_window=None,
+            calendar_file=None,
+            latency_budget=None,
+            risk_columns=None,
+            adaptive_quantiles=None,
+            sparklines=False
     ):
         self.asset_type = asset_type  # e.g. 'stock' or 'crypto'
         self.snapshot_file = snapshot_file
@@ -22,3 +30,23 @@ class MonitorConfig:
         self.high_threshold = high_threshold
         self.drawdown_threshold = drawdown_threshold
         self.daily_change_threshold = daily_change_threshold  # abs pct change vs previous close to trigger
+        # Percentile rank of the current price in the past rank_window days (None for the full history)
+        # e.g. 0.05 triggers when the price is lower than 95% of the history, None disables the criterion
+        self.low_rank_threshold = low_rank_threshold
+        self.high_rank_threshold = high_rank_threshold
+        self.rank_window = rank_window
+        # Json file of the last run time of each asset, set it to skip the assets
+        # whose market has not traded since their last run, see trading_calendar.py
+        self.calendar_file = calendar_file
+        # Seconds the downloads may take, the late assets are served from their archived history
+        # (see HISTORY_ARCHIVE) and downloaded in the background for the next run. None waits for all
+        self.latency_budget = latency_budget
+        # Names of risk.COLUMNS shown as extra columns of the email, e.g. ['volatility', 'from_high']
+        self.risk_columns = risk_columns
+        # Derive the thresholds of each asset from quantiles of its own history instead, e.g.
+        # {'low_threshold': 0.01, 'drawdown_threshold': 0.95, 'daily_change_threshold': 0.99},
+        # the other thresholds and the assets with a short history keep the values above
+        self.adaptive_quantiles = adaptive_quantiles
+        # Add an inline SVG chart of the price, its drawdown and the buy/sell signals to every row,
+        # see sparkline.py. Some web mail clients do not render inline SVG
+        self.sparklines = sparklines
@@ -1,68 +1,83 @@
 # -*- coding: UTF-8 -*-
+import gevent_patch  # noqa: F401, first of all, see gevent_patch.py
 from monitor_with_criteria import MonitorWithCriteria, MonitorConfig
 from crypto import Crypto
+from crypto_screener import CryptoScreener
+from history_archive import HistoryArchive
 
 
-def main_cryptos(symbols):
-    """Monitor crypto assets"""
-    config = MonitorConfig(
-        asset_type='crypto',
-        subject_prefix='加密货币小作手',
-        snapshot_file='crypto_snapshot.json',
-        drawdown_threshold=0.3
-    )
+CRYPTO_CONFIG = MonitorConfig(
+    asset_type='crypto',
+    subject_prefix='加密货币小作手',
+    snapshot_file='crypto_snapshot.json',
+    drawdown_threshold=0.3
+)
 
-    # Handle case where symbols is a list of tuples (symbol, exchange)
-    # or a simple list of symbols with default exchange
+CRYPTO_SYMBOLS = [
+    # Major cryptocurrencies
+    'BTC/USDT',     # Bitcoin
+    'ETH/USDT',     # Ethereum
+    ('BNB/USDT', 'binance'),     # Binance Coin (using OKX due to geo-restrictions)
+    'XRP/USDT',     # Ripple
+    'ADA/USDT',     # Cardano
+    'SOL/USDT',     # Solana
+    'DOGE/USDT',    # Dogecoin
+
+    # OKB from OKX exchange (native token)
+    ('OKB/USDT', 'okx'),     # OKB on OKX exchange
+
+    # Other symbols
+    # 'DOT/USDT',     # Polkadot
+    # 'MATIC/USDT',   # Polygon
+    # 'SHIB/USDT',    # Shiba Inu
+    # 'AVAX/USDT',    # Avalanche
+    # 'ATOM/USDT',    # Cosmos
+    'LINK/USDT',    # Chainlink
+    # 'UNI/USDT',     # Uniswap
+    'LTC/USDT',     # Litecoin
+    # # DeFi tokens
+    # 'AAVE/USDT',    # Aave
+    # 'COMP/USDT',    # Compound
+    # 'SUSHI/USDT',   # SushiSwap
+    # 'CRV/USDT',     # Curve
+    # 'YFI/USDT',     # Yearn Finance
+    # # Layer 2 and new projects
+    # 'ARB/USDT',     # Arbitrum
+    # 'OP/USDT',      # Optimism
+    # 'APT/USDT',     # Aptos
+    # 'SUI/USDT',     # Sui
+    # 'SEI/USDT',     # Sei
+]
+
+
+def create_cryptos(symbols):
+    """Create Crypto assets from a list of symbols
+
+    Handle case where symbols is a list of tuples (symbol, exchange) or
+    (symbol, exchange, timeframe), or a simple list of symbols with default exchange
+    """
     cryptos = []
     for item in symbols:
-        if isinstance(item, tuple):
-            symbol, exchange = item
-            cryptos.append(Crypto(symbol, exchange))
+        if isinstance(item, (tuple, list)):
+            cryptos.append(Crypto(*item))
         else:
-            symbol = item
-            cryptos.append(Crypto(symbol))
-
-    MonitorWithCriteria(config).process(cryptos)
+            cryptos.append(Crypto(item))
+    return cryptos
 
 
-if __name__ == '__main__':
-    # Crypto symbols - can be simple strings or (symbol, exchange) tuples
-    crypto_symbols = [
-        # Major cryptocurrencies
-        'BTC/USDT',     # Bitcoin
-        'ETH/USDT',     # Ethereum
-        ('BNB/USDT', 'binance'),     # Binance Coin (using OKX due to geo-restrictions)
-        'XRP/USDT',     # Ripple
-        'ADA/USDT',     # Cardano
-        'SOL/USDT',     # Solana
-        'DOGE/USDT',    # Dogecoin
+def main_cryptos(symbols, archive_dir='crypto_history'):
+    """Monitor crypto assets
 
-        # OKB from OKX exchange (native token)
-        ('OKB/USDT', 'okx'),     # OKB on OKX exchange
+    Only the symbols whose ticker price could change their signal are processed,
+    see CryptoScreener. Their histories are kept in archive_dir between runs.
+    """
+    screener = CryptoScreener(CRYPTO_CONFIG, HistoryArchive(archive_dir))
+    cryptos = screener.screen(create_cryptos(symbols))
+    monitor = MonitorWithCriteria(CRYPTO_CONFIG)
+    monitor.process(cryptos)
+    screener.update(monitor.success)
 
-        # Other symbols
-        # 'DOT/USDT',     # Polkadot
-        # 'MATIC/USDT',   # Polygon
-        # 'SHIB/USDT',    # Shiba Inu
-        # 'AVAX/USDT',    # Avalanche
-        # 'ATOM/USDT',    # Cosmos
-        'LINK/USDT',    # Chainlink
-        # 'UNI/USDT',     # Uniswap
-        'LTC/USDT',     # Litecoin
-        # # DeFi tokens
-        # 'AAVE/USDT',    # Aave
-        # 'COMP/USDT',    # Compound
-        # 'SUSHI/USDT',   # SushiSwap
-        # 'CRV/USDT',     # Curve
-        # 'YFI/USDT',     # Yearn Finance
-        # # Layer 2 and new projects
-        # 'ARB/USDT',     # Arbitrum
-        # 'OP/USDT',      # Optimism
-        # 'APT/USDT',     # Aptos
-        # 'SUI/USDT',     # Sui
-        # 'SEI/USDT',     # Sei
-    ]
 
+if __name__ == '__main__':
     print("Monitoring cryptos...")
-    main_cryptos(crypto_symbols)  # Default exchange for simple symbols
\ No newline at end of file
+    main_cryptos(CRYPTO_SYMBOLS)  # Default exchange for simple symbols
@@ -0,0 +1,413 @@
+# -*- coding: UTF-8 -*-
+import gevent_patch  # noqa: F401, first of all, see gevent_patch.py
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import tempfile
+import unittest
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import monitor_all
+import result_cache
+import adaptive_thresholds
+import sparkline
+from base_asset import BaseAsset
+from monitor_all import MultiMonitor, MONITORS, WATCHLIST
+from work_queue import WorkQueue, Heartbeat
+
+
+def compact_result(asset, rank_windows=(), quantiles=(), sparklines=()):
+    '''Everything the coordinator needs to filter and format an asset, without its history
+
+    quantiles are the MonitorConfig.adaptive_quantiles of the monitors of the asset, their
+    thresholds need the whole history so they are computed by the worker. So are the charts
+    of the monitors with MonitorConfig.sparklines, given as [low_threshold, high_threshold,
+    adaptive_quantiles] and keyed by the thresholds they are drawn with.
+    '''
+    charts = {}
+    for low, high, chart_quantiles in sparklines:
+        thresholds = (chart_quantiles and asset.adaptive_thresholds(chart_quantiles)) or {}
+        low, high = thresholds.get('low_threshold', low), thresholds.get('high_threshold', high)
+        charts[sparkline.chart_key(low, high)] = asset.sparkline(low, high)
+    return {
+        'code': asset.code,
+        'name': asset.name,
+        'N': asset.N,
+        'mdd': asset.mdd,
+        'cur': asset.cur,
+        'rank': asset.rank,
+        'ranks': {str(w): asset.percentile_rank(w) for w in rank_windows},
+        'trading': asset.trading,
+        'length': len(asset.worth),
+        'worth': asset.worth[-2:],
+        'dates': asset.dates[-2:],
+        'was_at_high_yesterday': asset.was_at_high_yesterday,
+        'risk': asset.risk_metrics(),
+        'thresholds': {adaptive_thresholds.quantiles_key(q): asset.adaptive_thresholds(q) for q in quantiles},
+        'sparklines': charts,
+    }
+
+
+class ResultAsset(BaseAsset):
+    """An asset processed by a worker, rebuilt from its compact result"""
+    def __init__(self, result):
+        super().__init__(result['code'])
+        self.result = result
+        self.name = result['name']
+        self.N = result['N']
+        self.mdd = result['mdd']
+        self.cur = result['cur']
+        self.rank = result['rank']
+        self.trading = result['trading']
+        self.worth = result['worth']
+        self.dates = result['dates']
+
+    @property
+    def is_at_historical_high(self):
+        return self.result['length'] > 0 and self.N == self.result['length'] - 1
+
+    @property
+    def is_at_historical_low(self):
+        return self.result['length'] > 1 and self.N == -(self.result['length'] - 1)
+
+    @property
+    def was_at_high_yesterday(self):
+        return self.result['was_at_high_yesterday']
+
+    def percentile_rank(self, window=None):
+        return self.rank if window is None else self.result['ranks'][str(window)]
+
+    def risk_metrics(self):
+        return self.result['risk']
+
+    def adaptive_thresholds(self, quantiles):
+        key = adaptive_thresholds.quantiles_key(quantiles)
+        if key not in self.result['thresholds']:
+            logging.warning(f'No adaptive thresholds of {self.code} for {key}, the config ones are used')
+        return self.result['thresholds'].get(key)
+
+    def sparkline(self, low_threshold, high_threshold):
+        key = sparkline.chart_key(low_threshold, high_threshold)
+        if key not in self.result['sparklines']:
+            logging.warning(f'No chart of {self.code} for the thresholds {key}')
+        return self.result['sparklines'].get(key, '')
+
+    def download(self):
+        raise RuntimeError('{0} has been processed by a worker'.format(self.code))
+
+
+def asset_key(asset_type, asset):
+    return '{0}|{1}|{2}'.format(asset_type, asset.code, getattr(asset, 'exchange_name', ''))
+
+
+def run_worker(queue, worker=None, batch=5, lease=300, idle_exit=60, poll=2, run_id=None):
+    '''Process tasks until the queue has been empty for idle_exit seconds
+
+    Each task is a watchlist entry, the asset is created, traded and its compact result
+    pushed back. A failed trade is given back to the queue to be retried by any worker.
+    '''
+    worker = worker or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    idle_since = time.time()
+    processed = 0
+    while True:
+        tasks = queue.lease(worker, n=batch, duration=lease, run_id=run_id)
+        if not tasks:
+            if time.time() - idle_since >= idle_exit:
+                break
+            time.sleep(poll)
+            continue
+
+        # renew the leases for as long as the batch takes, prefetching included
+        with Heartbeat(queue, worker, tasks, lease) as heartbeat:
+            assets = [monitor_all.make_asset(t.payload['type'], t.payload['item']) for t in tasks]
+            classes = list(dict.fromkeys(type(a) for a in assets))
+            for cls in classes:
+                try:
+                    cls.prefetch([a for a in assets if type(a) is cls])
+                except Exception:
+                    logging.exception(f'Failed to prefetch {cls.__name__} assets')
+
+            def process(pair):
+                task, asset = pair
+                try:
+                    asset.trade()
+                except Exception as e:
+                    logging.exception(f'Failed to process asset {asset.code}')
+                    heartbeat.done(task)
+                    queue.fail(task, worker, e)
+                    return
+                payload = task.payload
+                result = compact_result(asset, payload.get('rank_windows', []), payload.get('quantiles', []),
+                                        payload.get('sparklines', []))
+                heartbeat.done(task)
+                if not queue.complete(task, worker, result):
+                    logging.warning(f'The lease of {task.key} has been taken over by another worker')
+
+            try:
+                with ThreadPoolExecutor(max_workers=batch) as executor:
+                    list(executor.map(process, zip(tasks, assets)))
+            finally:
+                for cls in classes:
+                    cls.release()
+        processed += len(tasks)
+        idle_since = time.time()
+    result_cache.default_cache.save()
+    logging.info(f'Worker {worker} processed {processed} tasks')
+    return processed
+
+
+class DistributedMonitor(MultiMonitor):
+    '''Coordinator of a run whose assets are traded by workers on other processes or machines
+
+    The assets of all sections are enqueued as one run. The workers lease them, so a dead
+    worker's assets are retried by another one. Once the run is finished or timeout seconds
+    have passed, the compact results are filtered and notified by the section monitors as
+    in MultiMonitor. The snapshots are only read and written by the coordinator.
+    '''
+    def __init__(self, queue, run_id=None, timeout=1800, poll=5, subject_prefix='小作手'):
+        super().__init__(subject_prefix)
+        self.queue = queue
+        # unique even for coordinators started in the same second on other machines
+        self.run_id = run_id or '{0}-{1}'.format(datetime.now().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+        self.timeout = timeout
+        self.poll = poll
+        self._tasks = {}  # key -> payload
+        self._keys = {}  # id(asset) -> key
+
+    def add(self, monitor, items, asset_type=None):
+        asset_type = asset_type or monitor.config.asset_type
+        assets = super().add(monitor, items, asset_type)
+        for asset, item in zip(assets, items):
+            key = asset_key(asset_type, asset)
+            self._keys[id(asset)] = key
+            payload = self._tasks.setdefault(
+                key, {'type': asset_type, 'item': item, 'rank_windows': [], 'quantiles': [], 'sparklines': []})
+            if monitor.config.rank_window is not None and monitor.config.rank_window not in payload['rank_windows']:
+                payload['rank_windows'].append(monitor.config.rank_window)
+            quantiles = monitor.config.adaptive_quantiles
+            if quantiles and quantiles not in payload['quantiles']:
+                payload['quantiles'].append(quantiles)
+            chart = [monitor.config.low_threshold, monitor.config.high_threshold, quantiles]
+            if monitor.config.sparklines and chart not in payload['sparklines']:
+                payload['sparklines'].append(chart)
+        return assets
+
+    def enqueue(self):
+        """Put the assets of all sections in the queue, only once even if called again"""
+        keys = self._run_keys()
+        self.queue.enqueue(self.run_id, {k: v for k, v in self._tasks.items() if k in keys})
+        logging.info(f'Enqueued {len(keys)} assets as run {self.run_id}')
+
+    def process(self, assets=None, local_worker=False):
+        """Enqueue, wait for the workers (or do the work in this process), then notify"""
+        if self.TEST:
+            logging.info('TEST mode')
+            for _, section_assets in self.sections:
+                section_assets[:] = section_assets[:2]
+
+        start_time = time.time()
+        self.enqueue()
+        if local_worker:
+            run_worker(self.queue, run_id=self.run_id, idle_exit=0)
+        while not self.queue.is_finished(self.run_id) and time.time() - start_time < self.timeout:
+            time.sleep(self.poll)
+
+        self._collect_results()
+        self._distribute_results()
+        self._generate_and_send_notification()
+        logging.info(f'Run {self.run_id} completed in {time.time() - start_time:.2f} seconds')
+
+    def _run_keys(self):
+        return {self._keys[id(a)] for _, section_assets in self.sections for a in section_assets}
+
+    def _collect_results(self):
+        """Replace the assets done by the workers by their results, the others have failed"""
+        done, failed = self.queue.results(self.run_id)
+        unfinished = sorted(self._run_keys() - set(done) - set(failed))
+        results = {key: ResultAsset(result) for key, result in done.items()}
+        for _, section_assets in self.sections:
+            section_assets[:] = [results.get(self._keys.get(id(a)), a) for a in section_assets]
+        self.success = list(results.values())
+        for key, error in failed.items():
+            logging.error(f'{key} failed: {error}')
+        if unfinished:
+            logging.error(f'{len(unfinished)} assets are not done after {self.timeout}s: {unfinished}')
+        logging.info(f'Success: {len(done)}, Failed: {len(failed) + len(unfinished)}')
+
+
+def main(role, queue_path, watchlist=WATCHLIST):
+    '''
+    协调者把关注列表放入队列，各台机器上的工作者下载并分析，协调者汇总后过滤并发送邮件。
+    队列是一个SQLite文件，可以放在共享磁盘上。
+    `python monitor_distributed.py coordinator queue.db [watchlist.json]`
+    `python monitor_distributed.py worker queue.db`
+    '''
+    queue = WorkQueue(queue_path)
+    if role == 'worker':
+        run_worker(queue)
+        return
+    coordinator = DistributedMonitor(queue)
+    for asset_type, items in watchlist.items():
+        monitor_class, config = MONITORS[asset_type]
+        coordinator.add(monitor_class(config), items, asset_type)
+    coordinator.process()
+
+
+class TestDistributedMonitor(unittest.TestCase):
+    def setUp(self):
+        from unittest import mock
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from monitor_with_criteria import MonitorWithCriteria
+        from base_asset import TestAsset
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = WorkQueue(os.path.join(self.tmp.name, 'queue.db'))
+        series = {'A': [1, 2, 3], 'B': [3, 2, 1, 1.5], 'C': None}
+
+        def make_asset(asset_type, item):
+            asset = TestAsset(item, series[item] or [], fail=series[item] is None)
+            asset.result_cache = None
+            return asset
+
+        patcher = mock.patch('monitor_all.make_asset', make_asset)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fund_monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='基金小作手'))
+        self.crypto_config = MonitorConfig(asset_type='crypto', subject_prefix='加密货币小作手',
+                                           snapshot_file=os.path.join(self.tmp.name, 'snapshot.json'),
+                                           low_rank_threshold=0.1, rank_window=2)
+        self.crypto_monitor = MonitorWithCriteria(self.crypto_config)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compact_result(self):
+        from base_asset import TestAsset
+        asset = TestAsset('B', [5, 3, 2, 1, 1.5])
+        asset.result_cache = None
+        asset.trade()
+        result = ResultAsset(json.loads(json.dumps(compact_result(asset, [2]))))
+        for kwargs in [{}, {'low_rank_threshold': 0.6, 'rank_window': 2}]:
+            self.assertEqual(asset.format_with_config(**kwargs), result.format_with_config(**kwargs))
+        for name in ['current_price', 'daily_change_pct', 'is_at_historical_high', 'is_at_historical_low',
+                     'was_at_high_yesterday']:
+            self.assertEqual(getattr(asset, name), getattr(result, name), name)
+        self.assertEqual(asset.risk_metrics(), result.risk_metrics())
+
+    def test_adaptive_thresholds(self):
+        import random
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        random.seed(4)
+        quantiles = {'daily_change_threshold': 0.99, 'low_threshold': 0.01}
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', adaptive_quantiles=quantiles))
+        asset = TestAsset('A', [1 + random.random() for _ in range(300)])
+        asset.result_cache = None
+        asset.trade()
+        # through the payload of the coordinator and the json of the queue
+        coordinator = DistributedMonitor(self.queue, run_id='r1')
+        coordinator.add(monitor, ['A'], 'fund')
+        payload = json.loads(json.dumps(coordinator._tasks['fund|A|']))
+        result = ResultAsset(json.loads(json.dumps(compact_result(asset, quantiles=payload['quantiles']))))
+        config = monitor._config_for(result)
+        self.assertIsNot(monitor.config, config)
+        self.assertEqual(monitor._config_for(asset).__dict__, config.__dict__)
+        self.assertNotEqual(0.1, config.daily_change_threshold)
+        # quantiles the worker was not asked for
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(result.adaptive_thresholds({'high_threshold': 0.99}))
+
+    def test_sparklines(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', sparklines=True, low_threshold=-1))
+        coordinator = DistributedMonitor(self.queue, run_id='r1', timeout=0, poll=0)
+        coordinator.TEST = '1'  # no email
+        coordinator.add(monitor, ['B'], 'fund')
+        coordinator.enqueue()
+        run_worker(WorkQueue(self.queue.path), worker='w1', idle_exit=0)
+        coordinator.process()
+        self.assertIsInstance(monitor.success[0], ResultAsset)
+        # drawn by the worker from the whole history, the coordinator only has the last prices
+        self.assertEqual(2, len(monitor.success[0].worth))
+        html = monitor._create_notification_table()
+        self.assertIn('<td style="text-align: right;"><svg', html)
+        self.assertIn('<circle', html)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual('', monitor.success[0].sparkline(-2, 1000))
+
+    def test_slow_batch(self):
+        '''A batch slower than its lease is not taken over by another worker'''
+        import threading
+        from unittest import mock
+        from base_asset import TestAsset
+
+        def make_asset(asset_type, item):
+            asset = TestAsset(item, [1, 2], delay=1)
+            asset.result_cache = None
+            return asset
+
+        self.queue.enqueue('r1', {'fund|A|': {'type': 'fund', 'item': 'A'}})
+        with mock.patch('monitor_all.make_asset', make_asset):
+            thread = threading.Thread(target=run_worker, args=(self.queue,),
+                                      kwargs={'worker': 'w1', 'lease': 0.3, 'idle_exit': 0})
+            thread.start()
+            time.sleep(0.6)
+            self.assertEqual([], self.queue.lease('w2', run_id='r1'))
+            thread.join()
+        done, _ = self.queue.results('r1')
+        self.assertEqual(1, done['fund|A|']['N'])
+        self.assertEqual({'done': 1}, self.queue.counts('r1'))
+
+    def test_run(self):
+        coordinator = DistributedMonitor(self.queue, run_id='r1', timeout=0, poll=0)
+        coordinator.TEST = '1'  # no email
+        coordinator.add(self.fund_monitor, ['A', 'C'], 'fund')
+        coordinator.add(self.crypto_monitor, ['B'], 'crypto')
+        self.assertEqual(3, len(coordinator._tasks))
+
+        coordinator.enqueue()
+        worker_queue = WorkQueue(self.queue.path, max_attempts=1)  # C fails on its only attempt
+        run_worker(worker_queue, worker='w1', idle_exit=0)
+        coordinator.process()
+        self.assertEqual(['A'], [a.code for a in self.fund_monitor.success])
+        self.assertEqual(['C'], self.fund_monitor.failed)
+        self.assertEqual(['B'], [a.code for a in self.crypto_monitor.success])
+        self.assertIsInstance(self.crypto_monitor.success[0], ResultAsset)
+        self.assertEqual({'done': 2, 'failed': 1}, self.queue.counts('r1'))
+
+    def test_dead_worker(self):
+        queue = WorkQueue(self.queue.path, max_attempts=1)
+        coordinator = DistributedMonitor(queue, timeout=30, poll=0.05)
+        coordinator.TEST = '1'
+        coordinator.add(self.fund_monitor, ['A'], 'fund')
+        coordinator.enqueue()
+        queue.lease('w1', duration=0.2)  # and dies
+        start = time.time()
+        coordinator.process()
+        self.assertLess(time.time() - start, 5)  # not the timeout
+        self.assertEqual(['A'], self.fund_monitor.failed)
+        self.assertEqual({'failed': 1}, queue.counts(coordinator.run_id))
+        self.assertNotEqual(coordinator.run_id, DistributedMonitor(queue).run_id)
+
+    def test_local_worker(self):
+        coordinator = DistributedMonitor(self.queue, run_id='r2', timeout=0, poll=0)
+        coordinator.TEST = '1'
+        coordinator.add(self.fund_monitor, ['A', 'B'], 'fund')
+        coordinator.process(local_worker=True)
+        self.assertEqual([1, 2], sorted(a.N for a in self.fund_monitor.success))
+
+
+if __name__ == '__main__':
+    logging.info('usage: python monitor_distributed.py coordinator|worker queue.db [watchlist.json]')
+    watchlist = WATCHLIST
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'r', encoding='utf-8') as f:
+            watchlist = json.load(f)
+    main(sys.argv[1], sys.argv[2], watchlist)
@@ -0,0 +1,175 @@
+# -*- coding: UTF-8 -*-
+import gevent_patch  # noqa: F401, first of all, see gevent_patch.py
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import unittest
+
+import utils
+from base_asset import BaseAsset, TestAsset
+from monitor_all import MultiMonitor, MONITORS
+
+
+class Subscriber:
+    """A subscription profile: who receives the email, what to watch and with which thresholds"""
+    def __init__(self, name, receivers, watchlist, thresholds=None):
+        self.name = name
+        self.receivers = receivers  # list of email addresses
+        self.watchlist = watchlist  # asset type -> list of codes, same format as monitor_all.WATCHLIST
+        self.thresholds = thresholds or {}  # asset type -> MonitorConfig attributes to override
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['name'], d['receivers'], d['watchlist'], d.get('thresholds'))
+
+    def config(self, asset_type):
+        """Create the MonitorConfig of asset_type with this subscriber's overrides
+
+        Every subscriber has its own snapshot file so that notification
+        deduplication is tracked per subscriber.
+        """
+        _, base = MONITORS[asset_type]
+        config = copy.copy(base)
+        directory, filename = os.path.split(base.snapshot_file)
+        config.snapshot_file = os.path.join(directory, f'{self.name}_{filename}')
+        for key, value in self.thresholds.get(asset_type, {}).items():
+            if not hasattr(config, key):
+                raise ValueError(f'Unknown config {key} for subscriber {self.name}')
+            setattr(config, key, value)
+        return config
+
+
+class SubscriptionMonitor(MultiMonitor):
+    """Monitor the watchlists of many subscribers in one run
+
+    The union of all watchlists is downloaded once, then every subscriber's
+    criteria are evaluated against the shared results and the emails are sent
+    in parallel over a small pool of authenticated SMTP connections.
+    """
+
+    def __init__(self, subscribers=(), max_workers=3):
+        super().__init__()
+        self.max_workers = max_workers  # number of SMTP connections used in parallel
+        self.subscribers = []  # list of (subscriber, sections)
+        for subscriber in subscribers:
+            self.subscribe(subscriber)
+
+    def subscribe(self, subscriber):
+        sections = []
+        for asset_type, items in subscriber.watchlist.items():
+            monitor_class, _ = MONITORS[asset_type]
+            monitor = monitor_class(subscriber.config(asset_type))
+            assets = [i if isinstance(i, BaseAsset) else self.asset(asset_type, i) for i in items]
+            sections.append((monitor, assets))
+        self.subscribers.append((subscriber, sections))
+        return sections
+
+    def process(self, assets=None):
+        """Download the union of all watchlists once and notify every subscriber"""
+        if self.TEST:
+            logging.info('TEST mode')
+            for _, sections in self.subscribers:
+                for _, section_assets in sections:
+                    section_assets[:] = section_assets[:2]
+
+        # Deduplicate by identity while keeping the original order
+        unique = list({
+            id(a): a
+            for _, sections in self.subscribers
+            for _, section_assets in sections
+            for a in section_assets}.values())
+
+        logging.info('-' * 50)
+        logging.info(f'Starting to process {len(unique)} assets for {len(self.subscribers)} subscribers')
+        start_time = time.time()
+
+        with self.profiler.stage('download'):
+            self._download_asset_data(unique)
+        with self.profiler.stage('notify'):
+            messages = self._create_messages()
+            self._send_notifications(messages)
+        self.profiler.save()
+
+        total_time = time.time() - start_time
+        logging.info(f'Processing completed in {total_time:.2f} seconds')
+
+    def _create_messages(self):
+        """Render one email per subscriber who has something to be notified about"""
+        messages = []
+        for subscriber, sections in self.subscribers:
+            logging.info(f'Creating notification for subscriber {subscriber.name}')
+            self._distribute_results(sections)
+            html_message = self._create_notification_content(sections)
+            if html_message:
+                messages.append((subscriber.receivers, self.subject, html_message, 'html'))
+        return messages
+
+    def _send_notifications(self, messages):
+        if not messages:
+            logging.info('No notification needed - no interesting assets found')
+            return
+        if self.TEST:
+            logging.info(f'Skipping {len(messages)} email notifications in test mode')
+            return
+
+        failed = utils.send_emails(messages, max_workers=self.max_workers)
+        logging.info(f'Sent {len(messages) - len(failed)} email notifications, failed: {len(failed)}')
+
+
+def main(subscribers):
+    '''
+    subscribers是订阅者的列表，每个订阅者有自己的关注列表和阈值。
+    测试：`TEST=1 python monitor_subscribers.py subscribers.json`
+    '''
+    SubscriptionMonitor(subscribers).process()
+
+
+class TestSubscriptionMonitor(unittest.TestCase):
+    def setUp(self):
+        self.alice = Subscriber('test_alice', ['alice@example.com'], {'fund': ['A', 'B']})
+        self.bob = Subscriber(
+            'test_bob', ['bob@example.com'], {'fund': ['B']},
+            thresholds={'fund': {'low_threshold': -10}})
+        self.monitor = SubscriptionMonitor([self.alice, self.bob])
+        self.monitor.TEST = None
+
+    def test_config_overrides(self):
+        config = self.bob.config('fund')
+        self.assertEqual(-10, config.low_threshold)
+        self.assertEqual('test_bob_fund_snapshot.json', config.snapshot_file)
+        # the shared config is left untouched
+        self.assertEqual(-300, MONITORS['fund'][1].low_threshold)
+        self.assertRaises(ValueError, Subscriber('x', [], {}, {'fund': {'foo': 1}}).config, 'fund')
+        from unittest import mock
+        with mock.patch.object(MONITORS['fund'][1], 'snapshot_file', os.path.join('state', 'fund.json')):
+            self.assertEqual(os.path.join('state', 'test_bob_fund.json'), self.bob.config('fund').snapshot_file)
+
+    def test_shared_downloads(self):
+        (_, [(_, alice_assets)]), (_, [(_, bob_assets)]) = self.monitor.subscribers
+        self.assertIs(alice_assets[1], bob_assets[0])
+
+    def test_messages_per_subscriber(self):
+        a = TestAsset('A', [3, 2, 1])
+        b = TestAsset('B', [1, 2, 3])
+        self.monitor.subscribers = []
+        self.monitor.subscribe(Subscriber('test_alice', ['alice@example.com'], {'fund': [a, b]}))
+        self.monitor.subscribe(Subscriber('test_bob', ['bob@example.com'], {'fund': [b]}))
+
+        self.monitor._download_asset_data([a, b])
+        messages = self.monitor._create_messages()
+        self.assertEqual(2, len(messages))
+        (alice_receivers, _, alice_html, _), (bob_receivers, _, bob_html, _) = messages
+        self.assertEqual(['alice@example.com'], alice_receivers)
+        self.assertIn('Test Asset(A)', alice_html)
+        self.assertIn('Test Asset(B)', alice_html)
+        self.assertEqual(['bob@example.com'], bob_receivers)
+        self.assertNotIn('Test Asset(A)', bob_html)
+        self.assertIn('Test Asset(B)', bob_html)
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'subscribers.json', 'r', encoding='utf-8') as f:
+        main([Subscriber.from_dict(d) for d in json.load(f)])
@@ -9,6 +9,37 @@ from monitor import Monitor
 from monitor_config import MonitorConfig
 
 
+def check_criteria(s, config):
+    """The first criterion of config met by an asset as (name, description), None if there is none"""
+    # 0. large single-day move (>= configured threshold vs previous close)
+    day_change = s.daily_change_pct
+    if abs(day_change) >= config.daily_change_threshold:
+        return 'daily_change', f"{s.code} triggered daily move {day_change:.2%} (threshold {config.daily_change_threshold:.0%})"
+
+    # Use config thresholds for different conditions
+    # 1. lower than the past N days
+    if s.N < config.low_threshold:
+        return 'low', f"{s.code} triggered low threshold: N={s.N} < {config.low_threshold}"
+    # 2. drawdown is greater than threshold
+    if s.cur > config.drawdown_threshold:
+        return 'drawdown', f"{s.code} triggered drawdown threshold: {s.cur:.2%} > {config.drawdown_threshold:.0%}"
+    # 3. higher than the past N days
+    if s.N > config.high_threshold:
+        return 'high', f"{s.code} triggered high threshold: N={s.N} > {config.high_threshold}"
+    # 4. reached the highest price
+    if s.is_at_historical_high:
+        return 'historical_high', f"{s.code} hit historical high: N={s.N}"
+    # 5. percentile rank of the price in the past rank_window days
+    if config.low_rank_threshold is not None or config.high_rank_threshold is not None:
+        rank = s.rank if config.rank_window is None else s.percentile_rank(config.rank_window)
+        if rank is not None:
+            if config.low_rank_threshold is not None and rank <= config.low_rank_threshold:
+                return 'low_rank', f"{s.code} triggered low rank threshold: {rank:.2%} <= {config.low_rank_threshold:.0%}"
+            if config.high_rank_threshold is not None and rank >= config.high_rank_threshold:
+                return 'high_rank', f"{s.code} triggered high rank threshold: {rank:.2%} >= {config.high_rank_threshold:.0%}"
+    return None
+
+
 class MonitorWithCriteria(Monitor):
     def __init__(self, config):
         super().__init__(config)  # Pass config to base class
@@ -49,6 +80,7 @@ class MonitorWithCriteria(Monitor):
             snapshot[s.code]['datetime'] = now.strftime(date_format)
             snapshot[s.code]['N'] = s.N
             snapshot[s.code]['cur'] = s.cur
+            snapshot[s.code]['rank'] = s.rank
             snapshot[s.code]['trading'] = s.trading
             snapshot[s.code]['current_price'] = s.current_price
 
@@ -56,29 +88,9 @@ class MonitorWithCriteria(Monitor):
             # Check if asset is trading
             if not s.trading:
                 return False
-
-            # 0. large single-day move (>= configured threshold vs previous close)
-            day_change = s.daily_change_pct
-            if abs(day_change) >= self.config.daily_change_threshold:
-                logging.info(f"{s.code} triggered daily move {day_change:.2%} (threshold {self.config.daily_change_threshold:.0%})")
-                return True
-
-            # Use config thresholds for different conditions
-            # 1. lower than the past N days
-            if s.N < self.config.low_threshold:
-                logging.info(f"{s.code} triggered low threshold: N={s.N} < {self.config.low_threshold}")
-                return True
-            # 2. drawdown is greater than threshold
-            if s.cur > self.config.drawdown_threshold:
-                logging.info(f"{s.code} triggered drawdown threshold: {s.cur:.2%} > {self.config.drawdown_threshold:.0%}")
-                return True
-            # 3. higher than the past N days
-            if s.N > self.config.high_threshold:
-                logging.info(f"{s.code} triggered high threshold: N={s.N} > {self.config.high_threshold}")
-                return True
-            # 4. reached the highest price
-            if s.is_at_historical_high:
-                logging.info(f"{s.code} hit historical high: N={s.N} == {len(s.worth) - 1}")
+            triggered = check_criteria(s, self._config_for(s))
+            if triggered is not None:
+                logging.info(triggered[1])
                 return True
             return False
 
@@ -192,6 +204,27 @@ class MonitorWithCriteriaTestCase:
         results = self.monitor.filter_sort()
         self.assertEqual([asset], results)
 
+    def test_rank_threshold(self):
+        """Asset ranked below the low rank threshold should be interesting"""
+        asset = self.create_asset()
+        asset.worth = [50, 40, 60, 45, 30, 55, 43, 41]
+        asset.N = -1
+        self._ensure_trading(asset)  # the current price becomes 42
+        asset.rank = asset.percentile_rank()
+
+        self.monitor.success = [asset]
+        self.assertEqual([], self.monitor.filter_sort())
+
+        self.config.low_rank_threshold = 0.3  # 42 is higher than 2 of the 7 prices before
+        asset.worth[-1] += 1  # keep trading
+        self.assertEqual([asset], self.monitor.filter_sort())
+
+        # only the last 2 days are considered when rank_window=2
+        self.config.rank_window = 2
+        self.config.notification_days = 0
+        asset.worth[-1] += 1
+        self.assertEqual([], self.monitor.filter_sort())
+
     def test_notification_deduplication(self):
         """Should not notify twice within notification period"""
         asset = self.create_asset()
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+from bisect import bisect_left, bisect_right
+
+
+class RankIndex:
+    """Order statistics over a multiset of prices
+
+    Prices are coordinate-compressed against a known universe of values (e.g. the
+    whole history of an asset) and counted in a Fenwick tree, so insert, remove and
+    rank queries are all O(log n). Queries accept any price, not only the ones in
+    the universe, which is how today's intraday price is ranked.
+    """
+    def __init__(self, universe, values=()):
+        self._values = sorted(set(universe))
+        self._tree = [0] * (len(self._values) + 1)
+        self.size = 0
+        for v in values:
+            self.add(v)
+
+    def __len__(self):
+        return self.size
+
+    def _position(self, value):
+        i = bisect_left(self._values, value)
+        if i == len(self._values) or self._values[i] != value:
+            raise KeyError('{0} is not in the universe of this index'.format(value))
+        return i + 1
+
+    def _update(self, value, delta):
+        i = self._position(value)
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+        self.size += delta
+
+    def _prefix(self, i):
+        """Number of elements among the i smallest values of the universe"""
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, value):
+        self._update(value, 1)
+
+    def remove(self, value):
+        self._update(value, -1)
+
+    def count_less(self, value):
+        """Number of elements strictly lower than value"""
+        return self._prefix(bisect_left(self._values, value))
+
+    def count_less_equal(self, value):
+        """Number of elements lower than or equal to value"""
+        return self._prefix(bisect_right(self._values, value))
+
+    def percentile(self, value):
+        """Fraction of elements strictly lower than value: 0 means a new low, 1 a new high"""
+        if not self.size:
+            return None
+        return self.count_less(value) / self.size
+
+
+def percentile_ranks(worth, window=None):
+    '''The percentile rank of every day's price among the previous `window` days (the full history if None)
+
+    Return a list of the same length as worth, the first element is None since there is no history.
+    It is evaluated incrementally, so a backtest over n days costs O(n log n).
+    '''
+    index = RankIndex(worth)
+    ranks = []
+    for i, price in enumerate(worth):
+        ranks.append(index.percentile(price))
+        index.add(price)
+        if window is not None and i >= window:
+            index.remove(worth[i - window])
+    return ranks
+
+
+class TestRankIndex(unittest.TestCase):
+    def test_rank(self):
+        index = RankIndex([1, 2, 2, 3, 5], [1, 2, 2, 3])
+        self.assertEqual(4, len(index))
+        self.assertEqual(0, index.count_less(1))
+        self.assertEqual(1, index.count_less(2))
+        self.assertEqual(3, index.count_less_equal(2))
+        # values outside of the universe can be queried
+        self.assertEqual(3, index.count_less(2.5))
+        self.assertEqual(4, index.count_less(100))
+        self.assertEqual(0, index.percentile(0.5))
+        self.assertEqual(1, index.percentile(4))
+        index.remove(2)
+        self.assertEqual(2, index.count_less_equal(2))
+        self.assertRaises(KeyError, index.add, 4)
+        self.assertIsNone(RankIndex([]).percentile(1))
+
+    def test_percentile_ranks(self):
+        self.assertEqual([], percentile_ranks([]))
+        self.assertEqual([None, 1, 0, 2/3], percentile_ranks([2, 3, 1, 2.5]))
+        self.assertEqual([None, 1, 0, 0.5], percentile_ranks([2, 3, 1, 2.5], window=2))
+        self.assertEqual([None, 1, 0, 1], percentile_ranks([2, 3, 1, 2.5], window=1))
+
+        random.seed(0)
+        worth = [random.randint(1, 20) for _ in range(200)]
+        for window in [None, 1, 5, 50]:
+            expected = [None]
+            for i in range(1, len(worth)):
+                history = worth[:i] if window is None else worth[max(i - window, 0):i]
+                expected.append(sum(1 for w in history if w < worth[i]) / len(history))
+            self.assertEqual(expected, percentile_ranks(worth, window))
@@ -0,0 +1,371 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+
+import numpy as np
+
+from trading_calendar import MARKETS, Market
+
+
+DAY_MS = 24 * 60 * 60 * 1000
+# Trading days are counted in UTC+8, see base_asset.TIMEZONE
+OFFSET_MS = 8 * 60 * 60 * 1000
+
+
+def to_days(timestamps):
+    """Convert timestamps in milliseconds into trading day numbers (days since 1970-01-01)"""
+    return (np.asarray(timestamps, dtype=np.int64) + OFFSET_MS) // DAY_MS
+
+
+def streak_series(worth):
+    """N of every day as if the history ended on that day, see BaseAsset.buy_or_sell
+
+    Monotonic stacks find the last previous price that is not lower (or not higher),
+    so the whole series costs O(n) instead of O(n²).
+    """
+    N = [0] * len(worth)
+    higher = []  # indices of prices not lower than the ones after them
+    lower = []  # indices of prices not higher than the ones after them
+    for i, price in enumerate(worth):
+        while higher and worth[higher[-1]] < price:
+            higher.pop()
+        while lower and worth[lower[-1]] > price:
+            lower.pop()
+        above = i - (higher[-1] if higher else -1) - 1
+        below = i - (lower[-1] if lower else -1) - 1
+        N[i] = above if above > 0 else -below
+        higher.append(i)
+        lower.append(i)
+    return N
+
+
+def drawdown_series(worth):
+    '''Current drawdown of every day as if the history ended on that day, see BaseAsset.cal_mdd
+
+    The drawdown is measured from the peak since the last price lower than today's. A monotonic
+    stack of (index, peak of the prices it covers) finds both, so the whole series costs O(n).
+    '''
+    cur = [0.0] * len(worth)
+    stack = []  # increasing prices, each with the peak since the previous entry
+    for i, price in enumerate(worth):
+        peak = price
+        while stack and worth[stack[-1][0]] >= price:
+            peak = max(peak, stack.pop()[1])
+        stack.append((i, peak))
+        cur[i] = round(1 - price / peak, 4) if peak else 0.0
+    return cur
+
+
+class Panel:
+    """Prices of many assets aligned on a common trading calendar
+
+    prices is a days × assets matrix. An asset is forward-filled on the days its
+    market was closed (holidays, weekends of a fund next to crypto...) and is NaN
+    before its first price. observed marks the prices that were actually printed,
+    so that the metrics below count trading days of each asset exactly like the
+    per-asset methods of BaseAsset, but for all assets at once.
+    """
+    def __init__(self, days, codes, prices, observed, names=None):
+        self.days = days
+        self.codes = codes
+        self.prices = prices
+        self.observed = observed
+        self.names = names or [''] * len(codes)
+
+    @classmethod
+    def from_series(cls, series, calendar='union', names=None):
+        '''series maps a code to its (dates, prices)
+
+        calendar is 'union' (every day any asset traded), 'intersection' (days all of
+        them traded), a market of trading_calendar.MARKETS (or its name, e.g. 'CN')
+        whose trading days between the first and the last price make the calendar,
+        or an explicit sequence of day numbers. Prices on days outside of a market
+        or an explicit calendar are dropped.
+        '''
+        codes = list(series)
+        columns = [(to_days(dates), np.asarray(prices, dtype=np.float64)) for dates, prices in series.values()]
+        if isinstance(calendar, str) and calendar in MARKETS:
+            calendar = MARKETS[calendar]
+        if isinstance(calendar, Market):
+            observed_days = [d for d, _ in columns if len(d)]
+            if observed_days:
+                first = min(d.min() for d in observed_days)
+                last = max(d.max() for d in observed_days)
+                every_day = np.arange(first, last + 1)
+                days = every_day[[calendar.is_trading_day(day) for day in every_day.astype('datetime64[D]').tolist()]]
+            else:
+                days = np.empty(0, dtype=np.int64)
+        elif isinstance(calendar, str):
+            day_sets = [np.unique(d) for d, _ in columns]
+            if not day_sets:
+                days = np.empty(0, dtype=np.int64)
+            elif calendar == 'union':
+                days = np.unique(np.concatenate(day_sets))
+            elif calendar == 'intersection':
+                days = day_sets[0]
+                for d in day_sets[1:]:
+                    days = np.intersect1d(days, d)
+            else:
+                raise ValueError('Unknown calendar: {0}'.format(calendar))
+        else:
+            days = np.unique(np.asarray(calendar, dtype=np.int64))
+
+        n, m = len(days), len(codes)
+        prices = np.full((n, m), np.nan)
+        observed = np.zeros((n, m), dtype=bool)
+        for j, (d, p) in enumerate(columns):
+            rows = np.searchsorted(days, d)
+            keep = (rows < n) & (days[np.minimum(rows, n - 1)] == d) if n else np.zeros(len(d), dtype=bool)
+            # a later price of the same day wins, e.g. today's estimate
+            prices[rows[keep], j] = p[keep]
+            observed[rows[keep], j] = True
+
+        # forward fill the days an asset did not trade
+        index = np.where(observed, np.arange(n)[:, None], 0)
+        np.maximum.accumulate(index, axis=0, out=index)
+        prices = prices[index, np.arange(m)]
+        prices[np.cumsum(observed, axis=0) == 0] = np.nan
+        return cls(days, codes, prices, observed, names)
+
+    @classmethod
+    def from_assets(cls, assets, calendar='union'):
+        return cls.from_series(
+            {a.code: (a.dates, a.worth) for a in assets}, calendar, [a.name for a in assets])
+
+    @classmethod
+    def from_archive(cls, archive, codes=None, calendar='union'):
+        codes = archive.codes() if codes is None else codes
+        return cls.from_series(
+            {c: archive.read(c) for c in codes}, calendar, [archive.index[c]['name'] for c in codes])
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def dates(self):
+        return self.days.astype('datetime64[D]')
+
+    def column(self, code):
+        """The prices actually printed by an asset"""
+        j = self.codes.index(code)
+        return self.prices[self.observed[:, j], j]
+
+    def _last(self):
+        """Row of the last price of every asset, the current price and the observed rows before it"""
+        n, m = self.prices.shape
+        rows = np.arange(n)[:, None]
+        if n == 0:
+            empty = np.zeros(m, dtype=np.int64)
+            return rows, empty, np.full(m, np.nan), self.observed
+        has_data = self.observed.any(axis=0)
+        last = np.where(has_data, n - 1 - np.argmax(self.observed[::-1], axis=0), 0)
+        current = np.where(has_data, self.prices[last, np.arange(m)], np.nan)
+        history = self.observed & (rows < last)
+        return rows, last, current, history
+
+    def _count_before(self):
+        """count[r, j] is the number of prices of asset j before row r"""
+        n, m = self.prices.shape
+        count = np.zeros((n + 1, m), dtype=np.int64)
+        np.cumsum(self.observed, axis=0, out=count[1:])
+        return count
+
+    def current_price(self):
+        return self._last()[2]
+
+    def daily_change(self):
+        """Change of the current price vs the previous close, see BaseAsset.daily_change_pct"""
+        rows, _, current, history = self._last()
+        prev_row = np.where(history, rows, -1).max(axis=0, initial=-1)
+        cols = np.arange(len(self.codes))
+        prev = np.full(len(cols), np.nan)
+        prev[prev_row >= 0] = self.prices[prev_row[prev_row >= 0], cols[prev_row >= 0]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = (current - prev) / prev
+        return np.where(np.isfinite(change), change, 0.0)
+
+    def streak(self):
+        """N of every asset, see BaseAsset.buy_or_sell"""
+        rows, last, current, history = self._last()
+        count = self._count_before()
+        cols = np.arange(len(self.codes))
+        total = count[last, cols]
+        with np.errstate(invalid='ignore'):
+            last_higher = np.where(history & (self.prices >= current), rows, -1).max(axis=0, initial=-1)
+            last_lower = np.where(history & (self.prices <= current), rows, -1).max(axis=0, initial=-1)
+        above = total - count[last_higher + 1, cols]
+        below = total - count[last_lower + 1, cols]
+        return np.where(above > 0, above, -below)
+
+    def drawdown(self):
+        """Maximum and current drawdown of every asset, see BaseAsset.cal_mdd"""
+        rows, last, current, history = self._last()
+        prices = np.where(self.observed, self.prices, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mdd = 1 - prices / np.fmax.accumulate(prices, axis=0)
+            mdd = np.where(np.isnan(mdd), 0, mdd).max(axis=0, initial=0)
+            # the current drawdown is measured since the last time the price was lower than now
+            last_lower = np.where(history & (self.prices < current), rows, -1).max(axis=0, initial=-1)
+            since = self.observed & (rows > last_lower) & (rows <= last)
+            peak = np.where(since, self.prices, -np.inf).max(axis=0, initial=-np.inf)
+            cur = np.where(np.isfinite(peak), 1 - current / peak, 0)
+        return np.round(mdd, 4), np.round(cur, 4)
+
+    def _window(self, window):
+        """Mask of the last `window` prices of every asset"""
+        _, last, _, _ = self._last()
+        count = self._count_before()
+        cols = np.arange(len(self.codes))
+        return self.observed & (count[:-1] >= count[last + 1, cols] - window) & (count[:-1] < count[last + 1, cols])
+
+    def window_min(self, window):
+        """Minimum of the last `window` prices of every asset, see BaseAsset.window_min"""
+        return np.where(self._window(window), self.prices, np.inf).min(axis=0, initial=np.inf)
+
+    def window_max(self, window):
+        """Maximum of the last `window` prices of every asset, see BaseAsset.window_max"""
+        return np.where(self._window(window), self.prices, -np.inf).max(axis=0, initial=-np.inf)
+
+    def percentile_rank(self, window=None):
+        """Percentile rank of the current price of every asset, see BaseAsset.percentile_rank"""
+        _, _, current, history = self._last()
+        if window is not None:
+            history = history & self._window(window + 1)
+        size = history.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lower = (history & (self.prices < current)).sum(axis=0)
+            return np.where(size > 0, lower / size, np.nan)
+
+    def streak_series(self):
+        """N of every asset on every day it traded, 0 on the other days"""
+        N = np.zeros(self.prices.shape, dtype=np.int64)
+        for j in range(len(self.codes)):
+            rows = self.observed[:, j]
+            N[rows, j] = streak_series(self.prices[rows, j].tolist())
+        return N
+
+    def criteria_mask(self, config):
+        """Assets meeting the thresholds of MonitorWithCriteria, regardless of trading and notification history"""
+        N = self.streak()
+        _, cur = self.drawdown()
+        mask = np.abs(self.daily_change()) >= config.daily_change_threshold
+        mask |= N < config.low_threshold
+        mask |= cur > config.drawdown_threshold
+        mask |= N > config.high_threshold
+        mask |= N == self.observed.sum(axis=0) - 1
+        if config.low_rank_threshold is not None or config.high_rank_threshold is not None:
+            rank = self.percentile_rank(config.rank_window)
+            with np.errstate(invalid='ignore'):
+                if config.low_rank_threshold is not None:
+                    mask |= rank <= config.low_rank_threshold
+                if config.high_rank_threshold is not None:
+                    mask |= rank >= config.high_rank_threshold
+        return mask & self.observed.any(axis=0)
+
+
+class TestPanel(unittest.TestCase):
+    def create_assets(self):
+        from base_asset import TestAsset
+        random.seed(2)
+        assets = []
+        for i in range(30):
+            asset = TestAsset(str(i))
+            n = random.randint(0, 40)
+            # random trading days, some of them on the same days as other assets
+            days = sorted(random.sample(range(60), n))
+            asset.dates = [d * 86400000 for d in days]
+            asset.worth = [round(random.uniform(1, 3), 1) for _ in days]
+            assets.append(asset)
+        return assets
+
+    def test_alignment(self):
+        from base_asset import TestAsset
+        a, b = TestAsset('A'), TestAsset('B')
+        a.dates, a.worth = [0, 86400000 * 2], [1.0, 2.0]
+        b.dates, b.worth = [86400000, 86400000 * 2], [5.0, 6.0]
+        panel = Panel.from_assets([a, b])
+        self.assertEqual([0, 1, 2], panel.days.tolist())
+        np.testing.assert_array_equal([[1, np.nan], [1, 5], [2, 6]], panel.prices)
+        self.assertEqual([1.0, 2.0], panel.column('A').tolist())
+        self.assertEqual('1970-01-02', str(panel.dates[1]))
+
+        panel = Panel.from_assets([a, b], calendar='intersection')
+        self.assertEqual([2], panel.days.tolist())
+        panel = Panel.from_assets([a, b], calendar=[1, 2, 3])
+        np.testing.assert_array_equal([[np.nan, 5], [2, 6], [2, 6]], panel.prices)
+        self.assertRaises(ValueError, Panel.from_assets, [a], 'foo')
+
+    def test_market_calendar(self):
+        from datetime import date
+        day = lambda d: (date.fromisoformat(d) - date(1970, 1, 1)).days * 86400000 - 8 * 3600000
+        # Friday 2025-01-24 and Wednesday 2025-02-05, around the Spring Festival, plus a price on Saturday
+        fund = ([day('2025-01-24'), day('2025-01-25'), day('2025-02-05')], [1.0, 9.0, 1.2])
+        panel = Panel.from_series({'A': fund}, calendar='CN')
+        self.assertEqual(['2025-01-24', '2025-01-27', '2025-02-05'], [str(d) for d in panel.dates])
+        np.testing.assert_array_equal([[1.0], [1.0], [1.2]], panel.prices)
+        self.assertEqual([True, False, True], panel.observed[:, 0].tolist())
+        # the US market was open during the Spring Festival
+        panel = Panel.from_series({'A': fund}, calendar=MARKETS['US'])
+        self.assertEqual(9, len(panel))
+        self.assertEqual(0, len(Panel.from_series({}, calendar='CN')))
+
+    def test_against_assets(self):
+        assets = self.create_assets()
+        panel = Panel.from_assets(assets)
+        N = panel.streak()
+        mdd, cur = panel.drawdown()
+        change = panel.daily_change()
+        low, high = panel.window_min(5), panel.window_max(5)
+        rank, rank3 = panel.percentile_rank(), panel.percentile_rank(3)
+        for j, asset in enumerate(assets):
+            self.assertEqual(asset.buy_or_sell(asset.worth), N[j])
+            self.assertEqual(asset.cal_mdd(), (mdd[j], cur[j]))
+            self.assertAlmostEqual(asset.daily_change_pct, change[j])
+            if asset.worth:
+                self.assertEqual(asset.window_min(5), low[j])
+                self.assertEqual(asset.window_max(5), high[j])
+            if len(asset.worth) > 1:
+                self.assertAlmostEqual(asset.percentile_rank(), rank[j])
+                self.assertAlmostEqual(asset.percentile_rank(3), rank3[j])
+            else:
+                self.assertTrue(np.isnan(rank[j]))
+
+    def test_streak_series(self):
+        assets = self.create_assets()
+        for asset in assets:
+            expected = [asset.buy_or_sell(asset.worth[:i+1]) for i in range(len(asset.worth))]
+            self.assertEqual(expected, streak_series(asset.worth))
+        panel = Panel.from_assets(assets)
+        N = panel.streak_series()
+        self.assertEqual(panel.streak().tolist(), [
+            N[panel.observed[:, j], j][-1] if panel.observed[:, j].any() else 0 for j in range(len(assets))])
+
+    def test_drawdown_series(self):
+        for asset in self.create_assets():
+            worth = asset.worth
+            cur = drawdown_series(worth)
+            for i in range(len(worth)):
+                asset.worth = worth[:i+1]
+                self.assertEqual(asset.cal_mdd()[1], cur[i])
+
+    def test_criteria_mask(self):
+        from monitor_config import MonitorConfig
+        assets = self.create_assets()
+        panel = Panel.from_assets(assets)
+        config = MonitorConfig('test', 'test', low_threshold=-10, high_threshold=10, low_rank_threshold=0.1)
+        mask = panel.criteria_mask(config)
+        for j, asset in enumerate(assets):
+            asset.analyze()
+            expected = bool(asset.worth) and (
+                abs(asset.daily_change_pct) >= config.daily_change_threshold or
+                asset.N < config.low_threshold or
+                asset.cur > config.drawdown_threshold or
+                asset.N > config.high_threshold or
+                asset.is_at_historical_high or
+                (asset.rank is not None and asset.rank <= config.low_rank_threshold))
+            self.assertEqual(expected, mask[j], asset.code)
+
+    def test_empty(self):
+        panel = Panel.from_series({})
+        self.assertEqual(0, len(panel))
+        self.assertEqual([], panel.streak().tolist())
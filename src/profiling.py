@@ -0,0 +1,206 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+class StackSampler:
+    """Sample the stacks of all the other threads every interval seconds, in the collapsed format of flamegraph.pl"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+class Profiler:
+    '''Profile a monitor run, enabled by setting PROFILE to a directory
+
+    Every stage writes into a directory per run:
+        <stage>.prof        cProfile stats, e.g. `python -m pstats` or snakeviz
+        <stage>.collapsed   sampled stacks of all threads for flamegraph.pl or speedscope
+    and assets.json has the time, the tracemalloc peak and the top allocation sites of every
+    asset. Assets are then processed one at a time so that their memory can be told apart.
+    '''
+    enabled = True
+
+    def __init__(self, directory, top=10):
+        self.directory = os.path.join(directory, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(self.directory, exist_ok=True)
+        self.top = top
+        self.stages = {}
+        self.assets = {}
+
+    @staticmethod
+    def from_env():
+        directory = os.getenv('PROFILE')
+        return Profiler(directory) if directory else NullProfiler()
+
+    @contextmanager
+    def stage(self, name):
+        profile = cProfile.Profile()
+        sampler = StackSampler()
+        sampler.start()
+        start = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.stages[name] = time.time() - start
+            sampler.stop()
+            profile.dump_stats(os.path.join(self.directory, name + '.prof'))
+            sampler.write(os.path.join(self.directory, name + '.collapsed'))
+            logging.info('profiled stage {0} in {1:.2f}s'.format(name, self.stages[name]))
+
+    @contextmanager
+    def asset(self, code):
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start(25)
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            if not started:
+                tracemalloc.stop()
+            sites = after.compare_to(before, 'lineno')[:self.top]
+            self.assets[code] = {
+                'seconds': round(elapsed, 3),
+                'peak_kb': round(peak / 1024, 1),
+                'top_allocations': ['{0} {1:+.1f}KB'.format(s.traceback, s.size_diff / 1024) for s in sites],
+            }
+
+    def save(self):
+        with open(os.path.join(self.directory, 'assets.json'), 'w', encoding='utf-8') as f:
+            json.dump({'stages': self.stages, 'assets': self.assets}, f, ensure_ascii=False, indent=2)
+        slowest = sorted(self.assets.items(), key=lambda item: -item[1]['seconds'])[:5]
+        logging.info('profile written to {0}, slowest assets: {1}'.format(
+            self.directory, ', '.join('{0} {1}s'.format(code, a['seconds']) for code, a in slowest)))
+
+
+class NullProfiler:
+    """Profiler of the runs without PROFILE, which does nothing"""
+    enabled = False
+
+    def stage(self, name):
+        return nullcontext()
+
+    def asset(self, code):
+        return nullcontext()
+
+    def save(self):
+        pass
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+
+            def work():
+                data = [list(range(1000)) for _ in range(100)]
+                time.sleep(0.05)
+                return data
+
+            with profiler.stage('download'):
+                with profiler.asset('A'):
+                    data = work()
+                thread = threading.Thread(target=work)
+                thread.start()
+                thread.join()
+            profiler.save()
+
+            stats = pstats.Stats(os.path.join(profiler.directory, 'download.prof'))
+            self.assertTrue(any(func[2] == 'work' for func in stats.stats))
+            with open(os.path.join(profiler.directory, 'download.collapsed'), encoding='utf-8') as f:
+                self.assertIn('profiling.py:work', f.read())
+            with open(os.path.join(profiler.directory, 'assets.json'), encoding='utf-8') as f:
+                summary = json.load(f)
+            self.assertIn('download', summary['stages'])
+            self.assertGreater(summary['assets']['A']['peak_kb'], 1000)
+            self.assertIn('profiling.py', summary['assets']['A']['top_allocations'][0])
+            self.assertEqual(100, len(data))
+
+    def test_monitor(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        with tempfile.TemporaryDirectory() as directory:
+            monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test'))
+            monitor.TEST = '1'  # no email
+            monitor.profiler = Profiler(directory)
+            assets = [TestAsset('A', [1, 2, 3]), TestAsset('B', [3, 2])]
+            for asset in assets:
+                asset.result_cache = None
+            monitor.process(assets)
+            self.assertEqual(['A', 'B'], sorted(monitor.profiler.assets))
+            self.assertEqual(['download', 'notify'], sorted(monitor.profiler.stages))
+            stats = pstats.Stats(os.path.join(monitor.profiler.directory, 'download.prof'))
+            self.assertTrue(any(func[2] == 'buy_or_sell' for func in stats.stats))
+            files = os.listdir(monitor.profiler.directory)
+            for name in ['download.prof', 'download.collapsed', 'notify.prof', 'assets.json']:
+                self.assertIn(name, files)
+
+    def test_from_env(self):
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {'PROFILE': directory}):
+                profiler = Profiler.from_env()
+            self.assertIsInstance(profiler, Profiler)
+            self.assertTrue(profiler.enabled)
+            self.assertEqual(directory, os.path.dirname(profiler.directory))
+        with mock.patch.dict(os.environ, {'PROFILE': ''}):
+            self.assertIsInstance(Profiler.from_env(), NullProfiler)
+        with mock.patch.dict(os.environ):
+            os.environ.pop('PROFILE', None)
+            self.assertIsInstance(Profiler.from_env(), NullProfiler)
+
+    def test_null_profiler(self):
+        profiler = NullProfiler()
+        self.assertFalse(profiler.enabled)
+        with profiler.stage('download'), profiler.asset('A'):
+            pass
+        profiler.save()
@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+
+
+class SparseTable:
+    """Range minimum/maximum index over a static series
+
+    Built once in O(n log n), then the min or max of any range is answered in O(1)
+    by looking up two overlapping power-of-two blocks.
+    Ranges follow the slice convention: [start, end).
+    """
+    def __init__(self, values):
+        self.n = len(values)
+        self._min = [list(values)]
+        self._max = [list(values)]
+        j = 1
+        while (1 << j) <= self.n:
+            half = 1 << (j - 1)
+            prev_min = self._min[-1]
+            prev_max = self._max[-1]
+            # the block of length 2^j starting at i is made of two blocks of length 2^(j-1)
+            self._min.append([a if a < b else b for a, b in zip(prev_min, prev_min[half:])])
+            self._max.append([a if a > b else b for a, b in zip(prev_max, prev_max[half:])])
+            j += 1
+
+    def __len__(self):
+        return self.n
+
+    def _blocks(self, start, end):
+        if not 0 <= start < end <= self.n:
+            raise ValueError('invalid range [{0}, {1}) for a series of length {2}'.format(start, end, self.n))
+        k = (end - start).bit_length() - 1
+        return k, start, end - (1 << k)
+
+    def min(self, start, end):
+        k, i, j = self._blocks(start, end)
+        row = self._min[k]
+        return row[i] if row[i] < row[j] else row[j]
+
+    def max(self, start, end):
+        k, i, j = self._blocks(start, end)
+        row = self._max[k]
+        return row[i] if row[i] > row[j] else row[j]
+
+
+class TestSparseTable(unittest.TestCase):
+    def test_against_brute_force(self):
+        random.seed(0)
+        for n in [1, 2, 3, 7, 8, 9, 100]:
+            values = [random.random() for _ in range(n)]
+            table = SparseTable(values)
+            self.assertEqual(n, len(table))
+            for start in range(n):
+                for end in range(start + 1, n + 1):
+                    self.assertEqual(min(values[start:end]), table.min(start, end))
+                    self.assertEqual(max(values[start:end]), table.max(start, end))
+
+    def test_invalid_range(self):
+        table = SparseTable([1, 2, 3])
+        self.assertRaises(ValueError, table.min, 1, 1)
+        self.assertRaises(ValueError, table.max, 0, 4)
+        self.assertRaises(ValueError, SparseTable([]).min, 0, 0)
@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+import time
+import logging
+import threading
+import unittest
+from collections import deque
+from contextlib import contextmanager
+
+
+class Throttled(Exception):
+    """The source answered 429 Too Many Requests"""
+
+
+def classify(error):
+    """'throttled', 'timeout' or 'error' for an exception raised by a download"""
+    names = [cls.__name__ for cls in type(error).__mro__]
+    # ccxt raises RateLimitExceeded and DDoSProtection, requests raises Timeout subclasses
+    if isinstance(error, Throttled) or 'RateLimitExceeded' in names or 'DDoSProtection' in names:
+        return 'throttled'
+    if isinstance(error, TimeoutError) or any('Timeout' in name for name in names):
+        return 'timeout'
+    return 'error'
+
+
+class TokenBucket:
+    """Allow rate requests per second on average with bursts of up to capacity requests"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class AdaptiveLimiter:
+    '''Rate and concurrency limit of one host or venue, shared by all the threads downloading from it
+
+    The concurrency grows by one after a round of healthy requests (as many fast successes
+    as the current concurrency) and is halved on a 429, a timeout or when half of the recent
+    requests failed. A 429 also halves the request rate, which recovers as the concurrency grows.
+    '''
+    def __init__(self, name, rate=5.0, burst=5, concurrency=2, max_concurrency=8,
+                 target_latency=3.0, window=20):
+        self.name = name
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency  # seconds, slower requests do not count as healthy
+        self.active = 0
+        self._healthy = 0
+        self._outcomes = deque(maxlen=window)  # True for failed requests
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''Wait for a free slot and a token, then measure the request made in the with block
+
+        The slot is given back whatever leaves the block, e.g. a gevent.Timeout. An interrupt
+        (KeyboardInterrupt, or GeneratorExit when the block is abandoned) says nothing about
+        the source and is not counted.
+        '''
+        with self._cond:
+            while self.active >= self.concurrency:
+                self._cond.wait()
+            self.active += 1
+        start = None
+        failure = None
+        try:
+            self.bucket.acquire()
+            start = time.monotonic()
+            yield
+        except (KeyboardInterrupt, SystemExit, GeneratorExit):
+            failure = 'cancelled'
+            raise
+        except BaseException as e:
+            failure = classify(e)
+            raise
+        finally:
+            self._release(time.monotonic() - start if start is not None else 0, failure)
+
+    def _release(self, latency, failure):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+            if failure == 'cancelled':
+                return
+            self._outcomes.append(failure is not None)
+            if failure in ('throttled', 'timeout'):
+                self._decrease(failure)
+            elif failure is not None:
+                if len(self._outcomes) >= 4 and sum(self._outcomes) * 2 >= len(self._outcomes):
+                    self._decrease('errors')
+            elif latency <= self.target_latency:
+                self._healthy += 1
+                if self._healthy >= self.concurrency:
+                    self._increase()
+            else:
+                self._healthy = 0
+
+    def _increase(self):
+        self._healthy = 0
+        self.bucket.rate = min(self.max_rate, self.bucket.rate * 2)
+        if self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            logging.debug('{0}: concurrency up to {1}'.format(self.name, self.concurrency))
+
+    def _decrease(self, reason):
+        self._healthy = 0
+        self._outcomes.clear()
+        self.concurrency = max(1, self.concurrency // 2)
+        if reason == 'throttled':
+            self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+        logging.warning('{0}: {1}, concurrency down to {2}, {3:.2f} requests/s'.format(
+            self.name, reason, self.concurrency, self.bucket.rate))
+
+
+# Default limits of the sources, the other ones get the defaults of AdaptiveLimiter
+# A slot measures one call: efinance functions given a list of codes send many requests
+# in their own threads, so they go through 'eastmoney-bulk', one call at a time, and their
+# latency is the one of the whole batch.
+LIMITS = {
+    'fund.eastmoney.com': {'rate': 10, 'burst': 10, 'concurrency': 4},
+    'fundgz.1234567.com.cn': {'rate': 10, 'burst': 10, 'concurrency': 4},
+    'eastmoney': {'rate': 5, 'burst': 5, 'concurrency': 2},  # efinance
+    'eastmoney-bulk': {'rate': 1, 'burst': 1, 'concurrency': 1, 'max_concurrency': 1, 'target_latency': 60},
+}
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(name, **kwargs):
+    """The limiter shared by the whole process for a host or venue, kwargs only apply when it is created"""
+    with _lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = AdaptiveLimiter(name, **dict(LIMITS.get(name, {}), **kwargs))
+        return limiter
+
+
+def limit(name, **kwargs):
+    """Context manager around one request to a host or venue: `with rate_limiter.limit(host): ...`"""
+    return get_limiter(name, **kwargs).slot()
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_classify(self):
+        import requests
+        self.assertEqual('throttled', classify(Throttled()))
+        self.assertEqual('timeout', classify(requests.exceptions.ReadTimeout()))
+        self.assertEqual('timeout', classify(TimeoutError()))
+        self.assertEqual('error', classify(ValueError()))
+        import ccxt
+        self.assertEqual('throttled', classify(ccxt.RateLimitExceeded()))
+        self.assertEqual('timeout', classify(ccxt.RequestTimeout()))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, capacity=2)
+        start = time.monotonic()
+        for _ in range(7):
+            bucket.acquire()
+        # 2 at once, then 5 more at 100 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_adaptive_concurrency(self):
+        limiter = AdaptiveLimiter('test', rate=1000, burst=1000, concurrency=2, max_concurrency=4)
+        for _ in range(2 + 3):
+            with limiter.slot():
+                pass
+        self.assertEqual(4, limiter.concurrency)
+        with self.assertRaises(Throttled):
+            with limiter.slot():
+                raise Throttled()
+        self.assertEqual(2, limiter.concurrency)
+        self.assertEqual(500, limiter.bucket.rate)
+        with self.assertRaises(TimeoutError):
+            with limiter.slot():
+                raise TimeoutError()
+        self.assertEqual(1, limiter.concurrency)
+        with limiter.slot():
+            pass
+        self.assertEqual(2, limiter.concurrency)
+        self.assertEqual(1000, limiter.bucket.rate)
+
+    def test_error_spike(self):
+        limiter = AdaptiveLimiter('test', rate=1000, burst=1000, concurrency=4, max_concurrency=4)
+        for i in range(4):
+            try:
+                with limiter.slot():
+                    if i % 2:
+                        raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(2, limiter.concurrency)
+
+    def test_concurrency_limit(self):
+        limiter = AdaptiveLimiter('test', rate=1000, burst=1000, concurrency=2, max_concurrency=2)
+        active = []
+
+        def work(_):
+            with limiter.slot():
+                active.append(limiter.active)
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8, len(active))
+        self.assertLessEqual(max(active), 2)
+
+    def test_interrupted(self):
+        limiter = AdaptiveLimiter('test', rate=1000, burst=1000, concurrency=2, max_concurrency=2)
+
+        class Timeout(BaseException):  # like gevent.Timeout
+            pass
+        with self.assertRaises(Timeout):
+            with limiter.slot():
+                raise Timeout()
+        self.assertEqual((0, 1), (limiter.active, limiter.concurrency))
+        with self.assertRaises(KeyboardInterrupt):
+            with limiter.slot():
+                raise KeyboardInterrupt()
+        self.assertEqual((0, 1), (limiter.active, limiter.concurrency))
+        # a generator abandoned in the with block
+        def requests():
+            with limiter.slot():
+                yield
+        generator = requests()
+        next(generator)
+        self.assertEqual(1, limiter.active)
+        generator.close()
+        self.assertEqual(0, limiter.active)
+        self.assertEqual(0, len(limiter._outcomes))
+
+    def test_shared(self):
+        self.assertIs(get_limiter('fund.eastmoney.com'), get_limiter('fund.eastmoney.com'))
+        self.assertEqual(10, get_limiter('fund.eastmoney.com').max_rate)
@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+import sys
+import random
+import logging
+import unittest
+from bisect import bisect_left, insort
+from collections import Counter
+from datetime import date
+
+from base_asset import to_date
+import adaptive_thresholds
+from panel import streak_series, drawdown_series
+from monitor_with_criteria import check_criteria
+
+
+def rank_series(worth, window=None):
+    '''order_stats.percentile_ranks of every day, from a sorted list of the previous `window` prices
+
+    bisect and insort move the list in C, which is much faster than the Fenwick tree of RankIndex
+    walked in Python for the few thousand days of a history.
+    '''
+    ranks = [None] * len(worth)
+    history = []
+    for i, price in enumerate(worth):
+        if history:
+            ranks[i] = bisect_left(history, price) / len(history)
+        insort(history, price)
+        if window is not None and i >= window:
+            del history[bisect_left(history, worth[i - window])]
+    return ranks
+
+
+class DayState:
+    """The attributes of an asset read by check_criteria, on one day of the replay"""
+    __slots__ = ('code', 'N', 'cur', 'rank', 'window_rank', 'daily_change_pct', 'is_at_historical_high')
+
+    def __init__(self, code):
+        self.code = code
+
+    def percentile_rank(self, window=None):
+        return self.rank if window is None else self.window_rank
+
+
+def replay_asset(code, dates, worth, config, since=None):
+    '''Alerts that MonitorWithCriteria would have sent for one asset with a run after every close
+
+    Every day sees the history truncated to that day: N, the current drawdown and the ranks
+    are computed incrementally for all days at once, then the days are walked with the
+    notification history kept in memory. With config.adaptive_quantiles, the thresholds of each
+    day come from the history before it and are refreshed like Monitor._config_for does with
+    a result cache. Return [(day, criterion), ...] of the days from since.
+    '''
+    N = streak_series(worth)
+    cur = drawdown_series(worth)
+    use_rank = config.low_rank_threshold is not None or config.high_rank_threshold is not None
+    ranks = rank_series(worth) if use_rank else None
+    window_ranks = rank_series(worth, config.rank_window) if use_rank and config.rank_window else ranks
+
+    quantiles = config.adaptive_quantiles
+    computed_on = None  # length of the history of the current thresholds
+    day_config = config
+
+    state = DayState(code)
+    last_notified = date(2000, 1, 1)
+    alerts = []
+    for i in range(1, len(worth)):
+        # the price changed since the previous run
+        if worth[i] == worth[i - 1]:
+            continue
+        state.N = N[i]
+        state.cur = cur[i]
+        state.daily_change_pct = (worth[i] - worth[i - 1]) / worth[i - 1] if worth[i - 1] else 0.0
+        state.is_at_historical_high = N[i] == i
+        if use_rank:
+            state.rank = ranks[i]
+            state.window_rank = window_ranks[i]
+        if quantiles and i >= adaptive_thresholds.MIN_HISTORY and \
+                (computed_on is None or not adaptive_thresholds.reusable(computed_on, i)):
+            computed_on = i
+            day_config = adaptive_thresholds.with_thresholds(
+                config, adaptive_thresholds.series_thresholds(worth[:i], quantiles))
+        triggered = check_criteria(state, day_config)
+        if triggered is None:
+            continue
+        day = to_date(dates[i])
+        if (day - last_notified).days >= config.notification_days:
+            last_notified = day
+            if since is None or day >= since:
+                alerts.append((day, triggered[0]))
+    return alerts
+
+
+def replay(series, config, since=None):
+    '''Replay the criteria of config over the histories of many assets
+
+    series: {code: (dates, worth)}, e.g. read from a HistoryArchive
+    Return {'alerts': {code: [(day, criterion), ...]}, 'criteria': Counter, 'emails': [day, ...]}
+    where emails are the days with at least one alert, i.e. the emails that would have been sent.
+    '''
+    alerts = {}
+    for code, (dates, worth) in series.items():
+        alerts[code] = replay_asset(code, list(dates), list(worth), config, since)
+    criteria = Counter(criterion for a in alerts.values() for _, criterion in a)
+    emails = sorted({day for a in alerts.values() for day, _ in a})
+    return {'alerts': alerts, 'criteria': criteria, 'emails': emails}
+
+
+def summary(result):
+    lines = ['{0} emails, {1} alerts'.format(len(result['emails']), sum(result['criteria'].values()))]
+    lines += ['  {0}: {1}'.format(c, n) for c, n in result['criteria'].most_common()]
+    for code, alerts in sorted(result['alerts'].items(), key=lambda item: -len(item[1])):
+        if alerts:
+            lines.append('{0}: {1} alerts, last on {2}'.format(code, len(alerts), alerts[-1][0]))
+    return '\n'.join(lines)
+
+
+def main(archive_dir, asset_type='stock', since=None):
+    '''
+    回放存档中的历史数据，统计某类资产的阈值在过去会触发多少次提醒、发送多少封邮件。
+    `python replay.py archive_dir stock 2025-01-01`
+    '''
+    from history_archive import HistoryArchive
+    from monitor_all import MONITORS
+    archive = HistoryArchive(archive_dir)
+    _, config = MONITORS[asset_type]
+    result = replay({c: archive.read(c) for c in archive.codes()}, config, since)
+    logging.info('Replay of {0} assets\n{1}'.format(len(archive), summary(result)))
+    return result
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.worth, self.dates = self.series(120)
+
+    @staticmethod
+    def series(n):
+        random.seed(5)
+        price = 10.0
+        worth = []
+        for _ in range(n):
+            price *= random.uniform(0.9, 1.1)
+            worth.append(round(price, 2))
+        worth[50] = worth[49]  # no trading that day
+        day = 86400000
+        return worth, [1735660800000 + i * day for i in range(n)]
+
+    @staticmethod
+    def monitor_alerts(config, worth, dates, cache=None):
+        """Days MonitorWithCriteria sends an alert when run after every close"""
+        from datetime import datetime
+        from unittest import mock
+        from monitor_with_criteria import MonitorWithCriteria
+        from base_asset import TestAsset
+
+        class Clock(datetime):
+            current = None
+
+            @classmethod
+            def now(cls, tz=None):
+                return cls.current
+
+        monitor = MonitorWithCriteria(config)
+        alerts = []
+        with mock.patch('monitor_with_criteria.datetime', Clock):
+            for i in range(len(worth)):
+                asset = TestAsset('A', worth[:i + 1])
+                asset.result_cache = cache
+                asset.dates = dates[:i + 1]
+                asset.trade()
+                Clock.current = datetime.combine(to_date(dates[i]), datetime.min.time())
+                monitor.success = [asset]
+                if monitor.filter_sort():
+                    alerts.append(to_date(dates[i]))
+        return alerts
+
+    def test_rank_series(self):
+        from order_stats import percentile_ranks
+        for window in [None, 1, 7, 500]:
+            self.assertEqual(percentile_ranks(self.worth, window), rank_series(self.worth, window))
+
+    def test_against_monitor(self):
+        '''Alerts of the replay are the ones of MonitorWithCriteria run after every close'''
+        import os
+        import tempfile
+        from monitor_config import MonitorConfig
+
+        with tempfile.TemporaryDirectory() as directory:
+            config = MonitorConfig(asset_type='stock', subject_prefix='test', notification_days=2,
+                                   snapshot_file=os.path.join(directory, 'snapshot.json'),
+                                   low_threshold=-20, high_threshold=30, drawdown_threshold=0.5,
+                                   daily_change_threshold=0.08, low_rank_threshold=0.1, rank_window=20)
+            expected = self.monitor_alerts(config, self.worth, self.dates)
+
+            result = replay({'A': (self.dates, self.worth)}, config)
+            self.assertEqual(expected, [day for day, _ in result['alerts']['A']])
+            self.assertEqual(expected, result['emails'])
+            self.assertGreater(len(expected), 5)
+            self.assertGreater(len(result['criteria']), 1)
+            since = replay({'A': (self.dates, self.worth)}, config, since=expected[3])
+            self.assertEqual(expected[3:], since['emails'])
+            self.assertIn('{0} emails'.format(len(expected)), summary(result))
+
+    def test_adaptive_against_monitor(self):
+        """The thresholds of adaptive_quantiles are the ones of the monitor with a result cache"""
+        import os
+        import tempfile
+        from monitor_config import MonitorConfig
+        from result_cache import ResultCache
+        worth, dates = self.series(320)
+        with tempfile.TemporaryDirectory() as directory:
+            config = MonitorConfig(asset_type='stock', subject_prefix='test', notification_days=1,
+                                   snapshot_file=os.path.join(directory, 'snapshot.json'),
+                                   low_threshold=-1000, high_threshold=1000, drawdown_threshold=1,
+                                   daily_change_threshold=1, adaptive_quantiles={'daily_change_threshold': 0.8})
+            expected = self.monitor_alerts(config, worth, dates, ResultCache())
+            self.assertGreater(len(expected), 5)
+            self.assertEqual(expected, replay({'A': (dates, worth)}, config)['emails'])
+            self.assertGreater(replay({'A': (dates, worth)}, config)['criteria']['daily_change'], 0)
+            # without the quantiles nothing moves more than 100%
+            config.adaptive_quantiles = None
+            self.assertEqual(0, replay({'A': (dates, worth)}, config)['criteria']['daily_change'])
+
+
+if __name__ == '__main__':
+    # python replay.py archive_dir [fund|stock|crypto] [since YYYY-MM-DD]
+    main(sys.argv[1], *sys.argv[2:3], *[date.fromisoformat(d) for d in sys.argv[3:4]])
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import logging
+import hashlib
+import tempfile
+import threading
+import unittest
+from array import array
+from collections import OrderedDict
+
+
+def fingerprint(values):
+    """A short digest of a price series, identical series have identical fingerprints"""
+    return hashlib.blake2b(array('d', values).tobytes(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """LRU cache of strategy results, optionally persisted to a json file
+
+    Keys are strings such as 'code|fingerprint|strategy' and values must be json serializable.
+    It is thread safe so that it can be shared by the download threads of a monitor.
+    """
+    def __init__(self, maxsize=4096, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._dirty = True
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value of key, calling compute() to fill it on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        with self._lock:
+            # the file is saved from least to most recently used
+            self._data = OrderedDict(list(data.items())[-self.maxsize:])
+            self._dirty = False
+        logging.info('loaded {0} cached results from {1}'.format(len(self._data), self.path))
+
+    def save(self):
+        """Write the cache to disk if it has a path and has changed"""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self._data, ensure_ascii=False)
+            self._dirty = False
+        # write to a temporary file first so that a crash never leaves a truncated cache
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        logging.info('result cache: {0} hits, {1} misses, saved to {2}'.format(self.hits, self.misses, self.path))
+
+
+# Shared by the monitors, the backtests and the notebook.
+# Set RESULT_CACHE to a file path to persist it across runs.
+default_cache = ResultCache(path=os.getenv('RESULT_CACHE'))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint([1, 2.5]), fingerprint([1.0, 2.5]))
+        self.assertNotEqual(fingerprint([1, 2.5]), fingerprint([1, 2.5, 3]))
+        self.assertNotEqual(fingerprint([1, 2.5]), fingerprint([1, 2.6]))
+
+    def test_lru(self):
+        cache = ResultCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)  # evicts b, the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_or_compute(self):
+        cache = ResultCache()
+        calls = []
+        compute = lambda: calls.append(1) or {'N': 1}
+        self.assertEqual({'N': 1}, cache.get_or_compute('a', compute))
+        self.assertEqual({'N': 1}, cache.get_or_compute('a', compute))
+        self.assertEqual(1, len(calls))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.json')
+            cache = ResultCache(path=path)
+            cache.put('a', {'N': -3, 'mdd': 0.2})
+            cache.put('b', {'N': 5, 'mdd': 0.1})
+            cache.save()
+            loaded = ResultCache(maxsize=1, path=path)
+            self.assertEqual(1, len(loaded))
+            self.assertEqual({'N': 5, 'mdd': 0.1}, loaded.get('b'))
@@ -0,0 +1,175 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+
+import numpy as np
+
+
+# Bump it when the metrics change, to invalidate the cached ones
+VERSION = 1
+
+# name -> (column title, format) of the metrics that can be shown in the email, see MonitorConfig.risk_columns
+COLUMNS = {
+    'volatility': ('Vol', '{:.0%}'),
+    'sharpe': ('Sharpe', '{:.2f}'),
+    'sortino': ('Sortino', '{:.2f}'),
+    'downside_deviation': ('DD', '{:.0%}'),
+    'drawdown_days': ('Under', '{:d}d'),
+    'max_drawdown_days': ('MaxUnder', '{:d}d'),
+    'recovery_days': ('Recovery', '{:d}d'),
+    'from_high': ('52wH', '{:+.0%}'),
+    'from_low': ('52wL', '{:+.0%}'),
+}
+
+
+def returns(prices):
+    prices = np.asarray(prices, dtype=np.float64)
+    return prices[1:] / prices[:-1] - 1
+
+
+def _rolling_sum(values, window):
+    """Sums of every window of values in one pass: s[i] = values[i:i+window].sum()"""
+    cumsum = np.concatenate([[0], np.cumsum(values)])
+    return cumsum[window:] - cumsum[:-window]
+
+
+def rolling_sharpe(r, window, periods_per_year=252):
+    """Annualized Sharpe ratio (without risk-free rate) of every window of returns r"""
+    mean = _rolling_sum(r, window) / window
+    var = np.maximum(_rolling_sum(r * r, window) / window - mean * mean, 0) * window / (window - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(var > 0, mean / np.sqrt(var), np.nan) * np.sqrt(periods_per_year)
+
+
+def rolling_sortino(r, window, periods_per_year=252, mar=0.0):
+    """Annualized Sortino ratio of every window of returns r, mar is the minimum acceptable return per period"""
+    mean = _rolling_sum(r - mar, window) / window
+    downside = np.sqrt(_rolling_sum(np.minimum(r - mar, 0) ** 2, window) / window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(downside > 0, mean / downside, np.nan) * np.sqrt(periods_per_year)
+
+
+def drawdown_durations(prices):
+    '''Number of periods since the last peak at every day, 0 on a new high
+
+    Return (durations, peaks) where peaks is the running maximum of prices.
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    peaks = np.maximum.accumulate(prices)
+    index = np.arange(len(prices))
+    last_peak = np.maximum.accumulate(np.where(prices >= peaks, index, 0))
+    return index - last_peak, peaks
+
+
+def risk_metrics(prices, periods_per_year=252, window=63, mar=0.0):
+    '''Risk metrics of a price series, every one computed with vectorized passes
+
+    volatility, downside_deviation  annualized, over the full history
+    sharpe, sortino                 annualized, over the last window periods
+    drawdown_days                   periods since the last high
+    max_drawdown_days               longest time spent under a previous high
+    recovery_days                   periods from the bottom of the max drawdown back to its previous
+                                    high, None if it has not recovered yet
+    from_high, from_low             distance of the last price from the high and low of the last year
+    A metric that cannot be computed (too short a history) is None.
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    metrics = dict.fromkeys(COLUMNS)
+    if len(prices) < 3:
+        return metrics
+    r = returns(prices)
+    scale = np.sqrt(periods_per_year)
+    metrics['volatility'] = float(np.std(r, ddof=1) * scale)
+    metrics['downside_deviation'] = float(np.sqrt(np.mean(np.minimum(r - mar, 0) ** 2)) * scale)
+    w = min(window, len(r))
+    metrics['sharpe'] = float(rolling_sharpe(r, w, periods_per_year)[-1])
+    metrics['sortino'] = float(rolling_sortino(r, w, periods_per_year, mar)[-1])
+
+    durations, peaks = drawdown_durations(prices)
+    metrics['drawdown_days'] = int(durations[-1])
+    metrics['max_drawdown_days'] = int(durations.max())
+    trough = int(np.argmin(prices / peaks))
+    recovered = np.flatnonzero(prices[trough:] >= peaks[trough])
+    if trough > 0 and len(recovered):
+        metrics['recovery_days'] = int(recovered[0])
+    elif prices[trough] >= peaks[trough]:
+        metrics['recovery_days'] = 0  # never under water
+
+    year = prices[-periods_per_year:]
+    metrics['from_high'] = float(prices[-1] / year.max() - 1)
+    metrics['from_low'] = float(prices[-1] / year.min() - 1)
+    # NaN is not json
+    return {k: None if isinstance(v, float) and np.isnan(v) else v for k, v in metrics.items()}
+
+
+def format_metric(name, value):
+    return '-' if value is None else COLUMNS[name][1].format(value)
+
+
+class TestRisk(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+        price = 1.0
+        self.prices = []
+        for _ in range(400):
+            price *= random.uniform(0.97, 1.031)
+            self.prices.append(price)
+
+    def test_rolling(self):
+        r = returns(self.prices)
+        window = 30
+        sharpe = rolling_sharpe(r, window)
+        sortino = rolling_sortino(r, window)
+        self.assertEqual(len(r) - window + 1, len(sharpe))
+        for i in [0, 100, len(sharpe) - 1]:
+            x = r[i:i + window]
+            self.assertAlmostEqual(np.mean(x) / np.std(x, ddof=1) * np.sqrt(252), sharpe[i])
+            downside = np.sqrt(np.mean([min(v, 0) ** 2 for v in x]))
+            self.assertAlmostEqual(np.mean(x) / downside * np.sqrt(252), sortino[i])
+
+    def test_drawdown_durations(self):
+        durations, peaks = drawdown_durations([1, 2, 1.5, 1, 2.5, 2, 2.4, 3])
+        self.assertEqual([0, 0, 1, 2, 0, 1, 2, 0], durations.tolist())
+        self.assertEqual([1, 2, 2, 2, 2.5, 2.5, 2.5, 3], peaks.tolist())
+
+    def test_metrics(self):
+        metrics = risk_metrics(self.prices, window=63)
+        self.assertEqual(set(COLUMNS), set(metrics))
+        # against loops over the days
+        durations, peak_day = [], 0
+        for i, p in enumerate(self.prices):
+            if p >= self.prices[peak_day]:
+                peak_day = i
+            durations.append(i - peak_day)
+        self.assertEqual(durations[-1], metrics['drawdown_days'])
+        self.assertEqual(max(durations), metrics['max_drawdown_days'])
+        year = self.prices[-252:]
+        self.assertAlmostEqual(self.prices[-1] / max(year) - 1, metrics['from_high'])
+        self.assertAlmostEqual(self.prices[-1] / min(year) - 1, metrics['from_low'])
+        r = returns(self.prices)
+        self.assertAlmostEqual(np.std(r, ddof=1) * np.sqrt(252), metrics['volatility'])
+        self.assertAlmostEqual(rolling_sharpe(r, 63)[-1], metrics['sharpe'])
+
+    def test_recovery(self):
+        self.assertEqual(2, risk_metrics([2, 1, 1.5, 2.1, 2])['recovery_days'])
+        self.assertIsNone(risk_metrics([2, 1, 1.5])['recovery_days'])
+        self.assertEqual(0, risk_metrics([1, 2, 3])['recovery_days'])
+        self.assertIsNone(risk_metrics([1, 2])['volatility'])
+        self.assertEqual('-', format_metric('sharpe', None))
+        self.assertEqual('+5%', format_metric('from_low', 0.05))
+        self.assertEqual('12d', format_metric('drawdown_days', 12))
+
+    def test_columns(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test',
+                                        risk_columns=['volatility', 'drawdown_days']))
+        asset = TestAsset('A', [1, 2, 1.5, 1.8])
+        asset.result_cache = None
+        asset.trade()
+        monitor.success = [asset]
+        html = monitor._create_notification_table()
+        self.assertIn('<th style="text-align: right;">Under</th>', html)
+        self.assertIn('<td style="text-align: right;">2d</td>', html)
+        self.assertIn('<th>Vol</th>', html)
@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+import random
+import unittest
+
+import numpy as np
+
+from panel import streak_series
+
+
+def lttb(x, y, threshold):
+    '''Indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+
+    The first and the last points are kept, the others are split into threshold - 2 buckets
+    and each bucket keeps the point forming the largest triangle with the point kept in the
+    previous bucket and the average of the next one, so peaks and troughs survive.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = a = 0
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, n)
+        if next_start >= n - 1 or i == threshold - 3:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+        else:
+            avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    kept[-1] = n - 1
+    return kept
+
+
+def signal_days(worth, low_threshold, high_threshold):
+    """First days of every run of N <= low_threshold (buy) and N >= high_threshold (sell)"""
+    N = np.asarray(streak_series(list(worth)))
+    days = {}
+    for name, mask in (('buy', N <= low_threshold), ('sell', N >= high_threshold)):
+        days[name] = np.flatnonzero(mask & ~np.concatenate([[False], mask[:-1]]))
+    return days
+
+
+def chart_key(low_threshold, high_threshold):
+    """Key of the chart of an asset drawn with these thresholds, see monitor_distributed.compact_result"""
+    return '{0}|{1}'.format(low_threshold, high_threshold)
+
+
+def sparkline_svg(worth, points=200, width=240, height=60, low_threshold=-500, high_threshold=1000):
+    '''Inline SVG of a price history: the price line, its drawdown below it and the buy/sell signals
+
+    Long histories are reduced to `points` points with lttb, so a chart is a few KB whatever
+    the length of the history. The signals are found on the full history.
+    '''
+    worth = np.asarray(worth, dtype=np.float64)
+    n = len(worth)
+    if n < 3:
+        return ''
+    price_h = height * 0.7
+    drawdown = 1 - worth / np.maximum.accumulate(worth)
+
+    def xs(index):
+        return index * (width - 2) / (n - 1) + 1
+
+    def price_ys(values):
+        low, high = worth.min(), worth.max()
+        return 1 + (price_h - 2) * (1 - (values - low) / ((high - low) or 1))
+
+    kept = lttb(np.arange(n), worth, points)
+    line = ' '.join('{0:.1f},{1:.1f}'.format(a, b) for a, b in zip(xs(kept), price_ys(worth[kept])))
+    kept = lttb(np.arange(n), drawdown, points)
+    depth = drawdown.max() or 1
+    area = ' '.join('{0:.1f},{1:.1f}'.format(a, b) for a, b in
+                    zip(xs(kept), price_h + (height - price_h) * drawdown[kept] / depth))
+
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}">'.format(width, height),
+             '<polygon points="1,{0:.1f} {1} {2:.1f},{0:.1f}" fill="#f4b6b6"/>'.format(price_h, area, width - 1),
+             '<polyline points="{0}" fill="none" stroke="#3465a4" stroke-width="1"/>'.format(line)]
+    colors = {'buy': '#2e7d32', 'sell': '#c62828'}
+    for name, days in signal_days(worth, low_threshold, high_threshold).items():
+        last = -np.inf
+        for day, y in zip(xs(days), price_ys(worth[days])):
+            # one marker every few pixels is enough
+            if day - last >= 4:
+                parts.append('<circle cx="{0:.1f}" cy="{1:.1f}" r="2" fill="{2}"/>'.format(day, y, colors[name]))
+                last = day
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+class TestSparkline(unittest.TestCase):
+    def series(self, n):
+        random.seed(6)
+        price, worth = 1.0, []
+        for _ in range(n):
+            price *= random.uniform(0.98, 1.021)
+            worth.append(price)
+        return worth
+
+    def test_lttb(self):
+        worth = self.series(5000)
+        worth[1234] = 100  # a spike survives the downsampling
+        kept = lttb(np.arange(len(worth)), worth, 200)
+        self.assertEqual(200, len(kept))
+        self.assertEqual((0, 4999), (kept[0], kept[-1]))
+        self.assertTrue((np.diff(kept) > 0).all())
+        self.assertIn(1234, kept)
+        self.assertIn(int(np.argmin(worth)), kept)
+        self.assertEqual([0, 1, 2], lttb([0, 1, 2], [1, 2, 3], 200).tolist())
+
+    def test_signal_days(self):
+        days = signal_days([5, 4, 3, 2, 3, 4, 5, 6], -2, 3)
+        self.assertEqual([2], days['buy'].tolist())
+        self.assertEqual([5], days['sell'].tolist())
+
+    def test_svg(self):
+        svg = sparkline_svg(self.series(10000), points=200, low_threshold=-300, high_threshold=500)
+        self.assertTrue(svg.startswith('<svg') and svg.endswith('</svg>'))
+        self.assertEqual(200, svg.split('<polyline points="')[1].split('"')[0].count(','))
+        self.assertIn('<circle', svg)
+        self.assertLess(len(svg), 12000)
+        self.assertEqual('', sparkline_svg([1, 2]))
+
+    def test_notification(self):
+        from monitor import Monitor
+        from monitor_config import MonitorConfig
+        from base_asset import TestAsset
+        monitor = Monitor(MonitorConfig(asset_type='fund', subject_prefix='test', sparklines=True,
+                                        low_threshold=-2, risk_columns=['volatility']))
+        asset = TestAsset('A', [3, 2, 1.5, 1, 1.2])
+        asset.result_cache = None
+        asset.trade()
+        monitor.success = [asset]
+        html = monitor._create_notification_table()
+        self.assertIn('<td style="text-align: right;"><svg', html)
+        self.assertIn('<circle', html)
+        self.assertIn('<th style="text-align: right;"></th>', html)
@@ -1,19 +1,252 @@
 # -*- coding: UTF-8 -*-
+import logging
+import unittest
+from datetime import datetime, timedelta
 import efinance as ef
 
-from base_asset import BaseAsset
+import rate_limiter
+import trading_calendar
+from base_asset import BaseAsset, TIMEZONE, to_date
+
+
+def parse_date(date):
+    """'2025-01-02' -> timestamp in milliseconds of the trading day"""
+    return int(datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=TIMEZONE).timestamp() * 1000)
+
+
+# Markets of the codes that do not follow the rules of market_of, None for the ones trading around the clock
+MARKETS = {
+    'HSI': 'HK',
+    'SZZS': 'CN',
+    '京东': 'US',
+    'US10Y': None,
+    'CN10Y': None,
+    'USDCNY': None,
+}
+
+
+def market_of(code):
+    """6 digits for A-shares, 5 digits for Hong Kong and letters for US tickers"""
+    if code in MARKETS:
+        return MARKETS[code]
+    if code.isdigit():
+        return {6: 'CN', 5: 'HK'}.get(len(code))
+    if code.isascii() and code.isalpha():
+        return 'US'
+    return None
 
 
 class Stock(BaseAsset):
     def __init__(self, code):
         super().__init__(code)
+        self.market = market_of(code)
+        self.prefetched = None  # (name, dates, worth) set by prefetch
+
+    @classmethod
+    def prefetch(cls, stocks):
+        '''Load many stocks with a few requests instead of one history request per stock
+
+        The latest quotes of all the stocks come from one get_latest_quote request. A stock
+        whose archived history already ends on the latest trading day only needs its last
+        price updated. The histories of the others are requested together with a list of codes.
+        '''
+        # only the archived stocks can be updated from a quote
+        codes = [s.code for s in stocks if s.archive is not None and s.code in s.archive]
+        quotes = {}
+        if codes:
+            try:
+                with rate_limiter.limit('eastmoney-bulk'):
+                    latest = ef.stock.get_latest_quote(codes)
+                for _, row in latest.iterrows():
+                    quotes[str(row['代码'])] = row
+            except Exception:
+                logging.exception('failed to get the latest quotes')
+
+        missing = []
+        for s in stocks:
+            quote = quotes.get(s.code)
+            if quote is None or not s._update_from_archive(quote):
+                missing.append(s)
+
+        if missing:
+            # fqt=2 后复权, see download
+            with rate_limiter.limit('eastmoney-bulk'):
+                histories = ef.stock.get_quote_history([s.code for s in missing], fqt=2)
+            for s in missing:
+                hist = histories.get(s.code)
+                if hist is not None and not hist.empty:
+                    s.prefetched = cls._parse_history(hist)
+        logging.info('prefetched {0} stocks: {1} quotes, {2} histories'.format(
+            len(stocks), len(quotes), len(missing)))
+
+    @classmethod
+    def release(cls):
+        super().release()
+        # Need to close the session to avoid the error below:
+        # sys:1: ResourceWarning: unclosed <socket object, fd=3, family=2, type=1, proto=6>
+        ef.shared.session.close()
+
+    def _update_from_archive(self, quote):
+        '''Complete the archived history with the latest quote
+
+        Only possible if the archive ends on the latest trading day, whose price is replaced, or
+        on the trading day before, the quote is then appended: the archive only keeps the settled
+        closes (see BaseAsset.settled). The quote is not adjusted, so it is scaled by the ratio
+        of the adjusted to the raw previous close.
+        '''
+        if self.archive is None or self.code not in self.archive or not quote['昨日收盘']:
+            return False
+        dates, worth = self.archive.read(self.code)
+        day = parse_date(quote['最新交易日'])
+        if len(worth) >= 2 and dates[-1] == day:
+            dates, worth = dates.tolist(), worth[:-1].tolist()
+        elif len(worth) and dates[-1] == self._previous_trading_day(day):
+            dates, worth = dates.tolist() + [day], worth.tolist()
+        else:
+            return False
+        factor = worth[-1] / quote['昨日收盘']
+        name = quote['名称'] or self.archive.index[self.code]['name']
+        self.prefetched = (name, dates, worth + [float(quote['最新价'] * factor)])
+        return True
+
+    def _previous_trading_day(self, day):
+        """Timestamp of the trading day before the one of timestamp day, None without a market calendar"""
+        market = trading_calendar.MARKETS.get(self.market)
+        if market is None:
+            return None
+        previous = to_date(day)
+        for _ in range(60):
+            previous -= timedelta(days=1)
+            if market.is_trading_day(previous):
+                return parse_date(previous.isoformat())
+        return None
+
+    def fallback(self):
+        """The prefetched quote or history is as fresh as a download"""
+        prefetched = self.prefetched
+        if prefetched is None:
+            return super().fallback()
+        self.name, self.dates, self.worth = prefetched
+        self.analyze()
+        return True
+
+    @staticmethod
+    def _parse_history(hist):
+        name = hist.iloc[-1]['股票名称']
+        dates = [parse_date(d) for d in hist['日期']]
+        worth = hist['收盘'].tolist() # The last row contains the current real-time price
+        return name, dates, worth
 
     def download(self):
+        if self.prefetched is not None:
+            self.name, self.dates, self.worth = self.prefetched
+            self.prefetched = None
+            return
         # fqt
             # 0: 不复权
             # 1: 前复权 (default)
             # 2: 后复权
             # 使用后复权因为东方财富返回的前复权历史数据可能包含负数，比如NVDA，会影响计算最大回撤
-        hist = ef.stock.get_quote_history(self.code, fqt=2)
-        self.name = hist.iloc[-1]['股票名称']
-        self.worth = hist['收盘'].tolist() # The last row contains the current real-time price
+        with rate_limiter.limit('eastmoney'):
+            hist = ef.stock.get_quote_history(self.code, fqt=2)
+        self.name, self.dates, self.worth = self._parse_history(hist)
+
+
+class TestStock(unittest.TestCase):
+    def test_market(self):
+        self.assertEqual(['US', 'HK', 'HK', 'CN', 'CN', None, None], [
+            Stock(c).market for c in ['NVDA', 'HSI', '00700', 'SZZS', '600036', 'USDCNY', '黄金ETF-SPDR']])
+
+    def setUp(self):
+        import tempfile
+        import pandas as pd
+        from unittest import mock
+        from history_archive import HistoryArchive
+        self.pd = pd
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = HistoryArchive(self.tmp.name)
+        self.archive.write('AAPL', [parse_date('2025-01-02'), parse_date('2025-01-03')], [20.0, 21.0], 'Apple')
+        self.quotes = pd.DataFrame([
+            {'代码': 'AAPL', '名称': '苹果', '最新价': 11.0, '昨日收盘': 10.0, '最新交易日': '2025-01-03'},
+            {'代码': 'MSFT', '名称': '微软', '最新价': 5.0, '昨日收盘': 4.0, '最新交易日': '2025-01-03'},
+        ])
+        self.histories = {'MSFT': pd.DataFrame({
+            '股票名称': ['微软', '微软'], '日期': ['2025-01-02', '2025-01-03'], '收盘': [40.0, 50.0]})}
+        patcher = mock.patch.multiple(ef.stock, get_latest_quote=mock.DEFAULT, get_quote_history=mock.DEFAULT)
+        self.ef = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ef['get_latest_quote'].return_value = self.quotes
+        self.ef['get_quote_history'].return_value = self.histories
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def create_stock(self, code):
+        stock = Stock(code)
+        stock.archive = self.archive
+        stock.result_cache = None
+        return stock
+
+    def test_prefetch(self):
+        stocks = [self.create_stock('AAPL'), self.create_stock('MSFT')]
+        Stock.prefetch(stocks)
+        # one request for the quotes, one for the histories not up to date in the archive
+        self.ef['get_latest_quote'].assert_called_once_with(['AAPL'])
+        self.ef['get_quote_history'].assert_called_once_with(['MSFT'], fqt=2)
+
+        for s in stocks:
+            s.trade()
+        # the quote is adjusted like the history: 11 * 20 / 10
+        self.assertEqual([20.0, 22.0], stocks[0].worth)
+        self.assertEqual('苹果', stocks[0].name)
+        self.assertEqual([40.0, 50.0], stocks[1].worth)
+        self.assertEqual([parse_date('2025-01-02'), parse_date('2025-01-03')], stocks[1].dates)
+        self.ef['get_quote_history'].assert_called_once()  # download used the prefetched data
+
+    def test_new_trading_day(self):
+        # the archive only keeps the settled closes: Friday's is followed by Monday's quote
+        self.quotes.loc[0, '最新交易日'] = '2025-01-06'
+        stock = self.create_stock('AAPL')
+        Stock.prefetch([stock])
+        self.ef['get_quote_history'].assert_not_called()
+        stock.download()
+        self.assertEqual([parse_date('2025-01-02'), parse_date('2025-01-03'), parse_date('2025-01-06')], stock.dates)
+        # 11 * 21 / 10
+        self.assertEqual([20.0, 21.0, 23.1], stock.worth)
+
+    def test_missing_trading_day(self):
+        self.quotes.loc[0, '最新交易日'] = '2025-01-07'
+        stock = self.create_stock('AAPL')
+        self.histories['AAPL'] = self.pd.DataFrame({'股票名称': ['苹果'], '日期': ['2025-01-07'], '收盘': [30.0]})
+        Stock.prefetch([stock])
+        self.ef['get_quote_history'].assert_called_once_with(['AAPL'], fqt=2)
+        stock.download()
+        self.assertEqual([30.0], stock.worth)
+
+    def test_settled(self):
+        stock = self.create_stock('MSFT')
+        stock.dates = [parse_date('2025-01-02'), parse_date('2025-01-03')]
+        stock.worth = [40.0, 50.0]
+        # 10:00 in New York on Friday: Thursday's close is settled, Friday's price is real-time
+        friday = datetime.fromisoformat('2025-01-03 10:00').replace(tzinfo=trading_calendar.MARKETS['US'].tz)
+        self.assertEqual(1, stock.settled(friday))
+        self.assertEqual(2, stock.settled(friday + timedelta(hours=7)))
+
+    def test_quote_failure(self):
+        self.ef['get_latest_quote'].side_effect = Exception('timeout')
+        stocks = [self.create_stock('AAPL'), self.create_stock('MSFT')]
+        Stock.prefetch(stocks)
+        self.ef['get_quote_history'].assert_called_once_with(['AAPL', 'MSFT'], fqt=2)
+        self.assertIsNone(stocks[0].prefetched)  # AAPL has no history in the mock, it downloads it itself
+        self.assertIsNotNone(stocks[1].prefetched)
+
+    def test_fallback(self):
+        self.ef['get_quote_history'].side_effect = Exception('timeout')
+        stocks = [self.create_stock('AAPL'), self.create_stock('MSFT')]
+        with self.assertRaises(Exception):
+            Stock.prefetch(stocks)
+        # the quote that did arrive is served, MSFT has nothing to fall back to
+        self.assertTrue(stocks[0].fallback())
+        self.assertEqual([20.0, 22.0], stocks[0].worth)
+        self.assertFalse(stocks[0].stale)
+        self.assertFalse(stocks[1].fallback())
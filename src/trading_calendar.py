@@ -0,0 +1,228 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import logging
+import tempfile
+import unittest
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+
+def _days(*ranges):
+    """Expand ('2025-01-28', '2025-02-04') ranges and single '2025-04-04' days into a set of dates"""
+    days = set()
+    for r in ranges:
+        first, last = (r, r) if isinstance(r, str) else r
+        day, last = date.fromisoformat(first), date.fromisoformat(last)
+        while day <= last:
+            days.add(day)
+            day += timedelta(days=1)
+    return days
+
+
+class Market:
+    '''Trading days and session hours of a market
+
+    sessions are (open, close) local times, None for a market that never closes.
+    settle is the delay after the close before the closing price is published,
+    e.g. the net asset value of a fund comes out in the evening.
+    Holidays must be updated every year when the exchanges publish them, a warning is
+    logged the first time a day after the last year of holidays is looked up.
+    '''
+    def __init__(self, name, tz, sessions=None, holidays=(), settle=timedelta(0)):
+        self.name = name
+        self.tz = ZoneInfo(tz)
+        self.sessions = sessions
+        self.holidays = set(holidays)
+        self.settle = settle
+        self.last_year = max(day.year for day in self.holidays) if self.holidays else None
+        self._warned = False
+
+    def is_trading_day(self, day):
+        if self.sessions is None:
+            return True
+        if self.last_year is not None and day.year > self.last_year and not self._warned:
+            self._warned = True
+            logging.warning('the holidays of {0} end in {1}, update trading_calendar.py'.format(self.name, self.last_year))
+        return day.weekday() < 5 and day not in self.holidays
+
+    def is_open(self, now):
+        """Whether a session is in progress at the aware datetime now"""
+        if self.sessions is None:
+            return True
+        local = now.astimezone(self.tz)
+        if not self.is_trading_day(local.date()):
+            return False
+        return any(start <= local.time() < end for start, end in self.sessions)
+
+    def last_close(self, now):
+        """The latest time before now a closing price was published, None if the market never closes"""
+        if self.sessions is None:
+            return None
+        day = now.astimezone(self.tz).date()
+        for _ in range(60):
+            if self.is_trading_day(day):
+                close = datetime.combine(day, self.sessions[-1][1], self.tz) + self.settle
+                if close <= now:
+                    return close
+            day -= timedelta(days=1)
+        return None
+
+    def needs_update(self, last_run, now):
+        """Whether the prices may have changed since last_run: the market is open or has closed since"""
+        if last_run is None or self.is_open(now):
+            return True
+        close = self.last_close(now)
+        return close is None or close > last_run
+
+
+CN_HOLIDAYS = _days(
+    '2025-01-01', ('2025-01-28', '2025-02-04'), '2025-04-04', ('2025-05-01', '2025-05-05'),
+    '2025-06-02', ('2025-10-01', '2025-10-08'),
+    ('2026-01-01', '2026-01-02'), ('2026-02-16', '2026-02-23'), '2026-04-06', ('2026-05-01', '2026-05-05'),
+    '2026-06-19', '2026-09-25', ('2026-10-01', '2026-10-07'),
+)
+HK_HOLIDAYS = _days(
+    '2025-01-01', ('2025-01-29', '2025-01-31'), '2025-04-04', '2025-04-18', '2025-04-21', '2025-05-01',
+    '2025-05-05', '2025-07-01', '2025-10-01', '2025-10-07', '2025-10-29', '2025-12-25', '2025-12-26',
+    '2026-01-01', ('2026-02-17', '2026-02-19'), '2026-04-03', '2026-04-06', '2026-04-07', '2026-05-01',
+    '2026-05-25', '2026-06-19', '2026-07-01', '2026-10-01', '2026-10-19', '2026-12-25',
+)
+US_HOLIDAYS = _days(
+    '2025-01-01', '2025-01-09', '2025-01-20', '2025-02-17', '2025-04-18', '2025-05-26', '2025-06-19',
+    '2025-07-04', '2025-09-01', '2025-11-27', '2025-12-25',
+    '2026-01-01', '2026-01-19', '2026-02-16', '2026-04-03', '2026-05-25', '2026-06-19', '2026-07-03',
+    '2026-09-07', '2026-11-26', '2026-12-25',
+)
+
+CN_SESSIONS = [(time(9, 30), time(11, 30)), (time(13, 0), time(15, 0))]
+
+MARKETS = {
+    'CN': Market('CN', 'Asia/Shanghai', CN_SESSIONS, CN_HOLIDAYS),
+    # the net asset values of the day are published in the evening
+    'CN_FUND': Market('CN_FUND', 'Asia/Shanghai', CN_SESSIONS, CN_HOLIDAYS, settle=timedelta(hours=7)),
+    'HK': Market('HK', 'Asia/Hong_Kong', [(time(9, 30), time(12, 0)), (time(13, 0), time(16, 0))], HK_HOLIDAYS),
+    'US': Market('US', 'America/New_York', [(time(9, 30), time(16, 0))], US_HOLIDAYS),
+    'CRYPTO': Market('CRYPTO', 'UTC'),
+}
+
+
+class TradingCalendar:
+    '''Remember when each asset was last processed to skip the ones whose market has not moved since
+
+    The state is a json file mapping asset codes to the time of their last successful run.
+    A run only counts once the settled prices of the asset have reached the last close of its
+    market, e.g. not before the net asset value of the day is published.
+    Assets without a market (asset.market is None) are always processed.
+    '''
+    def __init__(self, path, markets=MARKETS):
+        self.path = path
+        self.markets = markets
+        self.last_runs = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.last_runs = json.load(f)
+
+    def needs_update(self, asset, now):
+        market = self.markets.get(asset.market)
+        if market is None:
+            return True
+        last_run = self.last_runs.get(asset.code)
+        return market.needs_update(datetime.fromisoformat(last_run) if last_run else None, now)
+
+    def split(self, assets, now=None):
+        """Return the assets to process and the ones to skip"""
+        now = now or datetime.now(timezone.utc)
+        keep, skip = [], []
+        for asset in assets:
+            (keep if self.needs_update(asset, now) else skip).append(asset)
+        if skip:
+            logging.info('skipped {0} assets of closed markets: {1}'.format(len(skip), ','.join(a.code for a in skip)))
+        return keep, skip
+
+    def is_up_to_date(self, asset, now):
+        """Whether the settled prices of asset reach the last close of its market, see BaseAsset.settled"""
+        from base_asset import to_date
+        market = self.markets.get(asset.market)
+        close = market.last_close(now) if market is not None else None
+        if close is None:
+            return True
+        n = asset.settled(now)
+        return n > 0 and to_date(asset.dates[n - 1]) >= close.astimezone(market.tz).date()
+
+    def record(self, assets, now=None):
+        now = now or datetime.now(timezone.utc)
+        for asset in assets:
+            if self.is_up_to_date(asset, now):
+                self.last_runs[asset.code] = now.isoformat()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.last_runs, f)
+        os.replace(tmp, self.path)
+
+
+class TestTradingCalendar(unittest.TestCase):
+    def at(self, market, text):
+        return datetime.fromisoformat(text).replace(tzinfo=MARKETS[market].tz)
+
+    def test_is_open(self):
+        cn = MARKETS['CN']
+        self.assertTrue(cn.is_open(self.at('CN', '2025-06-03 10:00')))
+        self.assertFalse(cn.is_open(self.at('CN', '2025-06-03 12:00')))  # lunch break
+        self.assertFalse(cn.is_open(self.at('CN', '2025-06-02 10:00')))  # Dragon Boat Festival
+        self.assertFalse(cn.is_open(self.at('CN', '2025-06-07 10:00')))  # Saturday
+        us = MARKETS['US']
+        # 21:30 in Shanghai is 09:30 in New York
+        self.assertTrue(us.is_open(self.at('CN', '2025-06-03 21:30')))
+        self.assertFalse(us.is_open(self.at('US', '2025-07-04 10:00')))
+        self.assertTrue(MARKETS['CRYPTO'].is_open(self.at('CN', '2025-06-07 03:00')))
+
+    def test_last_close(self):
+        cn = MARKETS['CN']
+        self.assertEqual(self.at('CN', '2025-05-30 15:00'), cn.last_close(self.at('CN', '2025-06-03 09:00')))
+        self.assertEqual(self.at('CN', '2025-06-03 15:00'), cn.last_close(self.at('CN', '2025-06-03 16:00')))
+        fund = MARKETS['CN_FUND']
+        self.assertEqual(self.at('CN', '2025-06-03 22:00'), fund.last_close(self.at('CN', '2025-06-04 08:00')))
+        self.assertIsNone(MARKETS['CRYPTO'].last_close(self.at('CN', '2025-06-03 16:00')))
+
+    def test_needs_update(self):
+        cn = MARKETS['CN']
+        friday_run = self.at('CN', '2025-05-30 15:30')
+        self.assertTrue(cn.needs_update(None, friday_run))
+        # nothing new over the weekend and the holiday
+        self.assertFalse(cn.needs_update(friday_run, self.at('CN', '2025-05-31 10:00')))
+        self.assertFalse(cn.needs_update(friday_run, self.at('CN', '2025-06-02 20:00')))
+        self.assertTrue(cn.needs_update(friday_run, self.at('CN', '2025-06-03 09:30')))
+        # a run during the session needs the close
+        self.assertTrue(cn.needs_update(self.at('CN', '2025-05-30 14:00'), self.at('CN', '2025-05-31 10:00')))
+
+    def test_holidays_expired(self):
+        market = Market('TEST', 'UTC', CN_SESSIONS, _days('2025-01-01'))
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertTrue(market.is_trading_day(date(2026, 1, 1)))
+            market.is_trading_day(date(2026, 1, 2))
+            logging.warning('end')
+        self.assertEqual(2, len(logs.output))
+        self.assertIn('TEST end in 2025', logs.output[0])
+
+    def test_split_and_record(self):
+        from base_asset import TestAsset
+        fund, crypto, unknown = TestAsset('F'), TestAsset('C'), TestAsset('U')
+        fund.market, crypto.market = 'CN_FUND', 'CRYPTO'
+        fund.dates = [int(self.at('CN', '2025-05-30 00:00').timestamp() * 1000)]
+        fund.worth = [1.0]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calendar.json')
+            calendar = TradingCalendar(path)
+            saturday = self.at('CN', '2025-05-31 10:00')
+            self.assertEqual(([fund, crypto, unknown], []), calendar.split([fund, crypto, unknown], saturday))
+            calendar.record([fund, crypto, unknown], saturday)
+            calendar = TradingCalendar(path)
+            sunday = self.at('CN', '2025-06-01 10:00')
+            self.assertEqual(([crypto, unknown], [fund]), calendar.split([fund, crypto, unknown], sunday))
+            # a fund still on Thursday's net asset value missed Friday's: its run does not count
+            late = TestAsset('L')
+            late.market, late.worth = 'CN_FUND', [1.0]
+            late.dates = [int(self.at('CN', '2025-05-29 00:00').timestamp() * 1000)]
+            calendar.record([late], saturday)
+            self.assertEqual(([late], []), TradingCalendar(path).split([late], sunday))
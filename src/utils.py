@@ -3,12 +3,15 @@
 
 import os
 import logging
+import threading
 import unittest
 from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import Header
-from smtplib import SMTP_SSL
+from smtplib import SMTP_SSL, SMTPException, SMTPResponseException, SMTPServerDisconnected
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import CONFIG
 
@@ -31,25 +34,153 @@ def html_table(lol, head=True):
         yield '</table>'
     return '\n'.join(yield_lines())
 
-def send_email(receiver, subject, mail_content, mimetype='plain', doNotSend=False):
-    logging.info('send email...')
-
-    host_server = 'smtp.qq.com'
-    sender_qq_mail = CONFIG.EMAIL_ADDRESS
-    pwd = CONFIG.EMAIL_PASSCODE
-    smtp = SMTP_SSL(host_server)
-    smtp.login(sender_qq_mail, pwd)
-
+def _create_message(subject, mail_content, mimetype='plain'):
     msg = MIMEMultipart()
     msg.attach(MIMEText(mail_content, mimetype, 'utf-8'))
     msg["Subject"] = Header(subject, 'utf-8')
-    msg["From"] = sender_qq_mail
+    msg["From"] = CONFIG.EMAIL_ADDRESS
+    return msg
+
+def _login(host_server='smtp.qq.com'):
+    smtp = SMTP_SSL(host_server)
+    smtp.login(CONFIG.EMAIL_ADDRESS, CONFIG.EMAIL_PASSCODE)
+    return smtp
+
+def send_email(receiver, subject, mail_content, mimetype='plain', doNotSend=False, smtp=None):
+    """Send one email
+
+    Pass a logged-in smtp connection (e.g. from SMTPPool) to reuse it,
+    otherwise a new connection is opened and closed for this email.
+    """
+    logging.info('send email...')
+
+    own_connection = smtp is None
+    if own_connection:
+        smtp = _login()
+
+    msg = _create_message(subject, mail_content, mimetype)
 
     if not doNotSend:
-        smtp.sendmail(sender_qq_mail, receiver, msg.as_string())
-    smtp.quit()
+        smtp.sendmail(CONFIG.EMAIL_ADDRESS, receiver, msg.as_string())
+    if own_connection:
+        smtp.quit()
     logging.info('email sent successfully')
 
+def is_broken_session(e):
+    """Whether an error leaves an SMTP connection unusable, e.g. not a refused recipient"""
+    if isinstance(e, SMTPServerDisconnected):
+        return True
+    if isinstance(e, SMTPResponseException):
+        return e.smtp_code == 421  # the server is closing the connection
+    # SMTPException is an OSError too, the others (ssl.SSLError, timeouts...) break the socket
+    return isinstance(e, OSError) and not isinstance(e, SMTPException)
+
+
+class SMTPPool:
+    """A bounded pool of logged-in SMTP connections
+
+    Connections are opened lazily, at most `size` of them, and each one is
+    authenticated once and reused for many emails until the pool is closed.
+    A broken connection is closed and a caller waiting for a connection opens
+    a new one instead.
+    """
+    def __init__(self, size=3, host_server='smtp.qq.com', connect=None):
+        self.size = size
+        self.host_server = host_server
+        self._connect = connect or (lambda: _login(self.host_server))
+        self._idle = []  # the last returned connection is reused first
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self):
+        smtp = self._acquire()
+        try:
+            yield smtp
+        except BaseException as e:
+            if is_broken_session(e):
+                self._discard(smtp)
+            else:
+                self._release(smtp)
+            raise
+        else:
+            self._release(smtp)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._connect()
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _release(self, smtp):
+        with self._cond:
+            self._idle.append(smtp)
+            self._cond.notify()
+
+    def _discard(self, smtp):
+        """Close a broken connection and let a waiting caller open a new one"""
+        if smtp is not None:
+            try:
+                smtp.close()
+            except Exception:
+                logging.exception('failed to close smtp connection')
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for smtp in idle:
+            try:
+                smtp.quit()
+            except Exception:
+                logging.exception('failed to close smtp connection')
+
+def send_emails(messages, max_workers=3, pool=None, doNotSend=False):
+    """Send many emails in parallel over a shared pool of SMTP connections
+
+    messages is a list of (receiver, subject, mail_content, mimetype).
+    A broken session (see is_broken_session) is retried once on a fresh connection.
+    Return the list of messages that could not be sent.
+    """
+    def send(message):
+        for attempt in range(2):
+            try:
+                with pool.connection() as smtp:
+                    send_email(*message, doNotSend=doNotSend, smtp=smtp)
+                return None
+            except Exception as e:
+                # a broken session is retried once on a fresh connection
+                if attempt > 0 or not is_broken_session(e):
+                    logging.exception('failed to send email to {0}'.format(message[0]))
+                    break
+        return message
+
+    own_pool = pool is None
+    if own_pool:
+        pool = SMTPPool(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [m for m in executor.map(send, messages) if m is not None]
+    finally:
+        if own_pool:
+            pool.close()
+
 class TestUtils(unittest.TestCase):
     def test_html_table(self):
         lols = [
@@ -70,6 +201,100 @@ class TestUtils(unittest.TestCase):
         self.assertIn('<th>', result_with_head)  # Should have headers
         self.assertNotIn('<th>', result_without_head)  # Should not have headers
 
+    def test_smtp_pool(self):
+        class FakeSMTP:
+            def __init__(self):
+                self.sent = []
+                self.closed = False
+            def sendmail(self, sender, receiver, msg):
+                self.sent.append(receiver)
+            def quit(self):
+                self.closed = True
+
+        connections = []
+        def connect():
+            connections.append(FakeSMTP())
+            return connections[-1]
+
+        pool = SMTPPool(2, connect=connect)
+        messages = [(['user{}@example.com'.format(i)], 'Test', 'hello', 'plain') for i in range(20)]
+        self.assertEqual([], send_emails(messages, max_workers=2, pool=pool))
+        # every email is sent over at most 2 logged-in connections
+        self.assertLessEqual(len(connections), 2)
+        self.assertEqual(20, sum(len(c.sent) for c in connections))
+        pool.close()
+        self.assertTrue(all(c.closed for c in connections))
+
+    def test_smtp_pool_reconnect(self):
+        class BrokenSMTP:
+            def sendmail(self, sender, receiver, msg):
+                raise SMTPServerDisconnected()
+            def quit(self):
+                pass
+            def close(self):
+                pass
+
+        class FakeSMTP(BrokenSMTP):
+            def sendmail(self, sender, receiver, msg):
+                pass
+
+        connections = [FakeSMTP(), BrokenSMTP()]
+        pool = SMTPPool(1, connect=connections.pop)
+        self.assertEqual([], send_emails([(['a@example.com'], 'Test', 'hello', 'plain')], pool=pool))
+        self.assertEqual([], connections)
+
+    def test_smtp_pool_broken_session(self):
+        import ssl
+        from smtplib import SMTPRecipientsRefused
+
+        class FakeSMTP:
+            def __init__(self, error=None):
+                self.error = error
+                self.closed = False
+            def sendmail(self, sender, receiver, msg):
+                if self.error:
+                    raise self.error
+            def quit(self):
+                pass
+            def close(self):
+                self.closed = True
+
+        for error, broken in [(ssl.SSLError('bad record'), True), (TimeoutError(), True),
+                              (SMTPResponseException(421, 'closing'), True),
+                              (SMTPRecipientsRefused({}), False), (ValueError(), False)]:
+            first = FakeSMTP(error)
+            pool = SMTPPool(1, connect=[FakeSMTP(), first].pop)
+            with self.assertRaises(type(error)):
+                with pool.connection() as smtp:
+                    smtp.sendmail(None, None, None)
+            # a broken connection is closed and replaced by a new one, the others are reused
+            self.assertEqual(broken, first.closed, error)
+            with pool.connection() as smtp:
+                self.assertIs(not broken, smtp is first, error)
+        self.assertTrue(is_broken_session(SMTPServerDisconnected()))
+
+    def test_smtp_pool_waiter_replaces_broken(self):
+        class FakeSMTP:
+            def sendmail(self, sender, receiver, msg):
+                pass
+            def quit(self):
+                pass
+            def close(self):
+                pass
+
+        pool = SMTPPool(1, connect=FakeSMTP)
+        got = []
+        with self.assertRaises(SMTPServerDisconnected):
+            with pool.connection() as first:
+                waiter = threading.Thread(target=lambda: got.append(pool._acquire()))
+                waiter.start()
+                waiter.join(0.2)
+                self.assertTrue(waiter.is_alive())  # the pool is full
+                raise SMTPServerDisconnected()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertIsNot(first, got[0])
+
     @unittest.skipIf(int(os.getenv('TEST_SEND_EMAIL', 0)) < 1, 'skip by default')
     def test_send_email(self):
         html_msg = """<table>
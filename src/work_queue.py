@@ -0,0 +1,249 @@
+# -*- coding: UTF-8 -*-
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+import unittest
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    run_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (run_id, key)
+)'''
+
+
+class Task:
+    def __init__(self, run_id, key, payload, attempts):
+        self.run_id = run_id
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+
+    def __repr__(self):
+        return 'Task({0}, {1}, attempt {2})'.format(self.run_id, self.key, self.attempts)
+
+
+class WorkQueue:
+    '''Queue of tasks in a SQLite file shared by a coordinator and its workers
+
+    Tasks are identified by (run_id, key), enqueuing them again is a no-op. A worker leases
+    tasks for a while: if it dies, the lease expires and another worker takes them over, up to
+    max_attempts times. Only the worker holding the lease can complete or fail a task.
+    The file can be on a shared disk, each operation is a short transaction.
+    '''
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    def _connect(self):
+        # autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE
+        return _Connection(sqlite3.connect(self.path, timeout=30, isolation_level=None))
+
+    def enqueue(self, run_id, tasks):
+        """Add the tasks of a run, tasks is a dict key -> json serializable payload"""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR IGNORE INTO tasks (run_id, key, payload) VALUES (?, ?, ?)',
+                           [(run_id, key, json.dumps(payload, ensure_ascii=False)) for key, payload in tasks.items()])
+            db.execute('COMMIT')
+
+    def lease(self, worker, n=1, duration=300, run_id=None, now=None):
+        """Lease up to n pending tasks, or tasks whose lease has expired"""
+        now = now or time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('''
+                SELECT run_id, key, payload, attempts FROM tasks
+                WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?))
+                AND attempts < ? AND (? IS NULL OR run_id = ?)
+                ORDER BY run_id, rowid LIMIT ?''',
+                (now, self.max_attempts, run_id, run_id, n)).fetchall()
+            for r in rows:
+                db.execute('''UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1
+                              WHERE run_id = ? AND key = ?''', (worker, now + duration, r[0], r[1]))
+            self._expire(db, now)
+            db.execute('COMMIT')
+        return [Task(r[0], r[1], json.loads(r[2]), r[3] + 1) for r in rows]
+
+    def _expire(self, db, now):
+        """Expired leases without attempts left will never be done, mark them failed"""
+        db.execute('''UPDATE tasks SET state = 'failed', error = COALESCE(error, 'lease expired')
+                      WHERE state = 'leased' AND lease_until < ? AND attempts >= ?''', (now, self.max_attempts))
+
+    def extend(self, task, worker, duration=300, now=None):
+        """Keep a lease alive, return False if it has been lost"""
+        now = now or time.time()
+        with self._connect() as db:
+            cursor = db.execute('''UPDATE tasks SET lease_until = ? WHERE run_id = ? AND key = ?
+                                   AND state = 'leased' AND worker = ?''', (now + duration, task.run_id, task.key, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, task, worker, result):
+        """Store the result of a task, return False if the lease had been taken over by another worker"""
+        with self._connect() as db:
+            cursor = db.execute('''UPDATE tasks SET state = 'done', result = ?, error = NULL
+                                   WHERE run_id = ? AND key = ? AND state = 'leased' AND worker = ?''',
+                                (json.dumps(result, ensure_ascii=False), task.run_id, task.key, worker))
+            return cursor.rowcount == 1
+
+    def fail(self, task, worker, error):
+        """Give the task back to be retried, or mark it failed when it has no attempts left"""
+        with self._connect() as db:
+            cursor = db.execute('''UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                   error = ?, worker = NULL, lease_until = NULL
+                                   WHERE run_id = ? AND key = ? AND state = 'leased' AND worker = ?''',
+                                (self.max_attempts, str(error), task.run_id, task.key, worker))
+            return cursor.rowcount == 1
+
+    def counts(self, run_id):
+        """Number of tasks of a run in each state"""
+        with self._connect() as db:
+            rows = db.execute('SELECT state, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY state', (run_id,)).fetchall()
+        return dict(rows)
+
+    def is_finished(self, run_id, now=None):
+        """Whether every task of a run is done or failed, without waiting for a worker to lease again"""
+        with self._connect() as db:
+            self._expire(db, now or time.time())
+        counts = self.counts(run_id)
+        return counts.get('pending', 0) + counts.get('leased', 0) == 0
+
+    def results(self, run_id):
+        """Return {key: result} of the done tasks and {key: error} of the failed ones"""
+        with self._connect() as db:
+            rows = db.execute('SELECT key, state, result, error FROM tasks WHERE run_id = ? ORDER BY rowid',
+                              (run_id,)).fetchall()
+        done = {key: json.loads(result) for key, state, result, _ in rows if state == 'done'}
+        failed = {key: error for key, state, _, error in rows if state == 'failed'}
+        return done, failed
+
+
+class Heartbeat:
+    '''Extend the leases of tasks from a thread while they are processed
+
+    Every duration / 3 seconds the lease of each task not yet done() is extended by duration,
+    so a batch slower than its lease is not taken over by another worker.
+    '''
+    def __init__(self, queue, worker, tasks, duration):
+        self.queue = queue
+        self.worker = worker
+        self.duration = duration
+        self._tasks = {(t.run_id, t.key): t for t in tasks}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+    def done(self, task):
+        with self._lock:
+            self._tasks.pop((task.run_id, task.key), None)
+
+    def _run(self):
+        while not self._stop.wait(self.duration / 3):
+            with self._lock:
+                tasks = list(self._tasks.values())
+            for task in tasks:
+                if not self.queue.extend(task, self.worker, self.duration):
+                    logging.warning(f'The lease of {task.key} has been lost')
+                    self.done(task)
+
+
+class _Connection:
+    """sqlite3 connection that is closed at the end of the with block"""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.connection.in_transaction:
+            self.connection.execute('ROLLBACK')
+        self.connection.close()
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = WorkQueue(os.path.join(self.tmp.name, 'queue.db'), max_attempts=2)
+        self.queue.enqueue('r1', {'a': ['fund', '000961'], 'b': ['crypto', ['OKB/USDT', 'okx']]})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_enqueue_is_idempotent(self):
+        self.queue.enqueue('r1', {'a': ['fund', 'changed'], 'c': ['stock', 'NDX']})
+        self.assertEqual({'pending': 3}, self.queue.counts('r1'))
+        tasks = self.queue.lease('w1', n=10)
+        self.assertEqual(['fund', '000961'], tasks[0].payload)
+
+    def test_lease_and_complete(self):
+        tasks = self.queue.lease('w1', n=1)
+        self.assertEqual(['a'], [t.key for t in tasks])
+        self.assertEqual(['b'], [t.key for t in self.queue.lease('w2', n=5)])
+        self.assertEqual([], self.queue.lease('w3'))
+        self.assertTrue(self.queue.complete(tasks[0], 'w1', {'N': 3}))
+        self.assertFalse(self.queue.is_finished('r1'))
+        self.assertEqual(({'a': {'N': 3}}, {}), self.queue.results('r1'))
+
+    def test_expired_lease(self):
+        now = time.time()
+        task, = self.queue.lease('w1', run_id='r1', duration=10, now=now)
+        # w1 died, its task is leased again once the lease has expired
+        self.assertEqual(['b'], [t.key for t in self.queue.lease('w2', n=5, now=now + 5)])
+        retried, = self.queue.lease('w3', now=now + 11)
+        self.assertEqual(('a', 2), (retried.key, retried.attempts))
+        self.assertFalse(self.queue.complete(task, 'w1', {'N': 1}))  # too late
+        self.assertTrue(self.queue.complete(retried, 'w3', {'N': 2}))
+        self.assertEqual({'N': 2}, self.queue.results('r1')[0]['a'])
+
+    def test_expired_without_workers(self):
+        now = time.time()
+        self.queue.lease('w1', n=2, duration=10, now=now)
+        a, b = self.queue.lease('w2', n=2, duration=10, now=now + 11)
+        self.queue.complete(b, 'w2', {'N': 1})
+        # w2 died too and no worker leases any more: the last attempt of a is over
+        self.assertFalse(self.queue.is_finished('r1', now=now + 15))
+        self.assertTrue(self.queue.is_finished('r1', now=now + 22))
+        self.assertEqual({'a': 'lease expired'}, self.queue.results('r1')[1])
+
+    def test_heartbeat(self):
+        task, = self.queue.lease('w1', duration=0.3)
+        with Heartbeat(self.queue, 'w1', [task], 0.3) as heartbeat:
+            time.sleep(0.5)
+            self.assertEqual(['b'], [t.key for t in self.queue.lease('w2', n=5)])
+            heartbeat.done(task)
+            time.sleep(0.5)
+            # no longer extended once done
+            self.assertEqual(['a'], [t.key for t in self.queue.lease('w3')])
+
+    def test_fail_and_retry(self):
+        task, = self.queue.lease('w1')
+        self.assertTrue(self.queue.fail(task, 'w1', 'timeout'))
+        task, = self.queue.lease('w2')
+        self.assertEqual(('a', 2), (task.key, task.attempts))
+        self.queue.fail(task, 'w2', 'timeout again')
+        self.queue.lease('w2')  # b
+        self.assertEqual({'failed': 1, 'leased': 1}, self.queue.counts('r1'))
+        self.assertEqual({'a': 'timeout again'}, self.queue.results('r1')[1])